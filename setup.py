@@ -80,5 +80,6 @@ setup(name='superlance',
       crashmailbatch = superlance.crashmailbatch:main
       fatalmailbatch = superlance.fatalmailbatch:main
       memmon = superlance.memmon:main
+      memmon-report = superlance.memmon_report:main
       """
       )
@@ -24,3 +24,13 @@ try:
     import xmlrpc.client as xmlrpclib
 except ImportError:
     import xmlrpclib
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
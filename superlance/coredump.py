@@ -0,0 +1,141 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Writes core files of hung processes with a gcore command before httpok
+# restarts them: several at a time, each within a time limit, and
+# compressed afterwards into a core directory of bounded size.
+
+import gzip
+import os
+import shutil
+import time
+
+from supervisor.options import make_namespec
+
+from superlance.tasks import run_all
+from superlance.tasks import run_command
+
+CHUNK_SIZE = 1024 * 1024
+COMPRESSLEVEL = 1 # cores can be gigabytes, so favour speed
+
+def compress(path):
+    """Gzip the file at path into path + '.gz', a chunk at a time, and
+    remove it.  Returns the path of the compressed file."""
+    gzpath = path + '.gz'
+    with open(path, 'rb') as f:
+        with gzip.GzipFile(gzpath, 'wb', COMPRESSLEVEL) as z:
+            shutil.copyfileobj(f, z, CHUNK_SIZE)
+    os.remove(path)
+    return gzpath
+
+class CoreDumper:
+    """Runs `gcore` (a command taking a file name and a pid) for several
+    processes at once, at most `concurrency` at a time.  A gcore that
+    takes longer than `timeout` seconds is killed and its partial core
+    removed.
+
+    gcore seeks around the file it writes, so a core can't be compressed
+    as it is written; store() compresses the cores once they are written
+    (after the processes have been restarted), then removes the oldest
+    compressed cores until the directory holds at most `max_size` bytes
+    of them."""
+
+    def __init__(self, gcore, coredir, concurrency=4, timeout=120,
+                 max_size=None):
+        self.gcore = gcore
+        self.coredir = coredir
+        self.concurrency = concurrency
+        self.timeout = timeout
+        self.max_size = max_size
+
+    def dump_all(self, specs):
+        """Write a core for each of the getAllProcessInfo() entries specs.
+        Returns a list of (output, paths) in the same order: the output of
+        gcore and the core files it wrote."""
+        return run_all(self.dump, specs, self.concurrency)
+
+    def dump(self, spec):
+        corename = os.path.join(self.coredir,
+                                make_namespec(spec['group'], spec['name']))
+        cmd = self.gcore + ' "%s" %s' % (corename, spec['pid'])
+        started = time.time()
+        try:
+            status, output, expired = run_command(cmd, self.timeout)
+        except (IOError, OSError) as e:
+            return str(e), []
+
+        # gdb's gcore appends the pid to the file name, others may not
+        paths = []
+        for path in (corename, '%s.%s' % (corename, spec['pid'])):
+            try:
+                if os.path.getmtime(path) >= int(started):
+                    paths.append(path)
+            except OSError:
+                pass
+        if expired:
+            for path in paths:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            output += '\ngcore timed out after %s seconds, core removed' % (
+                self.timeout)
+            return output, []
+        return output, paths
+
+    def store(self, paths, write):
+        """Compress the cores at paths, then evict the oldest compressed
+        cores beyond max_size."""
+        def compress_one(path):
+            try:
+                return compress(path)
+            except (IOError, OSError) as e:
+                write('Failed to compress %s: %s' % (path, e))
+                return None
+        stored = [path for path in
+                  run_all(compress_one, paths, self.concurrency) if path]
+        for path in stored:
+            write('Wrote core %s' % path)
+        if self.max_size is not None:
+            self.evict(stored, write)
+        return stored
+
+    def evict(self, keep, write):
+        """Remove the oldest compressed cores in coredir, except those in
+        keep, until their total size is at most max_size."""
+        cores = []
+        total = 0
+        for name in os.listdir(self.coredir):
+            if not name.endswith('.gz'):
+                continue
+            path = os.path.join(self.coredir, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            total += st.st_size
+            if path not in keep:
+                cores.append((st.st_mtime, path, st.st_size))
+        cores.sort()
+        for mtime, path, size in cores:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError as e:
+                write('Failed to remove old core %s: %s' % (path, e))
+                continue
+            total -= size
+            write('Removed old core %s (the cores in %s are limited to %d '
+                  'bytes)' % (path, self.coredir, self.max_size))
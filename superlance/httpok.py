@@ -26,7 +26,12 @@
 
 doc = """\
 httpok.py [-p processname] [-a] [-g] [-t timeout] [-c status_code] [-b inbody]
-          [-m mail_address] [-s sendmail] URL
+          [-m mail_address] [-s sendmail] [-f config_file]
+          [--concurrency N] [--method GET|HEAD] [--max-body byte_size]
+          [--failures N] [--window N] [--cooldown seconds]
+          [--p95 seconds] [--p99 seconds] [--latency-window N]
+          [--port-base N] [--gcore-concurrency N] [--gcore-timeout seconds]
+          [--coredir-max byte_size] URL
 
 Options:
 
@@ -48,12 +53,29 @@ Options:
 -d -- Core directory.  If a core directory is specified, httpok will
       try to use the ``gcore`` program (see ``-g``) to write a core
       file into this directory against each hung process before we
-      restart it.  Append gcore stdout output to email.
+      restart it.  Append gcore stdout output to email.  The cores of
+      all the processes being restarted are written at the same time,
+      then compressed with gzip (to <name>.gz) after the restarts.
+
+--gcore-concurrency -- the number of gcore commands to run at the same
+      time.  Default is 4.
+
+--gcore-timeout -- the number of seconds after which a gcore command is
+      killed (and its partial core removed), so that the process is
+      restarted anyway.  Default is 120.
+
+--coredir-max -- the total size of the compressed cores (*.gz) to keep
+      in the core directory.  Once cores have been written, the oldest
+      ones are removed until the rest fit.  Can be a plain integer or a
+      suffix-multiplied integer (e.g. 10GB).  Unlimited by default.
 
 -t -- The number of seconds that httpok should wait for a response
       before timing out.  If this timeout is exceeded, httpok will
       attempt to restart processes in the RUNNING state specified by
-      -p or -a.  This defaults to 10 seconds.
+      -p or -a.  This defaults to 10 seconds.  A refused connection is
+      retried until then, after 1 second, then about twice as long each
+      time.  URLs are checked in the background, so httpok answers
+      supervisord's TICK events at once.
 
 -c -- specify an expected HTTP status code from a GET request to the
       URL.  If this status code is not the status code provided by the
@@ -66,6 +88,39 @@ Options:
       or -a will be restarted.  The default is to ignore the
       body.
 
+--method -- the HTTP method to use, GET (the default) or HEAD.  HEAD
+      can be used when only the status code is checked (no -b).
+
+--max-body -- the body is read in chunks, and at most this many bytes
+      of it are read.  With -b, reading stops as soon as the string is
+      found; if it isn't found within this many bytes, the body is
+      considered bad.  Can be a plain integer or a suffix-multiplied
+      integer (e.g. 64KB).  Default is 1MB.
+
+--failures -- only restart processes once this many checks of the URL
+      in a row have failed.  Default is 1.
+
+--window -- with --failures, restart once --failures of the last
+      --window checks have failed, whether or not in a row.
+
+--cooldown -- after restarting processes, don't restart them again for
+      this many seconds, however often the URL fails.  If the first check
+      after the cool-down fails too, the processes are restarted again
+      and the cool-down doubles, up to 16 times this value, until a check
+      succeeds.  This avoids restarting processes over and over when the
+      real cause is elsewhere.  Default is 0 (no cool-down).
+
+--p95, --p99 -- the response time in seconds which the 95th (or 99th)
+      percentile of the last --latency-window responses must stay under.
+      Above it, the URL counts as failed (see --failures) even though it
+      answered in time.  Response times are kept in a histogram of fixed
+      buckets per URL, and the percentiles are included in the email.
+      Off by default.
+
+--latency-window -- the number of responses the percentiles are taken
+      over.  They are only checked once this many have been seen since
+      httpok started or last restarted the processes.  Default is 20.
+
 -s -- the sendmail command to use to send email
       (e.g. "/usr/sbin/sendmail -t -i").  Must be a command which accepts
       header and message data on stdin and sends mail.
@@ -85,7 +140,47 @@ Options:
       be used in the email subject to identify which httpok process
       restarted the process.
 
-URL -- The URL to which to issue a GET request.
+-f -- a config file of further URLs to check, each in a [check:name]
+      section with these options:
+
+        url = http://localhost:8080/tasty
+        programs = program1 group1:program2
+        any = false
+        timeout = 10
+        codes = 200 204
+        body = some text
+        eager = true
+        method = GET
+        max_body = 1MB
+        failures = 3
+        window = 5
+        cooldown = 300
+        p95 = 0.5
+        p99 = 2
+        latency_window = 20
+        port_base = 8000
+
+      Only 'url' is required; the other options default to the values
+      of -p, -a, -t, -c, -b, -e/-E, --method, --max-body, --failures,
+      --window, --cooldown, --p95, --p99, --latency-window and
+      --port-base.  Each URL restarts its own programs.  With -f, the URL
+      argument is optional.
+
+--concurrency -- the most URLs to check at the same time.  By default
+      every URL that is due is checked at once, so a tick takes about as
+      long as the slowest of them rather than the sum of their timeouts.
+
+--port-base -- the number added to the process number of a process to
+      give the %(port)d of its URL (see below).
+
+URL -- The URL to which to issue a GET request.  A URL containing
+      %(group_name)s, %(process_name)s, %(process_num)d or %(port)d is
+      a template: it is expanded for, and checked separately against,
+      each RUNNING process selected by -p or -a, and a failure restarts
+      only the process whose own URL failed.  With a template, -p accepts
+      'group_name:*' for all the processes of a group.  The process
+      number is taken from the digits at the end of the process name (as
+      supervisord's numprocs names processes, e.g. web_03).
 
 The -c option may be specified more than once, allowing for
 specification of multiple expected HTTP status codes.
@@ -98,30 +193,291 @@ A sample invocation:
 
 httpok.py -p program1 -p group1:program2 http://localhost:8080/tasty
 
+Checking each process of a group of workers listening on ports 8000 and
+up (web:web_00 on 8000, web:web_01 on 8001 and so on):
+
+httpok.py -p 'web:*' --port-base 8000 'http://localhost:%(port)d/health'
+
 """
 
+import errno
 import getopt
 import os
+import random
+import re
 import socket
 import sys
+import threading
 import time
+from collections import deque
+from superlance.compat import configparser
 from superlance.compat import urlparse
 from superlance.compat import xmlrpclib
 
 from supervisor import childutils
+from supervisor.datatypes import byte_size
 from supervisor.states import ProcessStates
 from supervisor.options import make_namespec
 
 from superlance import timeoutconn
+from superlance.coredump import CoreDumper
+from superlance.tasks import run_all
 
 def usage(exitstatus=255):
     print(doc)
     sys.exit(exitstatus)
 
+MAX_BODY = 1024 * 1024
+MAX_BACKOFF = 16 # the cool-down grows to at most this many times --cooldown
+CHUNK_SIZE = 8192
+MIN_RETRY_DELAY = 0.1
+LATENCY_WINDOW = 20
+# upper bounds in seconds of the latency histogram buckets (1-2-5 from 1ms
+# to 100s, then everything slower)
+LATENCY_BUCKETS = tuple(m * 10 ** e for e in range(-3, 3)
+                        for m in (1, 2, 5))[:-2] + (float('inf'),)
+
+class LatencyHistogram:
+    """Counts the response times of the last `window` probes of a URL in
+    fixed buckets, and estimates quantiles from them by interpolating
+    within the bucket a quantile falls in."""
+
+    def __init__(self, window=LATENCY_WINDOW, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.samples = deque() # bucket index of each probe in the window
+        self.window = window
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, seconds):
+        for i, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                break
+        self.samples.append(i)
+        self.counts[i] += 1
+        if len(self.samples) > self.window:
+            self.counts[self.samples.popleft()] -= 1
+
+    def clear(self):
+        self.samples.clear()
+        self.counts = [0] * len(self.buckets)
+
+    def full(self):
+        return len(self.samples) >= self.window
+
+    def quantile(self, q):
+        """Return the estimated q-quantile (0 < q <= 1) in seconds, or None
+        if there are no samples."""
+        total = len(self.samples)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = i and self.buckets[i - 1] or 0.0
+                upper = self.buckets[i]
+                if upper == float('inf'):
+                    return lower
+                return lower + (upper - lower) * (rank - seen) / count
+            seen += count
+
+    def summary(self):
+        return 'p50 %.3fs, p95 %.3fs, p99 %.3fs over the last %d checks' % (
+            self.quantile(0.5), self.quantile(0.95), self.quantile(0.99),
+            len(self))
+
+def search_body(response, search, limit):
+    """Read the body of a response in chunks until the bytes `search` are
+    found in it, it ends, or `limit` bytes have been read.  Returns
+    (found, complete), where complete is True if the whole body was read.
+    Without `search`, the body is read and discarded."""
+    # keep enough of the previous chunk to match across chunk boundaries
+    overlap = max(len(search or b'') - 1, 0)
+    tail = b''
+    seen = 0
+    while seen < limit:
+        chunk = response.read(min(CHUNK_SIZE, limit - seen))
+        if not chunk:
+            return False, True
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        seen += len(chunk)
+        if search:
+            data = tail + chunk
+            if search in data:
+                # the match may have been in the last chunk of the body
+                return True, response.isclosed()
+            tail = data[-overlap:] if overlap else b''
+    return False, False
+
+TRAILING_NUMBER = re.compile(r'(\d+)$')
+
+def expand_url(url, spec, port_base=None):
+    """Return the URL template url expanded for the process of the
+    getAllProcessInfo() entry spec."""
+    match = TRAILING_NUMBER.search(spec['name'])
+    process_num = match and int(match.group(1)) or 0
+    expansions = {
+        'group_name': spec['group'],
+        'process_name': spec['name'],
+        'process_num': process_num,
+        }
+    if port_base is not None:
+        expansions['port'] = port_base + process_num
+    try:
+        return url % expansions
+    except KeyError as e:
+        if e.args[0] == 'port':
+            raise ValueError('%s: %%(port)d needs --port-base' % url)
+        raise ValueError('%s: unknown expansion %s' % (url, e))
+    except (TypeError, ValueError) as e:
+        raise ValueError('%s: bad expansion (%s)' % (url, e))
+
+def validate_url(url, port_base=None):
+    """Raise ValueError if url is a URL template which can't be
+    expanded."""
+    if '%(' in url:
+        expand_url(url, {'name': 'name_0', 'group': 'group'}, port_base)
+
+class Check:
+    """A URL which httpok requests on every tick, what it expects of the
+    response, and the processes it restarts when the response isn't as
+    expected."""
+
+    def __init__(self, url, programs, any, timeout, statuses, inbody,
+                 eager=True, method='GET', max_body=MAX_BODY, failures=1,
+                 window=0, cooldown=0, p95=None, p99=None,
+                 latency_window=LATENCY_WINDOW, port_base=None):
+        self.url = url
+        self.programs = programs
+        self.any = any
+        self.timeout = timeout
+        self.statuses = statuses
+        self.inbody = inbody
+        self.eager = eager
+        self.method = method
+        self.max_body = max_body
+        self.search = None
+        if inbody:
+            # the body is searched as bytes, as it is read
+            self.search = inbody
+            if not isinstance(inbody, bytes):
+                self.search = inbody.encode('utf-8')
+
+        # act when `failures` of the last `window` probes failed (or that
+        # many in a row without a window), then hold off for `cooldown`
+        # seconds, doubling each time a restart doesn't help
+        self.failures = failures
+        self.window = window
+        self.cooldown = cooldown
+        self.results = deque(maxlen=max(window, failures))
+        self.tripped = False # restarted, not yet seen to succeed since
+        self.open_until = 0
+        self.backoff = cooldown
+
+        # the response time limits (in seconds) the 95th and 99th
+        # percentile of the last `latency_window` probes must stay under
+        self.p95 = p95
+        self.p99 = p99
+        self.slos = [(name, q, limit) for name, q, limit in
+                     (('p95', 0.95, p95), ('p99', 0.99, p99))
+                     if limit is not None]
+        self.latency = LatencyHistogram(latency_window)
+
+        # a URL template is checked once per process, by a Check of its
+        # own for each process (so each keeps its own failure state)
+        self.per_process = '%(' in url
+        self.port_base = port_base
+        self.workers = {} # namespec -> Check
+        validate_url(url, port_base)
+
+        parsed = urlparse.urlsplit(url)
+        self.scheme = parsed.scheme.lower()
+        self.hostport = parsed.netloc
+        self.path = parsed.path
+        if parsed.query:
+            self.path += '?' + parsed.query
+
+    def listProcesses(self, specs, state=None):
+        return [x for x in specs
+                   if x['name'] in self.programs and
+                      (state is None or x['state'] == state)]
+
+    def expand(self, specs):
+        """Return a Check for each RUNNING process of a per-process check,
+        which requests the URL expanded for the process and restarts only
+        it."""
+        workers = {}
+        running = []
+        for spec in specs:
+            namespec = make_namespec(spec['group'], spec['name'])
+            if not (self.any or spec['name'] in self.programs or
+                    namespec in self.programs or
+                    '%s:*' % spec['group'] in self.programs):
+                continue
+            url = expand_url(self.url, spec, self.port_base)
+            worker = self.workers.get(namespec)
+            if worker is None or worker.url != url:
+                worker = Check(url, [namespec], False, self.timeout,
+                               self.statuses, self.inbody, self.eager,
+                               self.method, self.max_body, self.failures,
+                               self.window, self.cooldown, self.p95,
+                               self.p99, self.latency.window)
+            workers[namespec] = worker
+            if spec['state'] == ProcessStates.RUNNING:
+                running.append(worker)
+        # processes which are gone are forgotten
+        self.workers = workers
+        return running
+
+    def record(self, failed, now):
+        """Record the result of a probe.  Returns (act, reason): whether
+        to act on a failure now, and if not, why not."""
+        if not failed:
+            self.results.append(False)
+            if self.tripped and now >= self.open_until:
+                # the first probe after the cool-down succeeded
+                self.tripped = False
+                self.backoff = self.cooldown
+            return False, None
+
+        if self.tripped:
+            if now < self.open_until:
+                return False, ('restarted %d seconds ago, cooling down '
+                               'for %d more seconds' % (
+                               now - (self.open_until - self.backoff),
+                               self.open_until - now))
+            # the first probe after the cool-down failed too, so the
+            # restart didn't help: wait longer after the next one
+            self.backoff = min(self.backoff * 2,
+                               self.cooldown * MAX_BACKOFF)
+            self.open_until = now + self.backoff
+            self.results.clear()
+            return True, None
+
+        self.results.append(True)
+        failed = sum(self.results)
+        if failed < self.failures:
+            return False, '%d of the last %d checks failed, %d needed' % (
+                failed, len(self.results), self.failures)
+        self.results.clear()
+        if self.cooldown:
+            self.tripped = True
+            self.backoff = self.cooldown
+            self.open_until = now + self.backoff
+        return True, None
+
 class HTTPOk:
     connclass = None
     def __init__(self, rpc, programs, any, url, timeout, statuses, inbody,
-                 email, sendmail, coredir, gcore, eager, retry_time, name):
+                 email, sendmail, coredir, gcore, eager, retry_time, name,
+                 checks=(), concurrency=0, method='GET', max_body=MAX_BODY,
+                 failures=1, window=0, cooldown=0, p95=None, p99=None,
+                 latency_window=LATENCY_WINDOW, port_base=None,
+                 gcore_concurrency=4, gcore_timeout=120, coredir_max=None):
         self.rpc = rpc
         self.programs = programs
         self.any = any
@@ -134,35 +490,36 @@ class HTTPOk:
         self.sendmail = sendmail
         self.coredir = coredir
         self.gcore = gcore
+        self.dumper = None
+        if coredir and gcore:
+            self.dumper = CoreDumper(gcore, coredir, gcore_concurrency,
+                                     gcore_timeout, coredir_max)
         self.eager = eager
         self.stdin = sys.stdin
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         self.name = name
+        self.checks = []
+        if url is not None:
+            self.checks.append(Check(url, programs, any, timeout, statuses,
+                                     inbody, eager, method, max_body,
+                                     failures, window, cooldown, p95, p99,
+                                     latency_window, port_base))
+        self.checks.extend(checks)
+        self.concurrency = concurrency
+        self.pools = {} # scheme -> ConnectionPool
+        self.clock = time.time
+        self.sleep = time.sleep
+        self.round = None # the thread checking the URLs of the last tick
 
     def listProcesses(self, state=None):
-        return [x for x in self.rpc.supervisor.getAllProcessInfo()
-                   if x['name'] in self.programs and
-                      (state is None or x['state'] == state)]
+        return self.checks[0].listProcesses(
+            self.rpc.supervisor.getAllProcessInfo(), state)
 
     def runforever(self, test=False):
-        parsed = urlparse.urlsplit(self.url)
-        scheme = parsed.scheme.lower()
-        hostport = parsed.netloc
-        path = parsed.path
-        query = parsed.query
-
-        if query:
-            path += '?' + query
-
-        if self.connclass:
-            ConnClass = self.connclass
-        elif scheme == 'http':
-            ConnClass = timeoutconn.TimeoutHTTPConnection
-        elif scheme == 'https':
-            ConnClass = timeoutconn.TimeoutHTTPSConnection
-        else:
-            raise ValueError('Bad scheme %s' % scheme)
+        # connections are kept open between ticks
+        for check in self.checks:
+            self.pool_for(check.scheme)
 
         while 1:
             # we explicitly use self.stdin, self.stdout, and self.stderr
@@ -176,63 +533,165 @@ class HTTPOk:
                     break
                 continue
 
-            conn = ConnClass(hostport)
-            conn.timeout = self.timeout
-
-            specs = self.listProcesses(ProcessStates.RUNNING)
-            if self.eager or len(specs) > 0:
-
-                try:
-                    # build a loop value that is guaranteed to execute at least
-                    # once and at most until the timeout is reached and that
-                    # has 0 as the last value (to allow raising an exception
-                    # in the last iteration)
-                    for will_retry in range(
-                            (self.timeout - 1) // (self.retry_time or 1),
-                            -1, -1):
-                        try:
-                            headers = {'User-Agent': 'httpok'}
-                            conn.request('GET', path, headers=headers)
-                            break
-                        except socket.error as e:
-                            if e.errno == 111 and will_retry:
-                                time.sleep(self.retry_time)
-                            else:
-                                raise
-
-                    res = conn.getresponse()
-                    body = res.read()
-                    status = res.status
-                    msg = 'status contacting %s: %s %s' % (self.url,
-                                                           res.status,
-                                                           res.reason)
-                except Exception as e:
-                    body = ''
-                    status = None
-                    msg = 'error contacting %s:\n\n %s' % (self.url, e)
-
-                if status not in self.statuses:
-                    subject = self.format_subject(
-                        '%s: bad status returned' % self.url
-                        )
-                    self.act(subject, msg)
-                elif self.inbody and self.inbody not in body:
-                    subject = self.format_subject(
-                        '%s: bad body returned' % self.url
-                    )
-                    self.act(subject, msg)
+            # the URLs are checked in a thread, so that the TICK is
+            # acknowledged at once and the listener doesn't keep
+            # supervisord waiting while requests time out or are retried
+            if self.round is not None and self.round.is_alive():
+                self.stderr.write('Still checking the URLs from the '
+                                  'previous tick, skipping this one\n')
+                self.stderr.flush()
+            else:
+                self.round = threading.Thread(target=self.check_all)
+                self.round.daemon = True
+                self.round.start()
 
             childutils.listener.ok(self.stdout)
             if test:
+                self.round.join()
                 break
 
+    def check_all(self):
+        """Check the URLs and act on those which failed."""
+        try:
+            specs = self.rpc.supervisor.getAllProcessInfo()
+        except Exception as e:
+            self.stderr.write('Exception retrieving process info %s, '
+                              'not checking\n' % e)
+            self.stderr.flush()
+            return
+
+        checks = []
+        for check in self.checks:
+            if check.per_process:
+                checks.extend(check.expand(specs))
+            elif check.eager or check.listProcesses(
+                    specs, ProcessStates.RUNNING):
+                checks.append(check)
+
+        results = self.probe_all(checks)
+        now = time.time()
+        for check, failure in zip(checks, results):
+            act, reason = check.record(failure is not None, now)
+            if act:
+                subject, msg = failure
+                self.act(subject, msg, check)
+                # latencies from before the restart no longer apply
+                check.latency.clear()
+            elif reason:
+                self.stderr.write('%s failed, not restarting: %s\n' % (
+                    check.url, reason))
+                self.stderr.flush()
+
+    def pool_for(self, scheme):
+        pool = self.pools.get(scheme)
+        if pool is None:
+            if self.connclass:
+                ConnClass = self.connclass
+            elif scheme == 'http':
+                ConnClass = timeoutconn.TimeoutHTTPConnection
+            elif scheme == 'https':
+                ConnClass = timeoutconn.TimeoutHTTPSConnection
+            else:
+                raise ValueError('Bad scheme %s' % scheme)
+            pool = self.pools[scheme] = timeoutconn.ConnectionPool(
+                ConnClass, self.timeout)
+        return pool
+
+    def probe_all(self, checks):
+        """Probe checks concurrently, at most self.concurrency at a time
+        (all of them if it is 0), and return their results in the same
+        order."""
+        return run_all(self.probe, checks, self.concurrency or len(checks))
+
+    def probe(self, check):
+        """Request the URL of a check.  Returns None if the response was as
+        expected, otherwise the (subject, message) to act on."""
+        pool = self.pools[check.scheme]
+        try:
+            # a refused connection (e.g. while the server restarts) is
+            # retried until the timeout, waiting twice as long each time
+            # and jittered so that many URLs aren't retried in lockstep
+            deadline = self.clock() + check.timeout
+            delay = max(self.retry_time, MIN_RETRY_DELAY)
+            while 1:
+                started = self.clock()
+                try:
+                    headers = {'User-Agent': 'httpok'}
+                    conn, res = pool.request(check.hostport, check.method,
+                                             check.path, headers,
+                                             check.timeout)
+                    break
+                except socket.error as e:
+                    remaining = deadline - self.clock()
+                    if e.errno != errno.ECONNREFUSED or remaining <= 0:
+                        raise
+                    self.sleep(min(delay * random.uniform(0.5, 1),
+                                   remaining))
+                    delay *= 2
+
+            try:
+                found, complete = search_body(res, check.search,
+                                              check.max_body)
+            except Exception:
+                conn.close()
+                raise
+            if complete:
+                pool.release(check.hostport, conn, res)
+            else:
+                # the rest of the body was not read
+                conn.close()
+            status = res.status
+            msg = 'status contacting %s: %s %s' % (check.url,
+                                                   res.status,
+                                                   res.reason)
+            if check.search and not found and not complete:
+                msg += ' (%r not found in the first %d bytes of the body)' % (
+                    check.inbody, check.max_body)
+            # only responses count towards the latency; errors and
+            # timeouts fail the check anyway
+            check.latency.add(self.clock() - started)
+        except Exception as e:
+            found = False
+            status = None
+            msg = 'error contacting %s:\n\n %s' % (check.url, e)
+
+        if status not in check.statuses:
+            subject = self.format_subject(
+                '%s: bad status returned' % check.url
+                )
+        elif check.search and not found:
+            subject = self.format_subject(
+                '%s: bad body returned' % check.url
+            )
+        elif check.slos and check.latency.full():
+            slow = []
+            for name, q, limit in check.slos:
+                latency = check.latency.quantile(q)
+                if latency > limit:
+                    slow.append('%s %.3fs is over %.3fs' % (name, latency,
+                                                             limit))
+            if not slow:
+                return None
+            subject = self.format_subject(
+                '%s: slow responses' % check.url
+            )
+            msg = 'latency of %s: %s' % (check.url, ', '.join(slow))
+        else:
+            return None
+        if len(check.latency):
+            msg += '\n\nresponse times of %s: %s' % (
+                check.url, check.latency.summary())
+        return subject, msg
+
     def format_subject(self, subject):
         if self.name is None:
             return 'httpok: %s' % subject
         else:
             return 'httpok [%s]: %s' % (self.name, subject)
 
-    def act(self, subject, msg):
+    def act(self, subject, msg, check=None):
+        if check is None:
+            check = self.checks[0]
         messages = [msg]
 
         def write(msg):
@@ -246,32 +705,53 @@ class HTTPOk:
             write('Exception retrieving process info %s, not acting' % e)
             return
 
-        waiting = list(self.programs)
+        waiting = list(check.programs)
+        selected = []
 
-        if self.any:
+        if check.any:
             write('Restarting all running processes')
             for spec in specs:
                 name = spec['name']
                 group = spec['group']
-                self.restart(spec, write)
+                selected.append(spec)
                 namespec = make_namespec(group, name)
                 if name in waiting:
                     waiting.remove(name)
                 if namespec in waiting:
                     waiting.remove(namespec)
         else:
-            write('Restarting selected processes %s' % self.programs)
+            write('Restarting selected processes %s' % check.programs)
             for spec in specs:
                 name = spec['name']
                 group = spec['group']
                 namespec = make_namespec(group, name)
-                if (name in self.programs) or (namespec in self.programs):
-                    self.restart(spec, write)
+                if (name in check.programs) or (namespec in check.programs):
+                    selected.append(spec)
                     if name in waiting:
                         waiting.remove(name)
                     if namespec in waiting:
                         waiting.remove(namespec)
 
+        # cores of all the hung processes are written at the same time,
+        # before any is restarted, and compressed once they all have been
+        dumps = {}
+        if self.dumper is not None:
+            running = [spec for spec in selected
+                       if spec['state'] is ProcessStates.RUNNING]
+            for spec, dump in zip(running, self.dumper.dump_all(running)):
+                dumps[make_namespec(spec['group'], spec['name'])] = dump
+        for spec in selected:
+            namespec = make_namespec(spec['group'], spec['name'])
+            if namespec in dumps:
+                write('gcore output for %s:\n\n %s' % (
+                    namespec, dumps[namespec][0]))
+            self.restart(spec, write)
+        if dumps:
+            paths = []
+            for output, dumped in dumps.values():
+                paths.extend(dumped)
+            self.dumper.store(paths, write)
+
         if waiting:
             write(
                 'Programs not restarted because they did not exist: %s' %
@@ -294,12 +774,6 @@ class HTTPOk:
     def restart(self, spec, write):
         namespec = make_namespec(spec['group'], spec['name'])
         if spec['state'] is ProcessStates.RUNNING:
-            if self.coredir and self.gcore:
-                corename = os.path.join(self.coredir, namespec)
-                cmd = self.gcore + ' "%s" %s' % (corename, spec['pid'])
-                with os.popen(cmd) as m:
-                    write('gcore output for %s:\n\n %s' % (
-                        namespec, m.read()))
             write('%s is in RUNNING state, restarting' % namespec)
             try:
                 self.rpc.supervisor.stopProcess(namespec)
@@ -319,8 +793,72 @@ class HTTPOk:
             write('%s not in RUNNING state, NOT restarting' % namespec)
 
 
+def validate_method(method, inbody):
+    if method not in ('GET', 'HEAD'):
+        raise ValueError('unsupported method %s (expected GET or HEAD)' %
+                         method)
+    if method == 'HEAD' and inbody:
+        raise ValueError('a body to look for (-b) needs the GET method')
+
+def read_checks(path, defaults):
+    """Return a Check for each [check:name] section of the config file at
+    path.  Options a section doesn't set are taken from defaults, a dict
+    of Check arguments (from the command line)."""
+    parser = configparser.RawConfigParser()
+    if not parser.read([path]):
+        raise ValueError('could not read %s' % path)
+    checks = []
+    for section in parser.sections():
+        if not section.startswith('check:'):
+            continue
+        def get(option, get=parser.get):
+            if parser.has_option(section, option):
+                return get(section, option)
+            return None
+        url = get('url')
+        if not url:
+            raise ValueError('section [%s] of %s has no url' % (section,
+                                                                 path))
+        options = dict(defaults)
+        options['programs'] = list(options.get('programs') or [])
+        values = {
+            'programs': get('programs'),
+            'any': get('any', parser.getboolean),
+            'timeout': get('timeout', parser.getint),
+            'statuses': get('codes'),
+            'inbody': get('body'),
+            'eager': get('eager', parser.getboolean),
+            'method': get('method'),
+            'max_body': get('max_body'),
+            'failures': get('failures', parser.getint),
+            'window': get('window', parser.getint),
+            'cooldown': get('cooldown', parser.getint),
+            'p95': get('p95', parser.getfloat),
+            'p99': get('p99', parser.getfloat),
+            'latency_window': get('latency_window', parser.getint),
+            'port_base': get('port_base', parser.getint),
+            }
+        if values['programs'] is not None:
+            values['programs'] = values['programs'].replace(',', ' ').split()
+        if values['statuses'] is not None:
+            values['statuses'] = [int(code) for code in
+                                  values['statuses'].replace(',', ' ').split()]
+        if values['method'] is not None:
+            values['method'] = values['method'].upper()
+        if values['max_body'] is not None:
+            values['max_body'] = byte_size(values['max_body'])
+        for option, value in values.items():
+            if value is not None:
+                options[option] = value
+        checks.append(Check(url, **options))
+    for check in checks:
+        validate_method(check.method, check.inbody)
+    if not checks:
+        raise ValueError('%s has no [check:name] sections' % path)
+    return checks
+
 def main(argv=sys.argv):
-    short_args="hp:at:c:b:s:m:g:d:eEn:"
+    short_args="hp:at:c:b:s:m:g:d:eEn:f:"
     long_args=[
         "help",
         "program=",
@@ -335,6 +873,20 @@ def main(argv=sys.argv):
         "eager",
         "not-eager",
         "name=",
+        "config=",
+        "concurrency=",
+        "method=",
+        "max-body=",
+        "failures=",
+        "window=",
+        "cooldown=",
+        "p95=",
+        "p99=",
+        "latency-window=",
+        "port-base=",
+        "gcore-concurrency=",
+        "gcore-timeout=",
+        "coredir-max=",
         ]
     arguments = argv[1:]
     try:
@@ -347,7 +899,13 @@ def main(argv=sys.argv):
         if option in ('-h', '--help'):
             usage(exitstatus=0)
 
-    if not args:
+    config = None
+    for option, value in opts:
+        if option in ('-f', '--config'):
+            config = value
+
+    # a URL is required unless there is a config file of URLs
+    if not args and config is None:
         usage()
     if len(args) > 1:
         usage()
@@ -360,10 +918,23 @@ def main(argv=sys.argv):
     eager = True
     email = None
     timeout = 10
-    retry_time = 10
+    retry_time = 1 # doubled on each retry
     statuses = []
     inbody = None
     name = None
+    concurrency = 0
+    method = 'GET'
+    max_body = MAX_BODY
+    failures = 1
+    window = 0
+    cooldown = 0
+    p95 = None
+    p99 = None
+    latency_window = LATENCY_WINDOW
+    port_base = None
+    gcore_concurrency = 4
+    gcore_timeout = 120
+    coredir_max = None
 
     for option, value in opts:
 
@@ -403,10 +974,68 @@ def main(argv=sys.argv):
         if option in ('-n', '--name'):
             name = value
 
+        if option == '--concurrency':
+            concurrency = max(int(value), 0)
+
+        if option == '--method':
+            method = value.upper()
+
+        if option == '--max-body':
+            max_body = byte_size(value)
+
+        if option == '--failures':
+            failures = max(int(value), 1)
+
+        if option == '--window':
+            window = int(value)
+
+        if option == '--cooldown':
+            cooldown = int(value)
+
+        if option == '--p95':
+            p95 = float(value)
+
+        if option == '--p99':
+            p99 = float(value)
+
+        if option == '--latency-window':
+            latency_window = max(int(value), 1)
+
+        if option == '--port-base':
+            port_base = int(value)
+
+        if option == '--gcore-concurrency':
+            gcore_concurrency = max(int(value), 1)
+
+        if option == '--gcore-timeout':
+            gcore_timeout = int(value)
+
+        if option == '--coredir-max':
+            coredir_max = byte_size(value)
+
     if not statuses:
         statuses = [200]
 
-    url = arguments[-1]
+    url = None
+    if args:
+        url = args[0]
+
+    checks = []
+    try:
+        validate_method(method, inbody)
+        if url is not None:
+            validate_url(url, port_base)
+        if config is not None:
+            checks = read_checks(config, dict(
+                programs=programs, any=any, timeout=timeout,
+                statuses=statuses, inbody=inbody, eager=eager, method=method,
+                max_body=max_body, failures=failures, window=window,
+                cooldown=cooldown, p95=p95, p99=p99,
+                latency_window=latency_window, port_base=port_base))
+    except (configparser.Error, ValueError) as e:
+        sys.stderr.write('httpok: %s\n' % e)
+        sys.stderr.flush()
+        usage()
 
     try:
         rpc = childutils.getRPCInterface(os.environ)
@@ -419,7 +1048,13 @@ def main(argv=sys.argv):
         return
 
     prog = HTTPOk(rpc, programs, any, url, timeout, statuses, inbody, email,
-                  sendmail, coredir, gcore, eager, retry_time, name)
+                  sendmail, coredir, gcore, eager, retry_time, name,
+                  checks=checks, concurrency=concurrency, method=method,
+                  max_body=max_body, failures=failures, window=window,
+                  cooldown=cooldown, p95=p95, p99=p99,
+                  latency_window=latency_window, port_base=port_base,
+                  gcore_concurrency=gcore_concurrency,
+                  gcore_timeout=gcore_timeout, coredir_max=coredir_max)
     prog.runforever()
 
 if __name__ == '__main__':
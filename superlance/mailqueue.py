@@ -0,0 +1,98 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Sends mail through a sendmail command from a background thread, so that
+# an event listener never waits on (or hangs in) mail delivery.
+
+import sys
+import threading
+import time
+
+from superlance.compat import queue
+from superlance.tasks import run_command
+
+class MailQueue:
+    """Queues messages (headers and body, as accepted by "sendmail -t") and
+    pipes them to the sendmail command from a worker thread.  A delivery
+    that takes longer than `timeout` seconds is killed, and a failed
+    delivery is tried again up to `retries` more times, waiting
+    `retry_delay` seconds longer before each attempt."""
+
+    def __init__(self, sendmail, timeout=30, retries=2, retry_delay=10,
+                 stderr=None):
+        self.sendmail = sendmail
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.stderr = stderr or sys.stderr
+        self.queue = queue.Queue()
+        self.worker = None
+        self.lock = threading.Lock()
+
+    def put(self, message):
+        with self.lock:
+            if self.worker is None:
+                self.worker = threading.Thread(target=self.work)
+                self.worker.daemon = True
+                self.worker.start()
+        self.queue.put(message)
+
+    def flush(self, timeout=None):
+        """Wait until every queued message has been delivered or given up
+        on.  Returns False if that didn't happen within timeout seconds."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        # Queue.join() can't time out, so poll
+        while self.queue.unfinished_tasks:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def work(self):
+        while 1:
+            message = self.queue.get()
+            try:
+                for attempt in range(self.retries + 1):
+                    if attempt:
+                        time.sleep(self.retry_delay * attempt)
+                    error = self.deliver(message)
+                    if error is None:
+                        break
+                    self.stderr.write(
+                        'Failed to send mail (attempt %d of %d): %s\n' % (
+                        attempt + 1, self.retries + 1, error))
+                    self.stderr.flush()
+            finally:
+                self.queue.task_done()
+
+    def deliver(self, message):
+        """Pipe message to sendmail.  Returns None on success or a string
+        describing the failure."""
+        if not isinstance(message, bytes):
+            message = message.encode('utf-8')
+        try:
+            status, output, expired = run_command(self.sendmail,
+                                                  self.timeout, message)
+        except (IOError, OSError) as e:
+            return str(e)
+        if expired:
+            return 'timed out after %s seconds' % self.timeout
+        if status:
+            error = '%r exited with status %s' % (self.sendmail, status)
+            if output.strip():
+                error += ': %s' % output.strip()
+            return error
+        return None
@@ -15,7 +15,8 @@
 
 # A event listener meant to be subscribed to TICK_60 (or TICK_5)
 # events, which restarts any processes that are children of
-# supervisord that consume "too much" memory.  Performs horrendous
+# supervisord that consume "too much" memory.  On Linux, memory usage
+# is read directly from /proc; elsewhere it performs horrendous
 # screenscrapes of ps output.  Works on Linux and OS X (Tiger/Leopard)
 # as far as I know.
 
@@ -29,7 +30,16 @@
 doc = """\
 memmon.py [-c] [-p processname=byte_size] [-g groupname=byte_size]
           [-a byte_size] [-s sendmail] [-m email_address]
-          [-u uptime] [-n memmon_name]
+          [-u uptime] [-n memmon_name] [--metric rss|pss|uss|swap|cgroup]
+          [--restart-concurrency N] [--min-running N] [-v]
+          [--horizon seconds] [--window samples]
+          [--sustain N] [--low-watermark percent]
+          [--store file] [--store-max-size byte_size] [--store-keep N]
+          [--textfile file] [--mail-timeout seconds] [--mail-retries N]
+          [--timing] [--profile file] [--profile-every N]
+          [--pressure] [--psi-threshold percent] [--min-available percent]
+          [--grace percent] [--instance name=serverurl]
+          [--reconcile-every N]
 
 Options:
 
@@ -42,8 +52,14 @@ Options:
       RSS.  If this process is in a group, it can be specified using
       the 'group_name:process_name' syntax.
 
+      process_name may also be a glob pattern (e.g. 'web_*') or a
+      regular expression between slashes (e.g. '/web_[0-9]+/'), which
+      is matched against both the process name and the
+      'group_name:process_name' namespec.
+
 -g -- specify a group_name=byte_size pair.  Restart any process in this group
-      when it uses more than byte_size RSS.
+      when it uses more than byte_size RSS.  group_name may also be a
+      glob pattern or a regular expression between slashes.
 
 -a -- specify a global byte_size.  Restart any child of the supervisord
       under which this runs if it uses more than byte_size RSS.
@@ -57,6 +73,13 @@ Options:
       address when any process is restarted.  If no email address is
       specified, email will not be sent.
 
+--mail-timeout -- mail is sent in the background, so that a slow or hung
+      sendmail never delays memmon.  Kill the sendmail command if it has
+      not finished after this many seconds.  Default is 30.
+
+--mail-retries -- the number of times to try again when sending mail
+      fails or times out.  Default is 2.
+
 -u -- optionally specify the minimum uptime in seconds for the process.
       if the process uptime is longer than this value, no email is sent
       (useful to only be notified if processes are restarted too often/early)
@@ -68,6 +91,111 @@ Options:
       be used in the email subject to identify which memmon process
       restarted the process.
 
+--metric -- the memory metric compared against the byte_size limits.
+      One of 'rss' (resident set size, the default), 'pss' (proportional
+      set size: shared pages are divided between the processes sharing
+      them), 'uss' (unique set size: private pages only) or 'swap'.
+      Metrics other than 'rss' are read from /proc/<pid>/smaps_rollup
+      and are only available on Linux.
+
+      'cgroup' checks the memory of the cgroup (v2) that the process
+      runs in, as reported by memory.current less the inactive file
+      cache from memory.stat.  The cgroup already includes any child
+      processes, so this is a constant-time alternative to -c.
+
+--horizon -- also restart a process before it reaches its limit, when
+      its memory usage is growing fast enough to reach the limit within
+      this many seconds.  The growth rate is fitted over the last
+      --window samples of the process.  Accepts the same suffixes as -u.
+
+--window -- the number of samples (one per tick) the growth rate used
+      by --horizon is fitted over.  Default is 10.
+
+--sustain -- only restart a process once it has been over its limit for
+      this many samples (ticks) in a row.  Default is 1, restart at once.
+
+--low-watermark -- a percentage of the limit.  With --sustain, a process
+      must drop below this share of its limit before its count of samples
+      over the limit starts again from zero; samples between this mark
+      and the limit don't break the run.  Default is 100.
+
+--store -- append every sample memmon takes (time, pid, program and
+      memory usage) to this file, for later analysis with memmon-report.
+
+--store-max-size -- rotate the --store file when it would grow beyond
+      this size.  Default is 64MB.
+
+--store-keep -- the number of rotated --store files to keep.  Default 4.
+
+--textfile -- write the memory usage and limit of each monitored process,
+      restart counts and the time spent measuring to this file on every
+      tick, in the Prometheus text format.  Point it at the directory of
+      node_exporter's textfile collector; the name must end in '.prom'.
+
+-v -- log the memory usage of every checked process on each tick.  By
+      default it is only logged for processes which are restarted.
+
+--timing -- log how long each tick took, split into the time spent in
+      the getAllProcessInfo call ('rpc'), measuring memory ('measure'),
+      deciding on and making restarts ('restart') and writing --store and
+      --textfile output ('output').  Whether or not this is given, memmon
+      warns when a tick takes longer than the TICK_<n> interval it is
+      subscribed to.
+
+--profile -- run every --profile-every'th tick under cProfile and write
+      the statistics to this file (overwriting it), for reading with
+      'python -m pstats file'.
+
+--profile-every -- how often to profile a tick with --profile.
+      Default is 100.
+
+--pressure -- take the state of the host into account when restarting.
+      Processes over their limit are restarted in order of how far over
+      it they are (as a share of the limit), worst first.  While the host
+      is under memory pressure they are all restarted, until the pressure
+      clears.  Otherwise, processes less than --grace percent over their
+      limit are left running.  Linux only.
+
+--psi-threshold -- with --pressure, the host is under pressure when the
+      'some avg10' value of /proc/pressure/memory is at least this
+      percentage.  Default is 10.
+
+--min-available -- with --pressure, the host is also under pressure when
+      MemAvailable in /proc/meminfo is below this percentage of MemTotal.
+      Default is 10.
+
+--grace -- with --pressure, how far over its limit (in percent) a
+      process may be before it is restarted while the host is not under
+      memory pressure.  Default is 10.
+
+--instance -- also monitor the processes of another supervisord, given
+      a name for it and its server URL as in supervisorctl's serverurl
+      (e.g. 'tenant1=unix:///var/run/tenant1.sock').  The same username
+      and password are used.  May be specified more than once.  Every
+      supervisord is queried concurrently on each tick and their
+      processes are checked against one shared process table.
+
+      -p and -g names without an instance prefix apply to the processes
+      of every supervisord.  Prefix them with 'name@' to apply them only
+      to one instance (e.g. -p 'tenant1@web_*=200MB').  Processes of an
+      instance are logged as 'name@group_name:process_name'.
+
+--reconcile-every -- keep track of this supervisord's processes from the
+      PROCESS_STATE events memmon receives, and only call
+      getAllProcessInfo every N ticks to catch up with anything the
+      events missed.  Requires subscribing memmon to PROCESS_STATE (and
+      preferably PROCESS_GROUP) events as well as TICK events.  The
+      default (0) calls getAllProcessInfo on every tick.  Other
+      --instance supervisords are still queried on every tick.
+
+--restart-concurrency -- restart over-limit processes in the background,
+      at most N at a time, instead of one after the other before
+      answering supervisord.  The default (0) restarts synchronously.
+
+--min-running -- never restart a process if that would leave fewer than
+      N processes of its group in the RUNNING state.  Restarts which
+      would are skipped and retried on a later tick.
+
 The -p and -g options may be specified more than once, allowing for
 specification of multiple groups and processes.
 
@@ -80,16 +208,26 @@ A sample invocation:
 memmon.py -p program1=200MB -p theprog:thegroup=100MB -g thegroup=100MB -a 1GB -s "/usr/sbin/sendmail -t -i" -m chrism@plope.com -n "Project 1"
 """
 
+import cProfile
+import fnmatch
 import getopt
 import os
+import re
 import sys
+import threading
 import time
-from collections import namedtuple
+from array import array
+from collections import OrderedDict, deque
 from superlance.compat import maxint
 from superlance.compat import xmlrpclib
 
 from supervisor import childutils
 from supervisor.datatypes import byte_size, SuffixMultiplier
+from supervisor.states import ProcessStates
+
+from superlance.mailqueue import MailQueue
+from superlance.samplestore import SampleStore
+from superlance.textfile import TextfileExporter
 
 def usage(exitstatus=255):
     print(doc)
@@ -99,8 +237,481 @@ def shell(cmd):
     with os.popen(cmd) as f:
         return f.read()
 
+def read_file(path):
+    with open(path) as f:
+        return f.read()
+
+def find_procdir(path='/proc'):
+    # only use procfs if it looks like the Linux flavor (it has statm files)
+    if os.path.exists(os.path.join(path, 'self', 'statm')):
+        return path
+    return None
+
+try:
+    PAGESIZE = os.sysconf('SC_PAGE_SIZE')
+except (AttributeError, ValueError, OSError): # pragma: no cover
+    PAGESIZE = 4096
+
+class ProcessTable:
+    """A snapshot of the process table, indexed by parent pid."""
+    def __init__(self, procs):
+        self.rss = {}
+        self.children = {}
+        for pid, ppid, rss in procs:
+            if pid in self.rss:
+                continue
+            self.rss[pid] = rss
+            self.children.setdefault(ppid, []).append(pid)
+        self.totals = {}
+
+    def cumulative_rss(self, pid):
+        """Return the RSS of pid and all of its descendants, or None if pid
+        is not in the table.  Subtree sums are memoized, so computing this
+        for every process in the table is a single linear pass."""
+        if pid not in self.rss:
+            return None
+        # iterative post-order walk; deep trees must not hit the
+        # recursion limit
+        stack = [(pid, False)]
+        seen = set([pid])
+        while stack:
+            current, expanded = stack.pop()
+            if current in self.totals:
+                continue
+            children = self.children.get(current, ())
+            if expanded:
+                total = self.rss[current]
+                for child in children:
+                    total += self.totals.get(child, 0)
+                self.totals[current] = total
+            else:
+                stack.append((current, True))
+                for child in children:
+                    if child not in seen:
+                        seen.add(child)
+                        stack.append((child, False))
+        return self.totals[pid]
+
+    def subtree(self, pid):
+        """Return a list of pid and all of its descendants, or None if pid
+        is not in the table."""
+        if pid not in self.rss:
+            return None
+        pids = [pid]
+        seen = set(pids)
+        for current in pids:
+            for child in self.children.get(current, ()):
+                if child not in seen:
+                    seen.add(child)
+                    pids.append(child)
+        return pids
+
+SMAPS_METRICS = {
+    'pss': ('Pss',),
+    'uss': ('Private_Clean', 'Private_Dirty'),
+    'swap': ('Swap',),
+    }
+
+METRICS = ('rss',) + tuple(sorted(SMAPS_METRICS)) + ('cgroup',)
+
+def parse_smaps(data):
+    # smaps and smaps_rollup lines look like "Pss:     1234 kB"; the
+    # mapping header lines are skipped.  Values are summed so that the
+    # per-mapping smaps format can be used as a fallback for smaps_rollup.
+    fields = {}
+    for line in data.splitlines():
+        parts = line.split()
+        if len(parts) == 3 and parts[2] == 'kB' and parts[0].endswith(':'):
+            key = parts[0][:-1]
+            fields[key] = fields.get(key, 0) + int(parts[1]) * 1024
+    return fields
+
+def find_cgroupdir(path='/sys/fs/cgroup'):
+    # only the unified (v2) hierarchy is supported
+    if os.path.exists(os.path.join(path, 'cgroup.controllers')):
+        return path
+    return None
+
+def parse_psi(data):
+    """Parse /proc/pressure/memory into {'some': {'avg10': 1.5, ...},
+    'full': {...}}."""
+    psi = {}
+    for line in data.splitlines():
+        parts = line.split()
+        if not parts:
+            continue
+        values = {}
+        for part in parts[1:]:
+            key, _, value = part.partition('=')
+            values[key] = float(value)
+        psi[parts[0]] = values
+    return psi
+
+def compile_pattern(pattern):
+    """Return a match function for a -p or -g name: a regular expression
+    between slashes, a glob pattern, or None for a plain name."""
+    if len(pattern) > 2 and pattern.startswith('/') and pattern.endswith('/'):
+        regex = re.compile('(?:%s)\\Z' % pattern[1:-1])
+        return regex.match
+    if any(c in pattern for c in '*?['):
+        regex = re.compile(fnmatch.translate(pattern))
+        return regex.match
+    return None
+
+def split_instance(pattern):
+    """Split an 'instance@name' -p or -g name into (instance, name).  The
+    instance is None if the name applies to every supervisord."""
+    instance, sep, name = pattern.partition('@')
+    if sep and instance and not pattern.startswith('/'):
+        return instance, name
+    return None, pattern
+
+class Thresholds:
+    """The -p, -g and -a limits, compiled into a lookup of the limit that
+    applies to a process by its (group, name) and supervisord instance.
+    When more than one limit applies, the lowest one is used."""
+
+    def __init__(self, programs, groups, any):
+        self.programs, self.program_patterns = self.compile(programs)
+        self.groups, self.group_patterns = self.compile(groups)
+        self.any = any
+        self.resolved = {}
+
+        status = []
+        if programs:
+            status.append('Checking programs %s' % ', '.join(
+                ['%s=%s' % (k, programs[k]) for k in sorted(programs)]))
+        if groups:
+            status.append('Checking groups %s' % ', '.join(
+                ['%s=%s' % (k, groups[k]) for k in sorted(groups)]))
+        if any is not None:
+            status.append('Checking any=%s' % any)
+        self.status = '\n'.join(status) + '\n'
+
+    def compile(self, limits):
+        """Return a dict of (instance, name) to limit for plain names and
+        a list of (instance, match, limit) for patterns."""
+        names = {}
+        patterns = []
+        for key, limit in sorted(limits.items()):
+            instance, pattern = split_instance(key)
+            match = compile_pattern(pattern)
+            if match is None:
+                names[(instance, pattern)] = limit
+            else:
+                patterns.append((instance, match, limit))
+        return names, patterns
+
+    def lookup(self, group, name, instance=None):
+        """Return the limit for a process, or None if it isn't monitored."""
+        key = (instance, group, name)
+        try:
+            return self.resolved[key]
+        except KeyError:
+            limit = self.resolved[key] = self.resolve(group, name, instance)
+            return limit
+
+    def resolve(self, group, name, instance=None):
+        namespec = '%s:%s' % (group, name)
+        instances = (None, instance) if instance is not None else (None,)
+        limits = []
+        for i in instances:
+            for n in name, namespec:
+                if (i, n) in self.programs:
+                    limits.append(self.programs[(i, n)])
+            if (i, group) in self.groups:
+                limits.append(self.groups[(i, group)])
+        for i, match, limit in self.program_patterns:
+            if i in instances and (match(name) or match(namespec)):
+                limits.append(limit)
+        for i, match, limit in self.group_patterns:
+            if i in instances and match(group):
+                limits.append(limit)
+        if self.any is not None:
+            limits.append(self.any)
+        if not limits:
+            return None
+        return min(limits)
+
+class ProcessSnapshot:
+    """A process as reported by getAllProcessInfo on this tick.  Passed
+    along the check and restart path so that restarting a process needs
+    no further getProcessInfo call.
+
+    Processes of an extra supervisord (--instance) have their instance
+    name prefixed to `namespec` and `groupspec` ('tenant1@group:name'),
+    which are used to tell processes apart in memmon; `rpcname` is the
+    plain 'group:name' supervisord knows them by."""
+    __slots__ = ('instance', 'group', 'name', 'namespec', 'groupspec',
+                 'rpcname', 'pid', 'state', 'start', 'now')
+
+    def __init__(self, info, instance=None):
+        self.instance = instance
+        self.group = info['group']
+        self.name = info['name']
+        self.rpcname = '%s:%s' % (self.group, self.name)
+        if instance is None:
+            self.namespec = self.rpcname
+            self.groupspec = self.group
+        else:
+            self.namespec = '%s@%s' % (instance, self.rpcname)
+            self.groupspec = '%s@%s' % (instance, self.group)
+        self.pid = info['pid']
+        self.state = info['state']
+        self.start = info['start']
+        self.now = info['now']
+
+    @property
+    def uptime(self):
+        return self.now - self.start
+
+def snapshot(infos, instance=None):
+    return [ProcessSnapshot(info, instance) for info in infos]
+
+# phases of a tick timed by --timing, in the order they are logged
+PHASES = ('rpc', 'measure', 'restart', 'output')
+
+def tick_interval(eventname):
+    """Return the period in seconds of a TICK_<n> event name, or None."""
+    try:
+        return int(eventname.split('_', 1)[1])
+    except (IndexError, ValueError):
+        return None
+
+class ProcessCache:
+    """The processes of the supervisord memmon runs under, kept up to date
+    from PROCESS_STATE events so that getAllProcessInfo only has to be
+    called every `reconcile_every` ticks (--reconcile-every).  Events for
+    a process it doesn't know, and PROCESS_GROUP events, make it call
+    getAllProcessInfo again on the next tick."""
+
+    def __init__(self, reconcile_every):
+        self.reconcile_every = reconcile_every
+        self.infos = None # rpcname -> getAllProcessInfo dict
+        self.age = 0 # ticks since the last getAllProcessInfo
+
+    def due(self):
+        return self.infos is None or self.age >= self.reconcile_every
+
+    def reconcile(self, infos):
+        self.infos = OrderedDict()
+        for info in infos:
+            info = dict(info)
+            self.infos['%s:%s' % (info['group'], info['name'])] = info
+        self.age = 0
+
+    def update(self, eventname, payload, now):
+        if self.infos is None:
+            return
+        if not eventname.startswith('PROCESS_STATE_'):
+            # a group was added or removed
+            self.infos = None
+            return
+        headers = childutils.get_headers(payload)
+        info = self.infos.get('%s:%s' % (headers.get('groupname'),
+                                         headers.get('processname')))
+        statename = eventname[len('PROCESS_STATE_'):]
+        state = getattr(ProcessStates, statename, None)
+        if info is None or state is None:
+            self.infos = None
+            return
+        info['state'] = state
+        info['statename'] = statename
+        if statename == 'STARTING':
+            info['start'] = now
+        if statename in ('RUNNING', 'STOPPING'):
+            info['pid'] = int(headers['pid'])
+        else:
+            # supervisord reports no pid until the process is RUNNING
+            # and none once it has exited
+            info['pid'] = 0
+
+    def current(self, now):
+        self.age += 1
+        infos = list(self.infos.values())
+        for info in infos:
+            info['now'] = now
+        return infos
+
+class ProcessState:
+    """Memory usage of one process, kept across ticks.  The most recent
+    samples are stored in a fixed-size ring buffer of (time, usage)
+    pairs, so the memory used per process stays constant."""
+
+    def __init__(self, pid, size):
+        self.pid = pid
+        self.size = size
+        self.samples = array('d', [0.0]) * (size * 2)
+        self.count = 0
+        self.over = 0 # consecutive samples over the limit
+
+    def add(self, when, usage):
+        if not self.size:
+            self.count += 1
+            return
+        i = (self.count % self.size) * 2
+        self.samples[i] = when
+        self.samples[i + 1] = usage
+        self.count += 1
+
+    def growth_rate(self):
+        """Return the growth in bytes per second, as a least squares fit
+        over the samples in the buffer, or None until it is full."""
+        if self.count < self.size or self.size < 2:
+            return None
+        samples = self.samples
+        times = samples[0::2]
+        mean_time = sum(times) / self.size
+        mean_usage = sum(samples[1::2]) / self.size
+        covariance = variance = 0.0
+        for i in range(0, self.size * 2, 2):
+            dt = samples[i] - mean_time
+            covariance += dt * (samples[i + 1] - mean_usage)
+            variance += dt * dt
+        if not variance:
+            return None
+        return covariance / variance
+
+class RestartScheduler:
+    """Restarts processes on behalf of Memmon, at most `concurrency` at a
+    time, without taking a group below `min_running` RUNNING members.
+
+    With a concurrency of 0, restarts happen synchronously in submit().
+    Otherwise they are done by background worker threads, each with its
+    own RPC connections from `rpc_factory(instance)`, and an error raised
+    by a restart is re-raised from the next call to update()."""
+
+    def __init__(self, restart, concurrency=0, min_running=0,
+                 rpc_factory=None):
+        self.restart = restart
+        self.concurrency = concurrency
+        self.min_running = min_running
+        self.rpc_factory = rpc_factory
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        self.pending = deque()
+        self.queued = set() # names pending or in flight
+        self.inflight = {} # groupspec -> set of namespecs in flight
+        self.running = {} # groupspec -> RUNNING processes at last tick
+        self.running_names = set() # namespecs RUNNING at last tick
+        self.workers = []
+        self.error = None
+
+    def update(self, processes):
+        """Called once per tick with the process snapshot."""
+        running = {}
+        running_names = set()
+        for process in processes:
+            if process.state == ProcessStates.RUNNING:
+                group = process.groupspec
+                running[group] = running.get(group, 0) + 1
+                running_names.add(process.namespec)
+        with self.lock:
+            self.running = running
+            self.running_names = running_names
+            # restarts still waiting from the last tick are resubmitted
+            # with fresh measurements if they are still needed
+            for job in self.pending:
+                self.queued.discard(job[0].namespec)
+            self.pending.clear()
+            error, self.error = self.error, None
+        if error is not None:
+            raise error
+
+    def allowed(self, group):
+        if not self.min_running:
+            return True
+        # a restart in flight only takes down a process the snapshot
+        # counted as RUNNING; one which started before the snapshot was
+        # STOPPING or STARTING then, and isn't counted twice
+        down = [namespec for namespec in self.inflight.get(group, ())
+                if namespec in self.running_names]
+        available = self.running.get(group, 0) - len(down)
+        return available - 1 >= self.min_running
+
+    def submit(self, process, rss, reason=None, needed=None):
+        """Restart a process, now or in the background.  If given,
+        needed() is called just before a background restart starts, and the
+        restart is dropped if it returns False."""
+        if not self.concurrency:
+            if self.allowed(process.groupspec):
+                self.restart(process, rss, reason)
+                return True
+            return False
+
+        with self.lock:
+            if process.namespec in self.queued:
+                return False
+            self.queued.add(process.namespec)
+            self.pending.append((process, rss, reason, needed))
+            while len(self.workers) < self.concurrency:
+                worker = threading.Thread(target=self.work)
+                worker.daemon = True
+                worker.start()
+                self.workers.append(worker)
+            self.changed.notify_all()
+        return True
+
+    def next_job(self):
+        for job in list(self.pending):
+            if self.allowed(job[0].groupspec):
+                self.pending.remove(job)
+                needed = job[3]
+                if needed is not None and not needed():
+                    self.queued.discard(job[0].namespec)
+                    self.changed.notify_all()
+                    continue
+                return job
+        return None
+
+    def work(self):
+        rpcs = {} # instance -> this worker's RPC connection
+        while 1:
+            with self.lock:
+                job = self.next_job()
+                while job is None:
+                    self.changed.wait()
+                    job = self.next_job()
+                process, rss, reason, needed = job
+                group = process.groupspec
+                self.inflight.setdefault(group, set()).add(process.namespec)
+            try:
+                rpc = None
+                if self.rpc_factory is not None:
+                    rpc = rpcs.get(process.instance)
+                    if rpc is None:
+                        rpc = rpcs[process.instance] = self.rpc_factory(
+                            process.instance)
+                self.restart(process, rss, reason, rpc)
+            except Exception as e:
+                with self.lock:
+                    if self.error is None:
+                        self.error = e
+            finally:
+                with self.lock:
+                    self.inflight[group].discard(process.namespec)
+                    self.queued.discard(process.namespec)
+                    self.changed.notify_all()
+
+    def wait(self, timeout=None):
+        """Wait until no restarts are pending or in flight.  Returns False
+        if that didn't happen within timeout seconds."""
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        with self.lock:
+            while self.queued:
+                if deadline is None:
+                    self.changed.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.changed.wait(remaining)
+        return True
+
 class Memmon:
-    def __init__(self, cumulative, programs, groups, any, sendmail, email, email_uptime_limit, name, rpc=None):
+    def __init__(self, cumulative, programs, groups, any, sendmail, email, email_uptime_limit, name, rpc=None, metric='rss', restart_concurrency=0, min_running=0, verbose=False, horizon=None, window=10, sustain=1, low_watermark=100, store=None, exporter=None, mail_timeout=30, mail_retries=2, timing=False, profile=None, profile_every=100, pressure=False, psi_threshold=10.0, min_available=10, grace=10, instances=(), reconcile_every=0):
         self.cumulative = cumulative
         self.programs = programs
         self.groups = groups
@@ -110,11 +721,47 @@ class Memmon:
         self.email_uptime_limit = email_uptime_limit
         self.name = name
         self.rpc = rpc
+        self.instances = list(instances) # [(name, url)] of extra supervisords
+        self.rpcs = {} # instance name -> RPC connection
+        self.cache = None
+        if reconcile_every:
+            self.cache = ProcessCache(reconcile_every)
+        self.thresholds = Thresholds(programs, groups, any)
+        self.verbose = verbose
+        self.horizon = horizon
+        self.window = window
+        self.sustain = sustain
+        self.low_watermark = low_watermark
+        self.states = {}
+        self.store = store
+        self.exporter = exporter
+        self.mail_timeout = mail_timeout
+        self.mail_retries = mail_retries
+        self.mailer = None
+        self.metric = metric
+        self.label = metric.upper()
         self.stdin = sys.stdin
         self.stdout = sys.stdout
         self.stderr = sys.stderr
         self.pscommand = 'ps -orss= -p %s'
         self.pstreecommand = 'ps ax -o "pid= ppid= rss="'
+        self.procdir = find_procdir()
+        self.pagesize = PAGESIZE
+        self.cgroupdir = find_cgroupdir()
+        self.scheduler = RestartScheduler(self.restart,
+                                          concurrency=restart_concurrency,
+                                          min_running=min_running)
+        self.clear_caches()
+        self.root_cgroup_warned = set()
+        self.pressure = pressure
+        self.psi_threshold = psi_threshold
+        self.min_available = min_available
+        self.grace = grace
+        self.timing = timing
+        self.profile = profile
+        self.profile_every = profile_every
+        self.ticks = 0
+        self.clock = time.time
         self.mailed = False # for unit tests
 
     def runforever(self, test=False):
@@ -124,93 +771,346 @@ class Memmon:
             headers, payload = childutils.listener.wait(self.stdin, self.stdout)
 
             if not headers['eventname'].startswith('TICK'):
-                # do nothing with non-TICK events
+                if self.cache is not None and \
+                        headers['eventname'].startswith('PROCESS_'):
+                    self.cache.update(headers['eventname'], payload,
+                                      time.time())
+                # do nothing else with non-TICK events
                 childutils.listener.ok(self.stdout)
                 if test:
                     break
                 continue
 
-            status = []
-            if self.programs:
-                keys = sorted(self.programs.keys())
-                status.append(
-                    'Checking programs %s' % ', '.join(
-                    [ '%s=%s' % (k, self.programs[k]) for k in keys ])
-                    )
-
-            if self.groups:
-                keys = sorted(self.groups.keys())
-                status.append(
-                    'Checking groups %s' % ', '.join(
-                    [ '%s=%s' % (k, self.groups[k]) for k in keys ])
-                    )
-            if self.any is not None:
-                status.append('Checking any=%s' % self.any)
-
-            self.stderr.write('\n'.join(status) + '\n')
-
-            infos = self.rpc.supervisor.getAllProcessInfo()
-
-            for info in infos:
-                pid = info['pid']
-                name = info['name']
-                group = info['group']
-                pname = '%s:%s' % (group, name)
-
-                if not pid:
-                    # ps throws an error in this case (for processes
-                    # in standby mode, non-auto-started).
-                    continue
-
-                rss = self.calc_rss(pid)
-                if rss is None:
-                    # no such pid (deal with race conditions) or
-                    # rss couldn't be calculated for other reasons
-                    continue
-
-                for n in name, pname:
-                    if n in self.programs:
-                        self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                        if  rss > self.programs[name]:
-                            self.restart(pname, rss)
-                            continue
-
-                if group in self.groups:
-                    self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                    if rss > self.groups[group]:
-                        self.restart(pname, rss)
-                        continue
-
-                if self.any is not None:
-                    self.stderr.write('RSS of %s is %s\n' % (pname, rss))
-                    if rss > self.any:
-                        self.restart(pname, rss)
-                        continue
+            self.ticks += 1
+            timings = dict.fromkeys(PHASES, 0.0)
+            started = self.clock()
+            if self.profile is not None and \
+                    self.ticks % self.profile_every == 0:
+                profiler = cProfile.Profile()
+                checked = profiler.runcall(self.tick, timings)
+                profiler.dump_stats(self.profile)
+            else:
+                checked = self.tick(timings)
+            elapsed = self.clock() - started
+
+            if self.timing:
+                self.stderr.write(
+                    'Tick took %.3fs: %s (%d processes checked)\n' % (
+                    elapsed, ', '.join(['%s %.3fs' % (phase, timings[phase])
+                                        for phase in PHASES]), checked))
+            interval = tick_interval(headers['eventname'])
+            if interval and elapsed > interval:
+                self.stderr.write(
+                    'Tick took %.3f seconds, longer than the %s interval of '
+                    '%d seconds: memmon is falling behind\n' % (
+                    elapsed, headers['eventname'], interval))
 
             self.stderr.flush()
             childutils.listener.ok(self.stdout)
             if test:
                 break
 
-    def restart(self, name, rss):
-        info = self.rpc.supervisor.getProcessInfo(name)
-        uptime = info['now'] - info['start'] #uptime in seconds
+    def tick(self, timings):
+        """Check every monitored process once.  Adds the time spent in each
+        phase to timings and returns the number of processes measured."""
+        self.clear_caches()
+
+        if self.ticks <= 1:
+            # only on the first tick: with many -p options it is long
+            self.stderr.write(self.thresholds.status)
+
+        started = self.clock()
+        processes = self.get_process_info()
+        timings['rpc'] += self.clock() - started
+        self.scheduler.update(processes)
+        seen = set()
+        tracking = self.horizon is not None or self.sustain > 1
+        checked = 0
+        candidates = [] # restarts ranked after the loop with --pressure
+        store_error = None
+
+        for process in processes:
+            if not process.pid:
+                # ps throws an error in this case (for processes
+                # in standby mode, non-auto-started).
+                continue
+
+            limit = self.thresholds.lookup(process.group, process.name,
+                                           process.instance)
+            if limit is None:
+                # not monitored, don't bother measuring it
+                continue
+
+            started = self.clock()
+            rss = self.measure(process.pid)
+            timings['measure'] += self.clock() - started
+            if rss is None:
+                # no such pid (deal with race conditions) or
+                # rss couldn't be calculated for other reasons
+                if process.pid in self.root_cgroup_pids and \
+                        process.namespec not in self.root_cgroup_warned:
+                    # say so once rather than never checking it silently
+                    self.root_cgroup_warned.add(process.namespec)
+                    self.stderr.write('Not checking %s: it is in the root '
+                                      'cgroup, which has no memory usage '
+                                      'to read\n' % process.namespec)
+                continue
+            checked += 1
+
+            if self.store is not None and store_error is None:
+                try:
+                    self.store.append(process.now, process.pid,
+                                      process.namespec, rss)
+                except (IOError, OSError) as e:
+                    # e.g. a full disk: samples are lost, not memory limits
+                    store_error = e
+            if self.exporter is not None:
+                self.exporter.sample(process.namespec, rss, limit)
+
+            state = growth = None
+            if tracking:
+                seen.add(process.namespec)
+                state = self.track(process, rss)
+                if self.horizon is not None:
+                    growth = state.growth_rate()
+                if rss > limit:
+                    state.over += 1
+                elif rss * 100 < limit * self.low_watermark:
+                    state.over = 0
+
+            started = self.clock()
+            if rss > limit and state and state.over < self.sustain:
+                if self.verbose:
+                    self.stderr.write('%s of %s is %s, over the limit '
+                                      'for %s of %s samples\n' % (
+                                      self.label, process.namespec, rss,
+                                      state.over, self.sustain))
+            elif rss > limit:
+                self.stderr.write('%s of %s is %s\n' % (
+                    self.label, process.namespec, rss))
+                if self.pressure:
+                    candidates.append((process, rss, limit, None))
+                else:
+                    self.submit(process, rss)
+            elif (growth is not None and growth > 0 and
+                  (limit - rss) / growth <= self.horizon):
+                self.stderr.write('%s of %s is %s, growing by %d '
+                                  'bytes/s\n' % (self.label,
+                                  process.namespec, rss, growth))
+                reason = ('its memory usage was growing by %d bytes/s '
+                          'and would have reached the limit of %s '
+                          'bytes within %d seconds (%s bytes %s)' % (
+                          growth, limit, (limit - rss) / growth, rss,
+                          self.label))
+                if self.pressure:
+                    candidates.append((process, rss, limit, reason))
+                else:
+                    self.submit(process, rss, reason)
+            elif self.verbose:
+                self.stderr.write('%s of %s is %s\n' % (
+                    self.label, process.namespec, rss))
+            timings['restart'] += self.clock() - started
+
+        if candidates:
+            started = self.clock()
+            self.submit_ranked(candidates)
+            timings['restart'] += self.clock() - started
+
+        started = self.clock()
+        if self.store is not None and store_error is None:
+            try:
+                self.store.commit()
+            except (IOError, OSError) as e:
+                store_error = e
+        if store_error is not None:
+            self.stderr.write('Cannot write samples to %s: %s\n' % (
+                self.store.path, store_error))
+        if self.exporter is not None:
+            try:
+                self.exporter.write(timings['measure'])
+            except (IOError, OSError) as e:
+                self.stderr.write('Cannot write metrics to %s: %s\n' % (
+                    self.exporter.path, e))
+        timings['output'] += self.clock() - started
+
+        if self.states:
+            # forget processes which have gone away
+            for namespec in list(self.states):
+                if namespec not in seen:
+                    del self.states[namespec]
+
+        return checked
+
+    def get_process_info(self):
+        """Return a snapshot of the processes of this supervisord and of
+        every --instance.  The instances are queried concurrently; one
+        which can't be reached is logged and skipped for this tick."""
+        if not self.instances:
+            return snapshot(self.get_local_process_info())
+
+        results = {}
+        def query(instance):
+            try:
+                infos = self.rpcs[instance].supervisor.getAllProcessInfo()
+                results[instance] = snapshot(infos, instance)
+            except Exception as e:
+                results[instance] = e
+        threads = []
+        for instance, url in self.instances:
+            thread = threading.Thread(target=query, args=(instance,))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        processes = snapshot(self.get_local_process_info())
+        for thread in threads:
+            thread.join()
+        for instance, url in self.instances:
+            result = results[instance]
+            if isinstance(result, Exception):
+                self.stderr.write('Cannot get the processes of instance %s '
+                                  '(%s): %s\n' % (instance, url, result))
+            else:
+                processes.extend(result)
+        return processes
+
+    def get_local_process_info(self):
+        if self.cache is None:
+            return self.rpc.supervisor.getAllProcessInfo()
+        if self.cache.due():
+            self.cache.reconcile(self.rpc.supervisor.getAllProcessInfo())
+        return self.cache.current(time.time())
+
+    def rpc_for(self, instance):
+        if instance is None:
+            return self.rpc
+        return self.rpcs[instance]
+
+    def make_rpc(self, instance=None):
+        """Return a new RPC connection to this supervisord or to one of
+        the --instance supervisords, with the same credentials."""
+        env = dict(os.environ)
+        if instance is not None:
+            env['SUPERVISOR_SERVER_URL'] = dict(self.instances)[instance]
+        return childutils.getRPCInterface(env)
+
+    def track(self, process, rss):
+        """Record a sample for process and return its ProcessState."""
+        state = self.states.get(process.namespec)
+        if state is None or state.pid != process.pid:
+            # a restarted process starts with an empty history
+            size = self.window if self.horizon is not None else 0
+            state = ProcessState(process.pid, size)
+            self.states[process.namespec] = state
+        state.add(process.now, rss)
+        return state
+
+    def submit(self, process, rss, reason=None, needed=None):
+        if not self.scheduler.submit(process, rss, reason, needed):
+            self.stderr.write(
+                'Not restarting %s now: fewer than %s other processes in '
+                'group %s are RUNNING, or a restart is already under way\n' %
+                (process.namespec, self.scheduler.min_running,
+                 process.groupspec))
+
+    def host_pressure(self):
+        """Return why the host is under memory pressure, or None if it
+        isn't (or this can't be told)."""
+        if self.procdir is None:
+            return None
+        try:
+            data = read_file(os.path.join(self.procdir, 'pressure', 'memory'))
+            avg10 = parse_psi(data)['some']['avg10']
+        except (IOError, OSError, KeyError, ValueError):
+            # PSI needs Linux 4.20 or later with CONFIG_PSI
+            pass
+        else:
+            if avg10 >= self.psi_threshold:
+                return 'memory pressure (PSI some avg10) is %.2f%%' % avg10
+        try:
+            fields = parse_smaps(read_file(os.path.join(self.procdir,
+                                                        'meminfo')))
+            total = fields['MemTotal']
+            available = fields['MemAvailable']
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        if total and available * 100 < total * self.min_available:
+            return 'only %d%% of memory is available' % (
+                available * 100 // total)
+        return None
+
+    def submit_ranked(self, candidates):
+        """Restart the processes furthest over their limits first while
+        the host is under memory pressure.  Without pressure, processes
+        that are less than --grace percent over their limit are left
+        running."""
+        def overage(candidate):
+            process, rss, limit, reason = candidate
+            if not limit:
+                return float('inf')
+            return float(rss) / limit
+        candidates.sort(key=overage, reverse=True)
+
+        pressure = self.host_pressure()
+        if pressure is not None:
+            self.stderr.write('Host is under memory pressure: %s\n' %
+                              pressure)
+        for process, rss, limit, reason in candidates:
+            if (pressure is None and reason is None and
+                    rss * 100 < limit * (100 + self.grace)):
+                self.stderr.write(
+                    'Not restarting %s now: %s is within %s%% of its limit '
+                    'and the host is not under memory pressure\n' % (
+                    process.namespec, self.label, self.grace))
+                continue
+            if not self.scheduler.concurrency:
+                self.submit(process, rss, reason)
+                if pressure is not None:
+                    # the restart may have been enough
+                    pressure = self.host_pressure()
+            elif (pressure is not None and reason is None and
+                    rss * 100 < limit * (100 + self.grace)):
+                # restarted only because of the pressure, which background
+                # restarts ahead of it in the queue may relieve
+                self.submit(process, rss, reason,
+                            lambda process=process: self.still_pressed(
+                                process))
+            else:
+                self.submit(process, rss, reason)
+
+    def still_pressed(self, process):
+        """Called by the scheduler before starting the background restart
+        of a process held back by --grace when the host was under memory
+        pressure."""
+        if self.host_pressure() is not None:
+            return True
+        self.stderr.write(
+            'Not restarting %s now: %s is within %s%% of its limit and the '
+            'host is no longer under memory pressure\n' % (
+            process.namespec, self.label, self.grace))
+        return False
+
+    def restart(self, process, rss, reason=None, rpc=None):
+        if rpc is None:
+            rpc = self.rpc_for(process.instance)
+        name = process.namespec
+        uptime = process.uptime
         self.stderr.write('Restarting %s\n' % name)
         try:
-            self.rpc.supervisor.stopProcess(name)
+            rpc.supervisor.stopProcess(process.rpcname)
         except xmlrpclib.Fault as e:
-            msg = ('Failed to stop process %s (RSS %s), exiting: %s' %
-                   (name, rss, e))
+            msg = ('Failed to stop process %s (%s %s), exiting: %s' %
+                   (name, self.label, rss, e))
             self.stderr.write(str(msg))
             if self.email:
                 subject = self.format_subject(
                     'failed to stop process %s, exiting' % name
                     )
                 self.mail(self.email, subject, msg)
+                self.flush_mail()
             raise
 
         try:
-            self.rpc.supervisor.startProcess(name)
+            rpc.supervisor.startProcess(process.rpcname)
         except xmlrpclib.Fault as e:
             msg = ('Failed to start process %s after stopping it, '
                    'exiting: %s' % (name, e))
@@ -220,15 +1120,21 @@ class Memmon:
                     'failed to start process %s, exiting' % name
                 )
                 self.mail(self.email, subject, msg)
+                self.flush_mail()
             raise
 
+        if self.exporter is not None:
+            self.exporter.restarted(name)
+
         if self.email and uptime <= self.email_uptime_limit:
             now = time.asctime()
             timezone = time.strftime('%Z')
+            if reason is None:
+                reason = ('it was consuming too much memory (%s bytes %s)' %
+                          (rss, self.label))
             msg = (
                 'memmon.py restarted the process named %s at %s %s because '
-                'it was consuming too much memory (%s bytes RSS)' % (
-                name, now, timezone, rss)
+                '%s' % (name, now, timezone, reason)
                 )
             subject = self.format_subject(
                 'process %s restarted' % name
@@ -241,42 +1147,107 @@ class Memmon:
         else:
             return 'memmon [%s]: %s' % (self.name, subject)
 
-    def calc_rss(self, pid):
-        ProcInfo = namedtuple('ProcInfo', ['pid', 'ppid', 'rss'])
-
-        def find_children(parent_pid, procs):
-            children = []
-            for proc in procs:
-                pid, ppid, rss = proc
-                if ppid == parent_pid:
-                    children.append(proc)
-                    children.extend(find_children(pid, procs))
-            return children
-
-        def cum_rss(pid, procs):
-            parent_proc = [p for p in procs if p.pid == pid][0]
-            children = find_children(pid, procs)
-            tree = [parent_proc] + children
-            total_rss = sum(map(int, [p.rss for p in tree]))
-            return total_rss
-
-        def get_all_process_infos(data):
-            data = data.strip()
-            procs = []
-            for line in data.splitlines():
-                pid, ppid, rss = map(int, line.split())
-                procs.append(ProcInfo(pid=pid, ppid=ppid, rss=rss))
-            return procs
+    def clear_caches(self):
+        # memory usage is read at most once per tick
+        self.ptable = None
+        self.smaps = {}
+        self.cgroups = {}
+        self.root_cgroup_pids = set()
+
+    def measure(self, pid):
+        if self.metric == 'rss':
+            return self.calc_rss(pid)
+        if self.metric == 'cgroup':
+            return self.calc_cgroup(pid)
+        return self.calc_smaps(pid, self.metric)
+
+    def calc_cgroup(self, pid):
+        path = os.path.join(self.procdir, str(pid), 'cgroup')
+        try:
+            data = read_file(path)
+        except (IOError, OSError):
+            # no such pid (deal with race conditions)
+            return None
+
+        cgroup = None
+        for line in data.splitlines():
+            # the v2 hierarchy is listed as "0::/path/to/cgroup"
+            if line.startswith('0::'):
+                cgroup = line[3:].strip().lstrip('/')
+                break
+        if cgroup == '':
+            # the root cgroup has no memory.current
+            self.root_cgroup_pids.add(pid)
+            return None
+        if cgroup is None:
+            # no v2 hierarchy
+            return None
+
+        # processes sharing a cgroup share its memory reading
+        if cgroup not in self.cgroups:
+            self.cgroups[cgroup] = self.read_cgroup_memory(cgroup)
+        return self.cgroups[cgroup]
+
+    def read_cgroup_memory(self, cgroup):
+        path = os.path.join(self.cgroupdir, cgroup)
+        try:
+            current = int(read_file(os.path.join(path, 'memory.current')))
+            stat = read_file(os.path.join(path, 'memory.stat'))
+        except (IOError, OSError, ValueError):
+            return None
+
+        # don't count page cache the kernel can drop whenever it likes
+        for line in stat.splitlines():
+            parts = line.split()
+            if len(parts) == 2 and parts[0] == 'inactive_file':
+                current -= int(parts[1])
+                break
+        return max(current, 0)
 
+    def calc_smaps(self, pid, metric):
         if self.cumulative:
-            data = shell(self.pstreecommand)
-            procs = get_all_process_infos(data)
-
-            try:
-                rss = cum_rss(pid, procs)
-            except (ValueError, IndexError):
-                # Could not determine cumulative RSS
+            pids = self.process_table().subtree(pid)
+            if pids is None:
                 return None
+        else:
+            pids = [pid]
+
+        keys = SMAPS_METRICS[metric]
+        total = 0
+        for p in pids:
+            fields = self.read_smaps(p)
+            if fields is None:
+                if p == pid:
+                    # no such pid (deal with race conditions)
+                    return None
+                # a child exited since the process table was read
+                continue
+            for key in keys:
+                total += fields.get(key, 0)
+        return total
+
+    def read_smaps(self, pid):
+        # smaps are read at most once per pid per tick
+        if pid in self.smaps:
+            return self.smaps[pid]
+        fields = None
+        # smaps_rollup is only available on Linux 4.14 and later
+        for filename in ('smaps_rollup', 'smaps'):
+            path = os.path.join(self.procdir, str(pid), filename)
+            try:
+                fields = parse_smaps(read_file(path))
+            except (IOError, OSError, ValueError):
+                continue
+            break
+        self.smaps[pid] = fields
+        return fields
+
+    def calc_rss(self, pid):
+        if self.cumulative:
+            return self.process_table().cumulative_rss(pid)
+
+        elif self.procdir is not None:
+            return self.read_procfs_rss(pid)
 
         else:
             data = shell(self.pscommand % pid)
@@ -294,19 +1265,87 @@ class Memmon:
         rss = rss * 1024  # rss is in KB
         return rss
 
+    def process_table(self):
+        # the process table is read at most once per tick; runforever
+        # discards it before each tick
+        if self.ptable is None:
+            if self.procdir is not None:
+                procs = self.read_procfs_process_table()
+            else:
+                procs = self.read_ps_process_table()
+            self.ptable = ProcessTable(procs)
+        return self.ptable
+
+    def read_ps_process_table(self):
+        procs = []
+        for line in shell(self.pstreecommand).strip().splitlines():
+            try:
+                pid, ppid, rss = map(int, line.split())
+            except ValueError:
+                continue
+            procs.append((pid, ppid, rss * 1024)) # rss is in KB
+        return procs
+
+    def read_procfs_process_table(self):
+        procs = []
+        for entry in os.listdir(self.procdir):
+            if not entry.isdigit():
+                continue
+            try:
+                data = read_file(os.path.join(self.procdir, entry, 'stat'))
+            except (IOError, OSError):
+                # process exited while we were listing
+                continue
+            # the command name is in parens and may itself contain spaces
+            # or parens, so split the remaining fields after the last one
+            fields = data[data.rfind(')') + 2:].split()
+            try:
+                ppid = int(fields[1])
+                rss = int(fields[21]) # in pages
+            except (IndexError, ValueError):
+                continue
+            procs.append((int(entry), ppid, rss * self.pagesize))
+        return procs
+
+    def read_procfs_rss(self, pid):
+        path = os.path.join(self.procdir, str(pid), 'statm')
+        try:
+            data = read_file(path)
+        except (IOError, OSError):
+            # no such pid (deal with race conditions)
+            return None
+
+        try:
+            # statm: size resident shared text lib data dt (in pages)
+            resident = int(data.split()[1])
+        except (IndexError, ValueError):
+            return None
+
+        return resident * self.pagesize
+
     def mail(self, email, subject, msg):
         body = 'To: %s\n' % self.email
         body += 'Subject: %s\n' % subject
         body += '\n'
         body += msg
-        with os.popen(self.sendmail, 'w') as m:
-            m.write(body)
+        if self.mailer is None:
+            self.mailer = MailQueue(self.sendmail,
+                                    timeout=self.mail_timeout,
+                                    retries=self.mail_retries,
+                                    stderr=self.stderr)
+        self.mailer.put(body)
         self.mailed = body
 
+    def flush_mail(self):
+        # give queued mail a chance to go out before memmon exits
+        if self.mailer is not None:
+            self.mailer.flush(self.mail_timeout * (self.mail_retries + 1))
+
 def parse_namesize(option, value):
     try:
-        name, size = value.split('=')
-    except ValueError:
+        name, size = value.rsplit('=', 1)
+        compile_pattern(name)
+    except (ValueError, re.error):
         print('Unparseable value %r for %r' % (value, option))
         usage()
     size = parse_size(option, size)
@@ -335,12 +1374,23 @@ def parse_seconds(option, value):
         usage()
     return seconds
 
+def parse_count(option, value):
+    try:
+        count = int(value)
+        if count < 0:
+            raise ValueError(value)
+    except ValueError:
+        print('Unparseable value %r for %r' % (value, option))
+        usage()
+    return count
+
 help_request = object()  # returned from memmon_from_args to indicate --help
 
 def memmon_from_args(arguments):
-    short_args = "hcp:g:a:s:m:n:u:"
+    short_args = "hcp:g:a:s:m:n:u:v"
     long_args = [
         "help",
+        "verbose",
         "cumulative",
         "program=",
         "group=",
@@ -349,6 +1399,28 @@ def memmon_from_args(arguments):
         "email=",
         "uptime=",
         "name=",
+        "metric=",
+        "restart-concurrency=",
+        "min-running=",
+        "horizon=",
+        "window=",
+        "sustain=",
+        "low-watermark=",
+        "store=",
+        "store-max-size=",
+        "store-keep=",
+        "textfile=",
+        "mail-timeout=",
+        "mail-retries=",
+        "timing",
+        "profile=",
+        "profile-every=",
+        "pressure",
+        "psi-threshold=",
+        "min-available=",
+        "grace=",
+        "instance=",
+        "reconcile-every=",
         ]
 
     if not arguments:
@@ -359,6 +1431,29 @@ def memmon_from_args(arguments):
         return None
 
     cumulative = False
+    metric = 'rss'
+    restart_concurrency = 0
+    min_running = 0
+    verbose = False
+    horizon = None
+    window = 10
+    sustain = 1
+    low_watermark = 100
+    store_path = None
+    store_max_size = 64 * 1024 * 1024
+    store_keep = 4
+    textfile = None
+    mail_timeout = 30
+    mail_retries = 2
+    timing = False
+    profile = None
+    profile_every = 100
+    pressure = False
+    psi_threshold = 10.0
+    min_available = 10
+    grace = 10
+    instances = []
+    reconcile_every = 0
     programs = {}
     groups = {}
     any = None
@@ -376,12 +1471,15 @@ def memmon_from_args(arguments):
             cumulative = True
 
         if option in ('-p', '--program'):
-            name, size = parse_namesize(option, value)
-            programs[name] = size
+            pattern, size = parse_namesize(option, value)
+            programs[pattern] = size
 
         if option in ('-g', '--group'):
-            name, size = parse_namesize(option, value)
-            groups[name] = size
+            pattern, size = parse_namesize(option, value)
+            groups[pattern] = size
+
+        if option in ('-v', '--verbose'):
+            verbose = True
 
         if option in ('-a', '--any'):
             size = parse_size(option, value)
@@ -399,6 +1497,105 @@ def memmon_from_args(arguments):
         if option in ('-n', '--name'):
             name = value
 
+        if option == '--metric':
+            metric = value.lower()
+            if metric not in METRICS:
+                print('Unknown metric %r for %r (expected one of %s)' % (
+                    value, option, ', '.join(METRICS)))
+                usage()
+
+        if option == '--restart-concurrency':
+            restart_concurrency = parse_count(option, value)
+
+        if option == '--min-running':
+            min_running = parse_count(option, value)
+
+        if option == '--horizon':
+            horizon = parse_seconds(option, value)
+
+        if option == '--window':
+            window = parse_count(option, value)
+            if window < 2:
+                print('--window needs at least 2 samples to fit a growth rate')
+                usage()
+
+        if option == '--sustain':
+            sustain = max(parse_count(option, value), 1)
+
+        if option == '--low-watermark':
+            low_watermark = parse_count(option, value.rstrip('%'))
+            if low_watermark > 100:
+                print('--low-watermark must be a percentage of at most 100')
+                usage()
+
+        if option == '--store':
+            store_path = value
+
+        if option == '--store-max-size':
+            store_max_size = parse_size(option, value)
+
+        if option == '--store-keep':
+            store_keep = parse_count(option, value)
+
+        if option == '--textfile':
+            textfile = value
+
+        if option == '--mail-timeout':
+            mail_timeout = parse_seconds(option, value)
+
+        if option == '--mail-retries':
+            mail_retries = parse_count(option, value)
+
+        if option == '--timing':
+            timing = True
+
+        if option == '--profile':
+            profile = value
+
+        if option == '--profile-every':
+            profile_every = max(parse_count(option, value), 1)
+
+        if option == '--pressure':
+            pressure = True
+
+        if option == '--psi-threshold':
+            try:
+                psi_threshold = float(value.rstrip('%'))
+            except ValueError:
+                print('Invalid percentage %r for %r' % (value, option))
+                usage()
+
+        if option == '--min-available':
+            min_available = parse_count(option, value.rstrip('%'))
+
+        if option == '--grace':
+            grace = parse_count(option, value.rstrip('%'))
+
+        if option == '--instance':
+            instance, _, url = value.partition('=')
+            if not instance or not url or '@' in instance or \
+                    instance in dict(instances):
+                print('Badly formed or duplicate instance %r for %r '
+                      '(expected name=serverurl)' % (value, option))
+                usage()
+            instances.append((instance, url))
+
+        if option == '--reconcile-every':
+            reconcile_every = parse_count(option, value)
+
+    store = None
+    if store_path is not None:
+        try:
+            store = SampleStore(store_path, max_size=store_max_size,
+                                keep=store_keep)
+        except (IOError, OSError, ValueError) as e:
+            print('Cannot open sample store %r: %s' % (store_path, e))
+            usage()
+
+    exporter = None
+    if textfile is not None:
+        exporter = TextfileExporter(textfile, metric)
+
     memmon = Memmon(cumulative=cumulative,
                     programs=programs,
                     groups=groups,
@@ -406,7 +1603,28 @@ def memmon_from_args(arguments):
                     sendmail=sendmail,
                     email=email,
                     email_uptime_limit=uptime_limit,
-                    name=name)
+                    name=name,
+                    metric=metric,
+                    restart_concurrency=restart_concurrency,
+                    min_running=min_running,
+                    verbose=verbose,
+                    horizon=horizon,
+                    window=window,
+                    sustain=sustain,
+                    low_watermark=low_watermark,
+                    store=store,
+                    exporter=exporter,
+                    mail_timeout=mail_timeout,
+                    mail_retries=mail_retries,
+                    timing=timing,
+                    profile=profile,
+                    profile_every=profile_every,
+                    pressure=pressure,
+                    psi_threshold=psi_threshold,
+                    min_available=min_available,
+                    grace=grace,
+                    instances=instances,
+                    reconcile_every=reconcile_every)
     return memmon
 
 def main():
@@ -415,7 +1633,22 @@ def main():
         usage(exitstatus=0)
     elif memmon is None:  # something went wrong
         usage()
-    memmon.rpc = childutils.getRPCInterface(os.environ)
+    if memmon.metric != 'rss' and memmon.procdir is None:
+        print('The %s metric requires a Linux /proc filesystem' %
+              memmon.label)
+        usage()
+    if memmon.metric == 'cgroup' and memmon.cgroupdir is None:
+        print('The %s metric requires a cgroup v2 filesystem' %
+              memmon.label)
+        usage()
+    if memmon.pressure and memmon.procdir is None:
+        print('--pressure requires a Linux /proc filesystem')
+        usage()
+    memmon.rpc = memmon.make_rpc()
+    for instance, url in memmon.instances:
+        memmon.rpcs[instance] = memmon.make_rpc(instance)
+    # restarts in background threads each need their own RPC connections
+    memmon.scheduler.rpc_factory = memmon.make_rpc
     memmon.runforever()
 
 if __name__ == '__main__':
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# A command line tool (not an event listener) which summarizes the samples
+# memmon records with its --store option.
+
+doc = """\
+memmon_report.py [-s seconds] [-p program] store_file
+
+Options:
+
+-s -- only consider samples taken within this many seconds of the newest
+      sample in the store.  Seconds can be specified as plain integer
+      values or a suffix-multiplied integer (e.g. 1d).  Valid suffixes
+      are m (minute), h (hour) and d (day).
+
+-p -- only report on this program.  Can be a process name, a
+      'group_name:process_name' namespec or a glob pattern.  May be
+      specified more than once.
+
+store_file -- the file given to memmon's --store option.  Rotated files
+      next to it ("store_file.1", ...) are read too.
+
+For each program, memmon-report prints the number of samples, the 50th,
+90th and 99th percentiles of its memory usage, and its peak usage with the
+time it was seen.  Samples are streamed from the store and binned into a
+fixed number of logarithmic buckets per program, so the percentiles are
+approximate (within about 5%) and memory use does not depend on the size
+of the store.  Peaks are exact.
+
+A sample invocation:
+
+memmon_report.py -s 7d -p 'web_*' /var/log/supervisor/memmon.samples
+"""
+
+import fnmatch
+import getopt
+import math
+import sys
+import time
+
+from supervisor.datatypes import SuffixMultiplier
+
+from superlance.samplestore import iter_samples, last_sample
+from superlance.samplestore import read_names, store_paths
+
+BUCKETS_PER_DOUBLING = 16
+PERCENTILES = (50, 90, 99)
+
+seconds_size = SuffixMultiplier({'s': 1,
+                                 'm': 60,
+                                 'h': 60 * 60,
+                                 'd': 60 * 60 * 24
+                                 })
+
+def usage(exitstatus=255):
+    print(doc)
+    sys.exit(exitstatus)
+
+class Summary:
+    """Streaming summary of the samples of one program."""
+
+    def __init__(self):
+        self.count = 0
+        self.peak = -1
+        self.peak_time = None
+        self.buckets = {}
+
+    def add(self, when, usage):
+        self.count += 1
+        if usage > self.peak:
+            self.peak = usage
+            self.peak_time = when
+        bucket = int(math.log(max(usage, 1), 2) * BUCKETS_PER_DOUBLING)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+
+    def percentile(self, percent):
+        """Return the upper bound of the bucket holding the percentile,
+        capped at the peak."""
+        rank = math.ceil(self.count * percent / 100.0)
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                bound = 2 ** (float(bucket + 1) / BUCKETS_PER_DOUBLING)
+                return min(int(bound), self.peak)
+        return self.peak
+
+def summarize(path, since=None, patterns=None):
+    """Return a dict of namespec to Summary for the samples in the store
+    at path (including rotated files)."""
+    names = read_names(path)
+    paths = store_paths(path)
+    cutoff = None
+    if since is not None:
+        # the store is empty right after a rotation, so fall back to the
+        # newest rotated file
+        for p in reversed(paths):
+            newest = last_sample(p)
+            if newest is not None:
+                cutoff = newest[0] - since
+                break
+
+    wanted = {}
+    def is_wanted(namespec_id):
+        try:
+            return wanted[namespec_id]
+        except KeyError:
+            if namespec_id < len(names):
+                namespec = names[namespec_id]
+            else:
+                namespec = '#%d' % namespec_id
+            name = namespec.split(':', 1)[-1]
+            if patterns:
+                match = False
+                for pattern in patterns:
+                    if (fnmatch.fnmatchcase(namespec, pattern) or
+                        fnmatch.fnmatchcase(name, pattern)):
+                        match = True
+                        break
+            else:
+                match = True
+            wanted[namespec_id] = match and namespec
+            return wanted[namespec_id]
+
+    summaries = {}
+    for p in paths:
+        for when, pid, namespec_id, usage in iter_samples(p):
+            if cutoff is not None and when < cutoff:
+                continue
+            namespec = is_wanted(namespec_id)
+            if not namespec:
+                continue
+            summary = summaries.get(namespec)
+            if summary is None:
+                summary = summaries[namespec] = Summary()
+            summary.add(when, usage)
+    return summaries
+
+def format_size(size):
+    if size < 1024:
+        return '%dB' % size
+    for suffix in ('KB', 'MB', 'GB'):
+        size /= 1024.0
+        if size < 1024 or suffix == 'GB':
+            return '%.1f%s' % (size, suffix)
+
+def report(summaries, out):
+    columns = ['program', 'samples'] + ['p%d' % p for p in PERCENTILES] + \
+              ['peak', 'peak time']
+    rows = []
+    for namespec in sorted(summaries):
+        summary = summaries[namespec]
+        row = [namespec, str(summary.count)]
+        for percent in PERCENTILES:
+            row.append(format_size(summary.percentile(percent)))
+        row.append(format_size(summary.peak))
+        row.append(time.strftime('%Y-%m-%d %H:%M:%S',
+                                 time.localtime(summary.peak_time)))
+        rows.append(row)
+    widths = [max([len(columns[i])] + [len(row[i]) for row in rows])
+              for i in range(len(columns))]
+    for row in [columns] + rows:
+        cells = [row[0].ljust(widths[0])]
+        cells += [cell.rjust(width) for cell, width in
+                  zip(row[1:-1], widths[1:-1])]
+        cells.append(row[-1])
+        out.write('  '.join(cells).rstrip() + '\n')
+
+def main(argv=sys.argv):
+    short_args = "hs:p:"
+    long_args = [
+        "help",
+        "since=",
+        "program=",
+        ]
+    try:
+        opts, args = getopt.getopt(argv[1:], short_args, long_args)
+    except:
+        usage()
+
+    since = None
+    patterns = []
+    for option, value in opts:
+        if option in ('-h', '--help'):
+            usage(exitstatus=0)
+
+        if option in ('-s', '--since'):
+            try:
+                since = seconds_size(value)
+            except:
+                print('Unparseable value for time in %r for %s' % (value,
+                                                                   option))
+                usage()
+
+        if option in ('-p', '--program'):
+            patterns.append(value)
+
+    if len(args) != 1:
+        usage()
+
+    try:
+        summaries = summarize(args[0], since, patterns)
+    except (IOError, OSError, ValueError) as e:
+        sys.stderr.write('memmon-report: %s\n' % e)
+        sys.exit(1)
+    report(summaries, sys.stdout)
+
+if __name__ == '__main__':
+    main()
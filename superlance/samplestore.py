@@ -0,0 +1,194 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# An append-only, memory-mapped time series of memory samples, written by
+# memmon (--store) and read by memmon-report.
+#
+# A store file starts with a 16 byte header (magic, version and the number
+# of records written) followed by fixed-size records of
+# (timestamp, pid, namespec id, bytes).  Namespec ids index the lines of a
+# "<store>.names" file next to it, which is shared by all rotated files.
+# The file grows in chunks; when it would exceed its maximum size it is
+# renamed to "<store>.1" (after "<store>.1" is renamed to "<store>.2", and
+# so on) and a new file is started.
+
+import mmap
+import os
+import struct
+
+MAGIC = b'MMSS'
+VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+RECORD = struct.Struct('<dIIQ')
+GROWTH = 4096 * RECORD.size # grow the file by this many bytes at a time
+
+def names_path(path):
+    return path + '.names'
+
+def read_names(path):
+    try:
+        with open(names_path(path)) as f:
+            return [line.rstrip('\n') for line in f]
+    except (IOError, OSError):
+        return []
+
+def store_paths(path):
+    """Return the rotated files of a store, oldest first, followed by the
+    store itself."""
+    paths = [path]
+    i = 1
+    while os.path.exists('%s.%d' % (path, i)):
+        paths.insert(0, '%s.%d' % (path, i))
+        i += 1
+    return paths
+
+class SampleStore:
+    """Appends samples to a store file, rotating it when it reaches
+    max_size bytes and keeping `keep` rotated files."""
+
+    def __init__(self, path, max_size=64 * 1024 * 1024, keep=4):
+        self.path = path
+        self.max_size = max(max_size, HEADER.size + GROWTH)
+        self.keep = keep
+        self.names = {}
+        for i, namespec in enumerate(read_names(path)):
+            self.names[namespec] = i
+        self.names_file = open(names_path(path), 'a')
+        self.file = None
+        self.map = None
+        self.open()
+
+    def open(self):
+        if os.path.exists(self.path):
+            self.file = open(self.path, 'r+b')
+            header = self.file.read(HEADER.size)
+            try:
+                magic, version, count = HEADER.unpack(header)
+            except struct.error:
+                magic = version = None
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a memmon sample store' %
+                                 self.path)
+            size = os.fstat(self.file.fileno()).st_size
+            self.count = min(count, (size - HEADER.size) // RECORD.size)
+            self.map_file(size)
+        else:
+            self.file = open(self.path, 'w+b')
+            self.count = 0
+            self.map_file(HEADER.size + GROWTH)
+            self.commit()
+
+    def map_file(self, size):
+        if self.map is not None:
+            self.map.close()
+        self.file.truncate(size)
+        self.size = size
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def close(self):
+        if self.map is not None:
+            self.commit()
+            self.map.close()
+            self.map = None
+            # don't leave unused preallocated space behind
+            self.file.truncate(HEADER.size + self.count * RECORD.size)
+            self.file.close()
+            self.file = None
+        self.names_file.close()
+
+    def namespec_id(self, namespec):
+        try:
+            return self.names[namespec]
+        except KeyError:
+            i = self.names[namespec] = len(self.names)
+            self.names_file.write(namespec + '\n')
+            self.names_file.flush()
+            return i
+
+    def append(self, when, pid, namespec, usage):
+        if self.map is None:
+            # a rotation failed (e.g. on a full disk): try again
+            self.open()
+        offset = HEADER.size + self.count * RECORD.size
+        if offset + RECORD.size > self.size:
+            if self.size + GROWTH > self.max_size:
+                self.rotate()
+                offset = HEADER.size
+            else:
+                self.map_file(self.size + GROWTH)
+        RECORD.pack_into(self.map, offset, when, pid,
+                         self.namespec_id(namespec), usage)
+        self.count += 1
+
+    def commit(self):
+        """Make the records appended so far visible to readers."""
+        if self.map is None:
+            return
+        HEADER.pack_into(self.map, 0, MAGIC, VERSION, self.count)
+
+    def rotate(self):
+        self.commit()
+        self.map.close()
+        self.map = None
+        self.file.truncate(HEADER.size + self.count * RECORD.size)
+        self.file.close()
+        for i in range(self.keep, 0, -1):
+            older = '%s.%d' % (self.path, i)
+            if i == self.keep:
+                if os.path.exists(older):
+                    os.remove(older)
+            else:
+                if os.path.exists(older):
+                    os.rename(older, '%s.%d' % (self.path, i + 1))
+        if self.keep:
+            os.rename(self.path, '%s.1' % self.path)
+        else:
+            os.remove(self.path)
+        self.open()
+
+def last_sample(path):
+    """Return the last record in one store file, or None if it is empty."""
+    with open(path, 'rb') as f:
+        header = f.read(HEADER.size)
+        if len(header) < HEADER.size:
+            return None
+        magic, version, count = HEADER.unpack(header)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not a memmon sample store' % path)
+        size = os.fstat(f.fileno()).st_size
+        count = min(count, (size - HEADER.size) // RECORD.size)
+        if not count:
+            return None
+        f.seek(HEADER.size + (count - 1) * RECORD.size)
+        return RECORD.unpack(f.read(RECORD.size))
+
+def iter_samples(path):
+    """Yield (timestamp, pid, namespec id, bytes) for each record in one
+    store file, reading it through a memory map."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size < HEADER.size:
+            return
+        m = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+        try:
+            magic, version, count = HEADER.unpack_from(m, 0)
+            if magic != MAGIC or version != VERSION:
+                raise ValueError('%s is not a memmon sample store' % path)
+            count = min(count, (size - HEADER.size) // RECORD.size)
+            offset = HEADER.size
+            for i in range(count):
+                yield RECORD.unpack_from(m, offset)
+                offset += RECORD.size
+        finally:
+            m.close()
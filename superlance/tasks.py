@@ -0,0 +1,96 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Helpers for the work event listeners do besides answering supervisord:
+# calling a function on many items from a bounded number of threads, and
+# running shell commands which are killed if they take too long.
+
+import os
+import signal
+import subprocess
+import sys
+import threading
+
+from superlance.compat import queue
+
+# commands run in a session of their own, so that one which times out can
+# be killed along with anything it started.  preexec_fn isn't safe in a
+# program with threads, so it is only used where start_new_session doesn't
+# exist (Python 2)
+if sys.version_info >= (3, 2):
+    NEW_SESSION = {'start_new_session': True}
+else:
+    NEW_SESSION = {'preexec_fn': os.setsid}
+
+def run_all(func, items, concurrency):
+    """Call func on each item, at most concurrency at a time, and return
+    the results in the same order."""
+    if len(items) <= 1 or concurrency <= 1:
+        return [func(item) for item in items]
+    results = [None] * len(items)
+    jobs = queue.Queue()
+    for job in enumerate(items):
+        jobs.put(job)
+    def work():
+        while 1:
+            try:
+                i, item = jobs.get_nowait()
+            except queue.Empty:
+                return
+            results[i] = func(item)
+    threads = []
+    for n in range(min(concurrency, len(items))):
+        thread = threading.Thread(target=work)
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+    for thread in threads:
+        thread.join()
+    return results
+
+def run_command(cmd, timeout, input=None):
+    """Run the shell command cmd, writing input (bytes) to its stdin if
+    given, and kill it if it is still running after timeout seconds.
+    Returns (returncode, output, expired), where output is what it wrote
+    to stdout and stderr and expired is True if it was killed.  Raises
+    OSError if the command can't be started or its stdin written."""
+    stdin = None
+    if input is not None:
+        stdin = subprocess.PIPE
+    p = subprocess.Popen(cmd, shell=True, stdin=stdin,
+                         stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                         **NEW_SESSION)
+    expired = []
+    def kill():
+        expired.append(True)
+        try:
+            # the shell and anything it started
+            os.killpg(p.pid, signal.SIGKILL)
+        except OSError:
+            pass
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        try:
+            output = p.communicate(input)[0]
+        except (IOError, OSError):
+            p.wait()
+            if not expired:
+                raise
+            output = b''
+    finally:
+        timer.cancel()
+    if not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
+    return p.returncode, output, bool(expired)
@@ -0,0 +1,230 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Benchmarks memmon's check loop against synthetic process tables.  Not
+# collected by the test runner; run it with
+#
+#   python -m superlance.tests.bench_memmon [options]
+
+doc = """\
+python -m superlance.tests.bench_memmon [-p counts] [-t ticks] [-s sources]
+                                       [-c children]
+
+Options:
+
+-p -- comma separated numbers of supervisor processes to benchmark with.
+      Default is 10,100,1000,10000.
+
+-t -- the number of ticks to time for each configuration.  Default is 5.
+
+-s -- comma separated process table sources: 'procfs' (a fake /proc
+      directory of statm and stat files) and 'ps' (fake ps commands which
+      print canned output).  Default is procfs,ps.  Flat 'ps' mode starts
+      one shell per process per tick, like memmon does.
+
+-c -- the number of child processes each supervisor process has in the
+      fake process table, which cumulative (-c) mode sums up.  Default 2.
+
+For each source, process count and mode (flat or cumulative), this
+prints the number of ticks per second memmon handles, and the peak
+memory allocated by Python during one tick (where tracemalloc is
+available, i.e. Python 3.4 and later).  Every process is measured and
+none are over the limit, so no restarts are made.  Nothing is sent to
+a real supervisord; the processes come from tests/dummy.py.
+"""
+
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+try:
+    import tracemalloc
+except ImportError: # Python 2
+    tracemalloc = None
+
+from supervisor.states import ProcessStates
+
+from superlance.compat import StringIO
+from superlance.compat import maxint
+from superlance.memmon import Memmon
+from superlance.tests.dummy import DummyRPCServer
+
+FIRST_PID = 1000
+STAT = '%d (proc) S %d' + ' 0' * 19 + ' %d 0 0\n'
+
+def usage(exitstatus=255):
+    print(doc)
+    sys.exit(exitstatus)
+
+def make_infos(count):
+    now = time.time()
+    infos = []
+    for i in range(count):
+        infos.append({
+            'name': 'proc_%05d' % i,
+            'group': 'bench_%d' % (i % 10),
+            'pid': FIRST_PID + i,
+            'state': ProcessStates.RUNNING,
+            'statename': 'RUNNING',
+            'start': now - 3600,
+            'now': now,
+            'stop': 0,
+            'spawnerr': '',
+            'exitstatus': 0,
+            'stdout_logfile': '/dev/null',
+            'stderr_logfile': '/dev/null',
+            'description': 'bench',
+            })
+    return infos
+
+def make_table(count, children):
+    """Return (pid, ppid, pages) for each supervisor process and its
+    children."""
+    table = []
+    next_pid = FIRST_PID + count
+    for i in range(count):
+        pid = FIRST_PID + i
+        table.append((pid, 1, 1000 + i))
+        for j in range(children):
+            table.append((next_pid, pid, 100 + j))
+            next_pid += 1
+    return table
+
+def make_procdir(path, table):
+    for pid, ppid, pages in table:
+        piddir = os.path.join(path, str(pid))
+        os.mkdir(piddir)
+        with open(os.path.join(piddir, 'statm'), 'w') as f:
+            f.write('%d %d 0 0 0 0 0\n' % (pages * 2, pages))
+        with open(os.path.join(piddir, 'stat'), 'w') as f:
+            f.write(STAT % (pid, ppid, pages))
+
+def make_pstree(path, table):
+    with open(path, 'w') as f:
+        for pid, ppid, pages in table:
+            f.write('%d %d %d\n' % (pid, ppid, pages * 4))
+
+def make_memmon(infos, cumulative, source, tmpdir):
+    memmon = Memmon(cumulative=cumulative, programs={}, groups={},
+                    any=maxint, sendmail=None, email=None,
+                    email_uptime_limit=maxint, name=None,
+                    rpc=DummyRPCServer())
+    memmon.rpc.supervisor.all_process_info = infos
+    memmon.stdout = StringIO()
+    memmon.stderr = StringIO()
+    if source == 'procfs':
+        memmon.procdir = os.path.join(tmpdir, 'proc')
+    else:
+        memmon.procdir = None
+        memmon.pscommand = 'echo %s'
+        memmon.pstreecommand = 'cat %s' % os.path.join(tmpdir, 'pstree')
+    return memmon
+
+def tick(memmon):
+    memmon.stdin = StringIO('eventname:TICK_60 len:0\n')
+    memmon.stdout.seek(0)
+    memmon.stdout.truncate()
+    memmon.stderr.seek(0)
+    memmon.stderr.truncate()
+    memmon.runforever(test=True)
+
+def bench(memmon, ticks):
+    """Return (ticks per second, peak bytes allocated during one tick or
+    None)."""
+    tick(memmon) # warm up caches (e.g. the threshold lookup)
+    started = time.time()
+    for i in range(ticks):
+        tick(memmon)
+    elapsed = time.time() - started
+    peak = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        try:
+            tick(memmon)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return ticks / elapsed, peak
+
+def run(counts, ticks, sources, children, out):
+    out.write('%-7s %-11s %9s %11s %13s\n' % (
+        'source', 'mode', 'processes', 'ticks/s', 'peak KB/tick'))
+    for count in counts:
+        tmpdir = tempfile.mkdtemp()
+        try:
+            table = make_table(count, children)
+            infos = make_infos(count)
+            if 'procfs' in sources:
+                os.mkdir(os.path.join(tmpdir, 'proc'))
+                make_procdir(os.path.join(tmpdir, 'proc'), table)
+            if 'ps' in sources:
+                make_pstree(os.path.join(tmpdir, 'pstree'), table)
+            for source in sources:
+                for cumulative in (False, True):
+                    memmon = make_memmon(infos, cumulative, source, tmpdir)
+                    rate, peak = bench(memmon, ticks)
+                    if peak is None:
+                        peak = 'n/a'
+                    else:
+                        peak = '%d' % (peak // 1024)
+                    out.write('%-7s %-11s %9d %11.2f %13s\n' % (
+                        source, cumulative and 'cumulative' or 'flat',
+                        count, rate, peak))
+                    out.flush()
+        finally:
+            shutil.rmtree(tmpdir)
+
+def parse_list(option, value, choices=None):
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    if choices is None:
+        try:
+            return [int(item) for item in items]
+        except ValueError:
+            print('%r for %r must be comma separated integers' % (value,
+                                                                 option))
+            usage()
+    for item in items:
+        if item not in choices:
+            print('Unknown %r for %r (expected %s)' % (item, option,
+                                                      ', '.join(choices)))
+            usage()
+    return items
+
+def main(argv=sys.argv):
+    try:
+        opts, args = getopt.getopt(argv[1:], 'hp:t:s:c:')
+    except getopt.GetoptError:
+        usage()
+    counts = [10, 100, 1000, 10000]
+    ticks = 5
+    sources = ['procfs', 'ps']
+    children = 2
+    for option, value in opts:
+        if option == '-h':
+            usage(exitstatus=0)
+        if option == '-p':
+            counts = parse_list(option, value)
+        if option == '-t':
+            ticks = max(parse_list(option, value)[0], 1)
+        if option == '-s':
+            sources = parse_list(option, value, ('procfs', 'ps'))
+        if option == '-c':
+            children = parse_list(option, value)[0]
+    run(counts, ticks, sources, children, sys.stdout)
+
+if __name__ == '__main__':
+    main()
@@ -12,8 +12,15 @@ class DummyResponse:
     status = 200
     reason = 'OK'
     body = 'OK'
-    def read(self):
-        return self.body
+    position = 0
+    def read(self, amt=None):
+        if amt is None:
+            amt = len(self.body)
+        data = self.body[self.position:self.position + amt]
+        self.position += len(data)
+        return data
+    def isclosed(self):
+        return self.position >= len(self.body)
 
 class DummySystemRPCNamespace:
     pass
@@ -0,0 +1,129 @@
+import gzip
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+# writes 64KB of zeros to <name>.<pid>, like gdb's gcore -o
+GCORE = '''#!/bin/sh
+sleep %s
+head -c 65536 /dev/zero > "$1.$2"
+echo "Saved corefile $1.$2"
+'''
+
+# waits (up to 5 seconds) until <count> gcores have started, and reports how
+# many had started
+OVERLAPPING_GCORE = '''#!/bin/sh
+touch "%(markers)s/$2"
+i=0
+while [ $(ls "%(markers)s" | wc -l) -lt %(count)d ] && [ $i -lt 50 ]; do
+    sleep 0.1
+    i=$((i+1))
+done
+echo $(ls "%(markers)s" | wc -l) running
+head -c 65536 /dev/zero > "$1.$2"
+'''
+
+class CoreDumperTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.coredir = os.path.join(self.tempdir, 'cores')
+        os.mkdir(self.coredir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _makeGcore(self, delay=0):
+        path = os.path.join(self.tempdir, 'gcore')
+        with open(path, 'w') as f:
+            f.write(GCORE % delay)
+        os.chmod(path, 0o755)
+        return path
+
+    def _makeOne(self, gcore, **kwargs):
+        from superlance.coredump import CoreDumper
+        return CoreDumper(gcore, self.coredir, **kwargs)
+
+    def _makeSpecs(self, count):
+        return [{'name': 'web_%02d' % i, 'group': 'web', 'pid': 100 + i}
+                for i in range(count)]
+
+    def test_dump_all(self):
+        dumper = self._makeOne(self._makeGcore())
+        dumps = dumper.dump_all(self._makeSpecs(2))
+        expected = [os.path.join(self.coredir, 'web:web_00.100'),
+                    os.path.join(self.coredir, 'web:web_01.101')]
+        self.assertEqual(dumps, [
+            ('Saved corefile %s\n' % expected[0], [expected[0]]),
+            ('Saved corefile %s\n' % expected[1], [expected[1]])])
+
+    def test_dump_all_concurrently(self):
+        markers = os.path.join(self.tempdir, 'markers')
+        os.mkdir(markers)
+        path = os.path.join(self.tempdir, 'gcore')
+        with open(path, 'w') as f:
+            f.write(OVERLAPPING_GCORE % {'markers': markers, 'count': 4})
+        os.chmod(path, 0o755)
+        dumper = self._makeOne(path, concurrency=4)
+        dumps = dumper.dump_all(self._makeSpecs(4))
+        self.assertEqual([output for output, paths in dumps],
+                         ['4 running\n'] * 4)
+        self.assertEqual([len(paths) for output, paths in dumps],
+                         [1, 1, 1, 1])
+
+    def test_dump_timeout(self):
+        dumper = self._makeOne(self._makeGcore(10), timeout=0.2)
+        started = time.time()
+        output, paths = dumper.dump(self._makeSpecs(1)[0])
+        self.assertTrue(time.time() - started < 5)
+        self.assertEqual(output,
+                         '\ngcore timed out after 0.2 seconds, core removed')
+        self.assertEqual(paths, [])
+
+    def test_dump_ignores_old_core(self):
+        old = os.path.join(self.coredir, 'web:web_00.100')
+        with open(old, 'w') as f:
+            f.write('old')
+        os.utime(old, (0, 0))
+        dumper = self._makeOne('true')
+        self.assertEqual(dumper.dump(self._makeSpecs(1)[0]), ('', []))
+
+    def test_store_compresses(self):
+        dumper = self._makeOne(self._makeGcore())
+        output, paths = dumper.dump(self._makeSpecs(1)[0])
+        messages = []
+        stored = dumper.store(paths, messages.append)
+        self.assertEqual(stored, [paths[0] + '.gz'])
+        self.assertEqual(messages, ['Wrote core %s.gz' % paths[0]])
+        self.assertFalse(os.path.exists(paths[0]))
+        with gzip.open(stored[0], 'rb') as f:
+            self.assertEqual(f.read(), b'\0' * 65536)
+
+    def test_store_evicts_oldest(self):
+        for i, name in enumerate(['b.gz', 'a.gz', 'other']):
+            path = os.path.join(self.coredir, name)
+            with open(path, 'wb') as f:
+                f.write(b'x' * 1000)
+            os.utime(path, (1000 + i, 1000 + i))
+        new = os.path.join(self.coredir, 'new')
+        with open(new, 'wb') as f:
+            f.write(os.urandom(1000)) # doesn't compress
+        dumper = self._makeOne('true', max_size=2500)
+        messages = []
+        dumper.store([new], messages.append)
+        self.assertEqual(sorted(os.listdir(self.coredir)),
+                         ['a.gz', 'new.gz', 'other'])
+        self.assertEqual(messages[1],
+                         'Removed old core %s (the cores in %s are limited '
+                         'to 2500 bytes)' % (os.path.join(self.coredir,
+                                                          'b.gz'),
+                                             self.coredir))
+
+    def test_store_keeps_new_cores_over_limit(self):
+        new = os.path.join(self.coredir, 'new')
+        with open(new, 'wb') as f:
+            f.write(os.urandom(1000))
+        dumper = self._makeOne('true', max_size=10)
+        dumper.store([new], [].append)
+        self.assertEqual(os.listdir(self.coredir), ['new.gz'])
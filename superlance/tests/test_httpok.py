@@ -1,4 +1,5 @@
 import socket
+import threading
 import time
 import unittest
 from superlance.compat import StringIO
@@ -52,6 +53,9 @@ def make_connection(response, exc=None):
         def getresponse(self):
             return response
 
+        def close(self):
+            pass
+
     return TestConnection
 
 class HTTPOkTests(unittest.TestCase):
@@ -65,7 +69,8 @@ class HTTPOkTests(unittest.TestCase):
     def _makeOnePopulated(self, programs, any=None, statuses=None, inbody=None,
                           eager=True, gcore=None, coredir=None,
                           response=None, exc=None, name=None,
-                          timeout=10, retry_time=0):
+                          timeout=10, retry_time=0, failures=1, p95=None,
+                          p99=None, latency_window=20):
         if statuses is None:
             statuses = [200]
         if response is None:
@@ -85,6 +90,10 @@ class HTTPOkTests(unittest.TestCase):
             email='chrism@plope.com',
             sendmail='cat - > /dev/null',
             retry_time=retry_time,
+            failures=failures,
+            p95=p95,
+            p99=p99,
+            latency_window=latency_window,
             )
         httpok.stdin = StringIO()
         httpok.stdout = StringIO()
@@ -314,6 +323,45 @@ class HTTPOkTests(unittest.TestCase):
         self.assertEqual(mailed[1],
                     'Subject: httpok: http://foo/bar: bad status returned')
 
+    def test_runforever_gcore_all_then_restart(self):
+        import os
+        import shutil
+        import tempfile
+        coredir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, coredir)
+        markers = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, markers)
+        # each gcore waits (up to 5 seconds) for the other to start, and
+        # reports how many were running at once
+        gcore = os.path.join(markers, 'gcore')
+        with open(gcore, 'w') as f:
+            f.write('#!/bin/sh\n'
+                    'touch "%(markers)s/$2"\n'
+                    'i=0\n'
+                    'while [ $(ls "%(markers)s" | wc -l) -lt 3 ] && '
+                    '[ $i -lt 50 ]; do sleep 0.1; i=$((i+1)); done\n'
+                    'echo $(($(ls "%(markers)s" | wc -l) - 1)) running\n'
+                    'echo core > "$1.$2"\n' % {'markers': markers})
+        os.chmod(gcore, 0o755)
+        prog = self._makeOnePopulated(['web_00', 'web_01'], exc=True,
+                                      gcore=gcore, coredir=coredir)
+        self._makeWorkers(prog, 2)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = [x for x in prog.stderr.getvalue().split('\n') if x]
+        self.assertEqual(lines[1], 'gcore output for web:web_00:')
+        self.assertEqual(lines[2], ' 2 running')
+        self.assertEqual(lines[6], ' 2 running')
+        self.assertEqual(lines[3], 'web:web_00 is in RUNNING state, '
+                         'restarting')
+        self.assertEqual(lines[5], 'gcore output for web:web_01:')
+        self.assertEqual(sorted(lines[9:11]), [
+            'Wrote core %s' % os.path.join(coredir, 'web:web_00.100.gz'),
+            'Wrote core %s' % os.path.join(coredir, 'web:web_01.101.gz')])
+        self.assertEqual(sorted(os.listdir(coredir)),
+                         ['web:web_00.100.gz', 'web:web_01.101.gz'])
+
     def test_runforever_not_eager_none_running(self):
         programs = ['bar', 'baz_01']
         any = None
@@ -346,17 +394,30 @@ class HTTPOkTests(unittest.TestCase):
         self.assertEqual(mailed[1],
                     'Subject: httpok: http://foo/bar: bad status returned')
 
+    def _fakeTime(self, prog):
+        """Make prog sleep on a fake clock; returns the list of sleeps."""
+        now = [0]
+        sleeps = []
+        def sleep(seconds):
+            sleeps.append(seconds)
+            now[0] += seconds
+        prog.clock = lambda: now[0]
+        prog.sleep = sleep
+        return sleeps
+
     def test_runforever_honor_timeout_on_connrefused(self):
         programs = ['foo', 'bar']
         any = None
         error = socket.error()
         error.errno = 111
         prog = self._makeOnePopulated(programs, any, exc=[error], eager=False)
+        sleeps = self._fakeTime(prog)
         prog.stdin.write('eventname:TICK len:0\n')
         prog.stdin.seek(0)
         prog.runforever(test=True)
         self.assertEqual(prog.stderr.getvalue(), '')
         self.assertEqual(prog.stdout.getvalue(), 'READY\nRESULT 2\nOK')
+        self.assertEqual(len(sleeps), 1)
 
     def test_runforever_connrefused_error(self):
         programs = ['foo', 'bar']
@@ -364,7 +425,8 @@ class HTTPOkTests(unittest.TestCase):
         error = socket.error()
         error.errno = 111
         prog = self._makeOnePopulated(programs, any,
-            exc=[error for x in range(100)], eager=False)
+            exc=[error for x in range(100)], eager=False, retry_time=1)
+        sleeps = self._fakeTime(prog)
         prog.stdin.write('eventname:TICK len:0\n')
         prog.stdin.seek(0)
         prog.runforever(test=True)
@@ -380,6 +442,58 @@ class HTTPOkTests(unittest.TestCase):
         self.assertEqual(mailed[0], 'To: chrism@plope.com')
         self.assertEqual(mailed[1],
                     'Subject: httpok: http://foo/bar: bad status returned')
+        # exponential backoff with jitter, until the 10 second timeout
+        self.assertTrue(3 <= len(sleeps) <= 5)
+        for i, seconds in enumerate(sleeps[:-1]):
+            self.assertTrue(2 ** i * 0.5 <= seconds <= 2 ** i)
+        self.assertAlmostEqual(sum(sleeps), 10)
+
+    def test_runforever_connrefused_retry_count_is_bounded(self):
+        error = socket.error()
+        error.errno = 111
+        prog = self._makeOnePopulated(programs=['foo'],
+            exc=[error for x in range(100)], eager=False, retry_time=0)
+        sleeps = self._fakeTime(prog)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertTrue(sleeps[0] >= 0.05)
+        self.assertTrue(len(sleeps) < 12)
+
+    def test_runforever_acks_tick_before_checking(self):
+        prog = self._makeOnePopulated(programs=['foo'])
+        acked = []
+        class SlowConnection(prog.connclass):
+            def getresponse(self):
+                # wait for the listener to acknowledge the TICK
+                for i in range(100):
+                    if prog.stdout.getvalue().endswith('OK'):
+                        break
+                    time.sleep(0.01)
+                acked.append(prog.stdout.getvalue().endswith('OK'))
+                return DummyResponse()
+        prog.connclass = SlowConnection
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(acked, [True])
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def test_runforever_skips_tick_while_checking(self):
+        prog = self._makeOnePopulated(programs=['foo'])
+        class Running:
+            def is_alive(self):
+                return True
+            def join(self):
+                pass
+        prog.round = Running()
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(prog.stderr.getvalue(),
+                         'Still checking the URLs from the previous tick, '
+                         'skipping this one\n')
+        self.assertEqual(prog.stdout.getvalue(), 'READY\nRESULT 2\nOK')
 
     def test_bug_110(self):
         error = socket.error()
@@ -387,6 +501,7 @@ class HTTPOkTests(unittest.TestCase):
         prog = self._makeOnePopulated(programs=['foo'], any=None,
             exc=[error for x in range(100)], eager=False,
                                       timeout=1, retry_time=10)
+        sleeps = self._fakeTime(prog)
         prog.stdin.write('eventname:TICK len:0\n')
         prog.stdin.seek(0)
         prog.runforever(test=True)
@@ -396,6 +511,480 @@ class HTTPOkTests(unittest.TestCase):
                          )
         self.assertEqual(lines[1], 'foo is in RUNNING state, restarting')
         self.assertEqual(lines[2], 'foo restarted')
+        # the retry doesn't wait past the timeout
+        self.assertEqual(sleeps, [1])
+
+    def test_runforever_reuses_connection_across_ticks(self):
+        response = DummyResponse()
+        response.will_close = False
+        prog = self._makeOnePopulated(programs=['foo'], response=response)
+        connclass = prog.connclass
+        made = []
+        class DummySocket:
+            def settimeout(self, timeout):
+                self.timeout = timeout
+        def connect(hostport):
+            conn = connclass(hostport)
+            conn.sock = DummySocket()
+            made.append(conn)
+            return conn
+        prog.connclass = connect
+        prog.stdin.write('eventname:TICK len:0\n' * 2)
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        prog.runforever(test=True)
+        self.assertEqual(len(made), 1)
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def _makeChecks(self, *specs):
+        from superlance.httpok import Check
+        return [Check(url, programs, False, 10, [200], None)
+                for url, programs in specs]
+
+    def _makeHostConnection(self, responses):
+        """Return a connection class answering with responses[hostport]."""
+        class HostConnection:
+            def __init__(self, hostport):
+                self.hostport = hostport
+
+            def request(self, method, path, headers):
+                pass
+
+            def getresponse(self):
+                return responses[self.hostport]
+
+            def close(self):
+                pass
+        return HostConnection
+
+    def test_runforever_checks_act_on_failed_check_only(self):
+        bad = DummyResponse()
+        bad.status = 500
+        bad.reason = 'Internal Server Error'
+        prog = self._makeOnePopulated(programs=['foo'])
+        prog.checks.extend(self._makeChecks(
+            ('http://one/ok', ['bar']), ('http://two/bad', ['baz_01'])))
+        prog.connclass = self._makeHostConnection({
+            'foo': DummyResponse(), 'one': DummyResponse(), 'two': bad})
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes "
+                         "['baz_01']")
+        self.assertEqual(lines[1],
+                         'baz:baz_01 not in RUNNING state, NOT restarting')
+        self.assertEqual(prog.mailed.split('\n')[1],
+                         'Subject: httpok: http://two/bad: '
+                         'bad status returned')
+
+    def _makeGatedConnection(self, expected, wait=5):
+        """Return a connection class whose responses wait until expected
+        requests are in flight at once (or wait seconds have passed), and
+        a list holding the most requests seen in flight at once."""
+        cond = threading.Condition()
+        running = [0]
+        peak = [0]
+        class GatedConnection:
+            def __init__(self, hostport):
+                self.hostport = hostport
+
+            def request(self, method, path, headers):
+                pass
+
+            def getresponse(self):
+                with cond:
+                    running[0] += 1
+                    peak[0] = max(peak[0], running[0])
+                    cond.notify_all()
+                    deadline = time.time() + wait
+                    while peak[0] < expected and time.time() < deadline:
+                        cond.wait(deadline - time.time())
+                    running[0] -= 1
+                return DummyResponse()
+
+            def close(self):
+                pass
+        return GatedConnection, peak
+
+    def test_runforever_checks_concurrently(self):
+        # every due URL is checked at once by default
+        prog = self._makeOnePopulated(programs=['foo'])
+        prog.checks.extend(self._makeChecks(
+            *[('http://host%d/' % i, ['foo']) for i in range(15)]))
+        prog.connclass, peak = self._makeGatedConnection(16)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(peak[0], 16)
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def test_runforever_checks_concurrency_limit(self):
+        prog = self._makeOnePopulated(programs=['foo'])
+        prog.checks.extend(self._makeChecks(
+            *[('http://host%d/' % i, ['foo']) for i in range(5)]))
+        prog.concurrency = 2
+        # would let a third request through if there were one
+        prog.connclass, peak = self._makeGatedConnection(3, wait=0.1)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(peak[0], 2)
+
+    def test_read_checks(self):
+        import os
+        import tempfile
+        from superlance.httpok import read_checks
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('[check:one]\n'
+                    'url = http://localhost:8080/one\n'
+                    'programs = web_01, web:web_02\n'
+                    'timeout = 3\n'
+                    'codes = 200 204\n'
+                    '\n'
+                    '[check:two]\n'
+                    'url = https://localhost:8443/two?x=1\n'
+                    'body = OK\n'
+                    'eager = false\n'
+                    'max_body = 64KB\n')
+        checks = read_checks(path, dict(
+            programs=['default'], any=False, timeout=10, statuses=[200],
+            inbody=None, eager=True))
+        self.assertEqual(len(checks), 2)
+        one, two = checks
+        self.assertEqual(one.programs, ['web_01', 'web:web_02'])
+        self.assertEqual(one.timeout, 3)
+        self.assertEqual(one.statuses, [200, 204])
+        self.assertEqual(one.inbody, None)
+        self.assertEqual(one.eager, True)
+        self.assertEqual(two.programs, ['default'])
+        self.assertEqual(two.timeout, 10)
+        self.assertEqual(two.statuses, [200])
+        self.assertEqual(two.inbody, 'OK')
+        self.assertEqual(two.eager, False)
+        self.assertEqual(one.method, 'GET')
+        self.assertEqual(one.max_body, 1024 * 1024)
+        self.assertEqual(two.max_body, 64 * 1024)
+        self.assertEqual((two.scheme, two.hostport, two.path),
+                         ('https', 'localhost:8443', '/two?x=1'))
+
+        with open(path, 'w') as f:
+            f.write('[check:one]\nprograms = foo\n')
+        self.assertRaises(ValueError, read_checks, path, dict(
+            programs=[], any=False, timeout=10, statuses=[200], inbody=None))
+
+    def test_read_checks_failure_options(self):
+        import os
+        import tempfile
+        from superlance.httpok import read_checks
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as f:
+            f.write('[check:one]\n'
+                    'url = http://localhost:8080/one\n'
+                    'failures = 3\n'
+                    'window = 5\n'
+                    '\n'
+                    '[check:two]\n'
+                    'url = http://localhost:8080/two\n')
+        one, two = read_checks(path, dict(
+            programs=['default'], any=False, timeout=10, statuses=[200],
+            inbody=None, cooldown=60))
+        self.assertEqual((one.failures, one.window, one.cooldown),
+                         (3, 5, 60))
+        self.assertEqual((two.failures, two.window, two.cooldown),
+                         (1, 0, 60))
+        one.programs.append('other')
+        self.assertEqual(two.programs, ['default'])
+
+    def _makeCheck(self, **kwargs):
+        from superlance.httpok import Check
+        return Check('http://foo/bar', ['foo'], False, 10, [200], None,
+                     **kwargs)
+
+    def test_check_record_default_acts_on_first_failure(self):
+        check = self._makeCheck()
+        self.assertEqual(check.record(True, 0), (True, None))
+        self.assertEqual(check.record(True, 1), (True, None))
+
+    def test_check_record_failures_in_a_row(self):
+        check = self._makeCheck(failures=3)
+        self.assertEqual(check.record(True, 0),
+                         (False, '1 of the last 1 checks failed, 3 needed'))
+        self.assertEqual(check.record(True, 1)[0], False)
+        self.assertEqual(check.record(False, 2), (False, None))
+        self.assertEqual(check.record(True, 3)[0], False)
+        self.assertEqual(check.record(True, 4)[0], False)
+        self.assertEqual(check.record(True, 5), (True, None))
+        # the count starts over after acting
+        self.assertEqual(check.record(True, 6)[0], False)
+
+    def test_check_record_failures_in_window(self):
+        check = self._makeCheck(failures=3, window=5)
+        for now, failed in enumerate([True, False, True, False]):
+            self.assertEqual(check.record(failed, now)[0], False)
+        self.assertEqual(check.record(True, 4), (True, None))
+
+    def test_check_record_failures_outside_window(self):
+        check = self._makeCheck(failures=2, window=3)
+        self.assertEqual(check.record(True, 0)[0], False)
+        self.assertEqual(check.record(False, 1)[0], False)
+        self.assertEqual(check.record(False, 2)[0], False)
+        self.assertEqual(check.record(True, 3)[0], False)
+
+    def test_check_record_cooldown(self):
+        check = self._makeCheck(cooldown=60)
+        self.assertEqual(check.record(True, 0), (True, None))
+        self.assertEqual(check.record(True, 30),
+                         (False, 'restarted 30 seconds ago, cooling down '
+                          'for 30 more seconds'))
+        # still failing after the cool-down: restart, then wait twice as long
+        self.assertEqual(check.record(True, 60), (True, None))
+        self.assertEqual(check.record(True, 179)[0], False)
+        self.assertEqual(check.record(True, 180), (True, None))
+        self.assertEqual(check.open_until, 180 + 240)
+        # a success after the cool-down resets it
+        self.assertEqual(check.record(False, 420), (False, None))
+        self.assertEqual(check.record(True, 421), (True, None))
+        self.assertEqual(check.open_until, 421 + 60)
+
+    def test_check_record_cooldown_is_capped(self):
+        check = self._makeCheck(cooldown=10)
+        now = 0
+        for i in range(10):
+            self.assertEqual(check.record(True, now), (True, None))
+            now = check.open_until
+        self.assertEqual(check.backoff, 160)
+
+    def test_runforever_waits_for_failures(self):
+        response = DummyResponse()
+        response.status = 500
+        response.reason = 'Internal Server Error'
+        prog = self._makeOnePopulated(programs=['foo'], response=response,
+                                      failures=2)
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(prog.stderr.getvalue(),
+                         'http://foo/bar failed, not restarting: '
+                         '1 of the last 1 checks failed, 2 needed\n')
+        prog.stderr = StringIO()
+        prog.stdin = StringIO('eventname:TICK len:0\n')
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+
+    def test_latency_histogram_quantiles(self):
+        from superlance.httpok import LatencyHistogram
+        histogram = LatencyHistogram(window=100)
+        self.assertEqual(histogram.quantile(0.95), None)
+        for i in range(90):
+            histogram.add(0.015) # the 10ms-20ms bucket
+        for i in range(10):
+            histogram.add(4) # the 2s-5s bucket
+        self.assertEqual(histogram.quantile(0.5), 0.01 + 0.01 * 50 / 90)
+        self.assertEqual(histogram.quantile(0.9), 0.02)
+        self.assertEqual(histogram.quantile(0.95), 2 + 3 * 5 / 10.0)
+        self.assertEqual(histogram.quantile(1), 5)
+        histogram.add(1000)
+        self.assertEqual(histogram.quantile(1), 100)
+
+    def test_latency_histogram_window(self):
+        from superlance.httpok import LatencyHistogram
+        histogram = LatencyHistogram(window=3)
+        for seconds in (4, 4, 4, 0.015, 0.015):
+            histogram.add(seconds)
+        self.assertEqual(len(histogram), 3)
+        self.assertTrue(histogram.full())
+        self.assertEqual(sum(histogram.counts), 3)
+        self.assertAlmostEqual(histogram.quantile(0.5), 0.0175)
+        histogram.clear()
+        self.assertEqual(len(histogram), 0)
+        self.assertFalse(histogram.full())
+
+    def _makeSlowClock(self, prog, seconds):
+        # every probe takes `seconds`
+        times = []
+        def clock():
+            times.append(len(times) * seconds)
+            return times[-1]
+        prog.clock = clock
+
+    def _tick(self, prog):
+        prog.stdin = StringIO('eventname:TICK len:0\n')
+        prog.stderr = StringIO()
+        prog.runforever(test=True)
+        return prog.stderr.getvalue()
+
+    def test_runforever_acts_on_slow_responses(self):
+        prog = self._makeOnePopulated(programs=['foo'], p95=2,
+                                      latency_window=3)
+        self._makeSlowClock(prog, 4)
+        # not acted on until the window is full
+        self.assertEqual(self._tick(prog), '')
+        self.assertEqual(self._tick(prog), '')
+        lines = self._tick(prog).split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes ['foo']")
+        mailed = prog.mailed.split('\n')
+        self.assertEqual(mailed[1],
+                         'Subject: httpok: http://foo/bar: slow responses')
+        self.assertEqual(mailed[3], 'latency of http://foo/bar: '
+                         'p95 4.850s is over 2.000s')
+        self.assertEqual(mailed[5], 'response times of http://foo/bar: '
+                         'p50 3.500s, p95 4.850s, p99 4.970s over the last '
+                         '3 checks')
+        # the window starts over after a restart
+        self.assertEqual(len(prog.checks[0].latency), 0)
+
+    def test_runforever_doesnt_act_on_fast_responses(self):
+        prog = self._makeOnePopulated(programs=['foo'], p95=2, p99=5,
+                                      latency_window=3)
+        self._makeSlowClock(prog, 0.1)
+        for i in range(5):
+            self.assertEqual(self._tick(prog), '')
+        self.assertEqual(len(prog.checks[0].latency), 3)
+
+    def test_expand_url(self):
+        from superlance.httpok import expand_url
+        spec = {'name': 'web_07', 'group': 'web'}
+        self.assertEqual(
+            expand_url('http://localhost:%(port)d/%(group_name)s/'
+                       '%(process_name)s/%(process_num)02d', spec, 8000),
+            'http://localhost:8007/web/web_07/07')
+        self.assertEqual(expand_url('http://%(process_name)s/',
+                                    {'name': 'web', 'group': 'web'}),
+                         'http://web/')
+        self.assertRaises(ValueError, expand_url,
+                          'http://localhost:%(port)d/', spec)
+        self.assertRaises(ValueError, expand_url, 'http://%(host)s/', spec)
+        self.assertRaises(ValueError, expand_url,
+                          'http://%(process_name)d/', spec)
+
+    def _makeWorkers(self, prog, count, stopped=()):
+        infos = []
+        for i in range(count):
+            name = 'web_%02d' % i
+            state = ProcessStates.RUNNING
+            if name in stopped:
+                state = ProcessStates.STOPPED
+            infos.append({'name': name, 'group': 'web', 'pid': 100 + i,
+                          'state': state})
+        prog.rpc.supervisor.all_process_info = infos
+
+    def test_runforever_per_process_restarts_failed_worker_only(self):
+        bad = DummyResponse()
+        bad.status = 500
+        bad.reason = 'Internal Server Error'
+        prog = self._makeOnePopulated(programs=[])
+        from superlance.httpok import Check
+        prog.checks = [Check('http://localhost:%(port)d/health', ['web:*'],
+                             False, 10, [200], None, port_base=8000)]
+        self._makeWorkers(prog, 3, stopped=['web_02'])
+        prog.connclass = self._makeHostConnection({
+            'localhost:8000': DummyResponse(), 'localhost:8001': bad})
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertEqual(lines[0], "Restarting selected processes "
+                         "['web:web_01']")
+        self.assertEqual(lines[1], 'web:web_01 is in RUNNING state, '
+                         'restarting')
+        self.assertEqual(lines[2], 'web:web_01 restarted')
+        self.assertEqual(prog.mailed.split('\n')[1],
+                         'Subject: httpok: http://localhost:8001/health: '
+                         'bad status returned')
+        self.assertEqual(sorted(prog.checks[0].workers),
+                         ['web:web_00', 'web:web_01', 'web:web_02'])
+
+    def test_check_expand_keeps_worker_state(self):
+        from superlance.httpok import Check
+        check = Check('http://localhost:%(port)d/', [], True, 10, [200],
+                      None, failures=2, port_base=8000)
+        prog = self._makeOnePopulated(programs=[])
+        self._makeWorkers(prog, 2)
+        specs = prog.rpc.supervisor.all_process_info
+        first = check.expand(specs)
+        self.assertEqual([worker.url for worker in first],
+                         ['http://localhost:8000/', 'http://localhost:8001/'])
+        self.assertEqual(first[0].programs, ['web:web_00'])
+        self.assertEqual(first[0].failures, 2)
+        self.assertEqual(first[0].any, False)
+        self.assertEqual(check.expand(specs), first)
+        self.assertEqual(check.expand(specs[1:]), first[1:])
+        self.assertEqual(list(check.workers), ['web:web_01'])
+
+    def _searchBody(self, body, search, limit, chunk_size):
+        from superlance import httpok
+        response = DummyResponse()
+        response.body = body
+        old, httpok.CHUNK_SIZE = httpok.CHUNK_SIZE, chunk_size
+        try:
+            return httpok.search_body(response, search, limit), response
+        finally:
+            httpok.CHUNK_SIZE = old
+
+    def test_search_body_across_chunks(self):
+        result, response = self._searchBody(b'aaawo' + b'rksbbbbbbb',
+                                            b'works', 1000, 5)
+        self.assertEqual(result, (True, False))
+        # stopped reading at the chunk with the match
+        self.assertEqual(response.position, 10)
+
+    def test_search_body_limit(self):
+        result, response = self._searchBody(b'a' * 100 + b'works', b'works',
+                                            10, 4)
+        self.assertEqual(result, (False, False))
+        self.assertEqual(response.position, 10)
+
+    def test_search_body_not_found(self):
+        result, response = self._searchBody(b'a' * 10, b'works', 100, 4)
+        self.assertEqual(result, (False, True))
+        result, response = self._searchBody(b'a' * 10, None, 100, 4)
+        self.assertEqual(result, (False, True))
+        self.assertEqual(response.position, 10)
+
+    def test_runforever_acts_if_inbody_beyond_max_body(self):
+        response = DummyResponse()
+        response.body = 'x' * 100 + 'works'
+        prog = self._makeOnePopulated(programs=['foo'], response=response,
+                                      inbody='works')
+        prog.checks[0].max_body = 100
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        lines = prog.stderr.getvalue().split('\n')
+        self.assertTrue('Subject: httpok: http://foo/bar: '
+                        'bad body returned' in lines)
+        self.assertTrue("status contacting http://foo/bar: 200 OK ('works' "
+                        "not found in the first 100 bytes of the body)"
+                        in lines)
+
+    def test_runforever_head_method(self):
+        from superlance.httpok import Check
+        requests = []
+        connclass = make_connection(DummyResponse())
+        class RecordingConnection(connclass):
+            def request(self, method, path, headers):
+                requests.append((method, path))
+        prog = self._makeOnePopulated(programs=['foo'])
+        prog.checks = [Check('http://foo/bar', ['foo'], False, 10, [200],
+                             None, method='HEAD')]
+        prog.connclass = RecordingConnection
+        prog.stdin.write('eventname:TICK len:0\n')
+        prog.stdin.seek(0)
+        prog.runforever(test=True)
+        self.assertEqual(requests, [('HEAD', '/bar')])
+        self.assertEqual(prog.stderr.getvalue(), '')
+
+    def test_validate_method(self):
+        from superlance.httpok import validate_method
+        validate_method('GET', 'works')
+        validate_method('HEAD', None)
+        self.assertRaises(ValueError, validate_method, 'HEAD', 'works')
+        self.assertRaises(ValueError, validate_method, 'POST', None)
 
     def test_subject_no_name(self):
         """set the name to None to check if subject formats to:
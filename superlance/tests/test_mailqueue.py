@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from superlance.compat import StringIO
+
+class MailQueueTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.mailbox = os.path.join(self.tempdir, 'mailbox')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _makeOne(self, sendmail, **kwargs):
+        from superlance.mailqueue import MailQueue
+        kwargs.setdefault('stderr', StringIO())
+        return MailQueue(sendmail, **kwargs)
+
+    def test_put_delivers_in_background(self):
+        mailer = self._makeOne('cat - >> %s' % self.mailbox)
+        mailer.put('To: a@example.com\nSubject: one\n\nbody\n')
+        mailer.put('To: a@example.com\nSubject: two\n\nbody\n')
+        self.assertTrue(mailer.flush(5))
+        with open(self.mailbox) as f:
+            mail = f.read()
+        self.assertTrue('Subject: one' in mail)
+        self.assertTrue('Subject: two' in mail)
+        self.assertEqual(mailer.stderr.getvalue(), '')
+
+    def test_timeout_is_killed_and_retried(self):
+        mailer = self._makeOne('cat - >> %s; sleep 10' % self.mailbox,
+                               timeout=0.2, retries=1, retry_delay=0)
+        started = time.time()
+        mailer.put('Subject: slow\n\n')
+        self.assertTrue(mailer.flush(5))
+        self.assertTrue(time.time() - started < 5)
+        lines = mailer.stderr.getvalue().splitlines()
+        self.assertEqual(lines, [
+            'Failed to send mail (attempt 1 of 2): timed out after 0.2 '
+            'seconds',
+            'Failed to send mail (attempt 2 of 2): timed out after 0.2 '
+            'seconds',
+            ])
+        with open(self.mailbox) as f:
+            self.assertEqual(f.read().count('Subject: slow'), 2)
+
+    def test_failure_is_retried(self):
+        marker = os.path.join(self.tempdir, 'marker')
+        # fails the first time only
+        sendmail = ('if [ -e %s ]; then cat - >> %s; else touch %s; '
+                    'exit 75; fi' % (marker, self.mailbox, marker))
+        mailer = self._makeOne(sendmail, retries=2, retry_delay=0)
+        mailer.put('Subject: retried\n\n')
+        self.assertTrue(mailer.flush(5))
+        self.assertTrue(mailer.stderr.getvalue().startswith(
+            'Failed to send mail (attempt 1 of 3): '))
+        self.assertTrue('exited with status 75' in mailer.stderr.getvalue())
+        with open(self.mailbox) as f:
+            self.assertEqual(f.read(), 'Subject: retried\n\n')
+
+    def test_flush_timeout(self):
+        mailer = self._makeOne('sleep 10', timeout=5, retries=0)
+        mailer.put('Subject: slow\n\n')
+        self.assertFalse(mailer.flush(0.1))
@@ -1,4 +1,7 @@
 # -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
 import unittest
 from superlance.compat import StringIO
 from superlance.compat import maxint
@@ -33,8 +36,28 @@ class MemmonTests(unittest.TestCase):
         memmon.stdout = StringIO()
         memmon.stderr = StringIO()
         memmon.pscommand = 'echo 22%s'
+        memmon.procdir = None
         return memmon
 
+    def _makeProcdir(self, files):
+        procdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, procdir)
+        for path, data in files.items():
+            path = os.path.join(procdir, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, 'w') as f:
+                f.write(data)
+        return procdir
+
+    def test_runforever_status_first_tick_only(self):
+        memmon = self._makeOnePopulated({'foo': 1 << 30}, {}, None)
+        for i in range(2):
+            memmon.stdin = StringIO('eventname:TICK len:0\n')
+            memmon.runforever(test=True)
+        self.assertEqual(memmon.stderr.getvalue(),
+                         'Checking programs foo=%d\n' % (1 << 30))
+
     def test_runforever_notatick(self):
         programs = {'foo':0, 'bar':0, 'baz_01':0 }
         groups = {}
@@ -144,6 +167,7 @@ class MemmonTests(unittest.TestCase):
         groups = {}
         any = None
         memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.verbose = True
         memmon.stdin.write('eventname:TICK len:0\n')
         memmon.stdin.seek(0)
         memmon.runforever(test=True)
@@ -159,6 +183,7 @@ class MemmonTests(unittest.TestCase):
         groups = {}
         any = None
         memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.verbose = True
         memmon.stdin.write('eventname:TICK len:0\n')
         memmon.stdin.seek(0)
         memmon.runforever(test=True)
@@ -169,6 +194,78 @@ class MemmonTests(unittest.TestCase):
         self.assertEqual(lines[2], '')
         self.assertEqual(memmon.mailed, False)
 
+    def test_runforever_tick_programs_norestart_not_verbose(self):
+        programs = {'foo': maxint}
+        groups = {}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        measured = []
+        def measure(pid):
+            measured.append(pid)
+            return 1024
+        memmon.measure = measure
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines, ['Checking programs foo=%s' % maxint, ''])
+        # processes without a limit are not measured
+        self.assertEqual(measured, [11])
+
+    def test_runforever_tick_patterns(self):
+        programs = {'/ba[rz](_[0-9]+)?/': 0, 'foo:f*': maxint}
+        groups = {}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1], 'RSS of bar:bar is 2265088')
+        self.assertEqual(lines[2], 'Restarting bar:bar')
+        self.assertEqual(lines[3], 'RSS of baz:baz_01 is 2265088')
+        self.assertEqual(lines[4], 'Restarting baz:baz_01')
+
+    def test_thresholds_lookup(self):
+        from superlance.memmon import Thresholds
+        thresholds = Thresholds(
+            programs={'foo': 100, 'grp:bar': 200, 'web_*': 300,
+                      '/api:.*/': 400},
+            groups={'grp': 250, 'w*': 350},
+            any=None,
+            )
+        self.assertEqual(thresholds.lookup('foo', 'foo'), 100)
+        self.assertEqual(thresholds.lookup('grp', 'bar'), 200)
+        self.assertEqual(thresholds.lookup('grp', 'baz'), 250)
+        self.assertEqual(thresholds.lookup('other', 'bar'), None)
+        self.assertEqual(thresholds.lookup('web', 'web_01'), 300)
+        self.assertEqual(thresholds.lookup('web', 'worker'), 350)
+        self.assertEqual(thresholds.lookup('api', 'x'), 400)
+        self.assertEqual(thresholds.lookup('apix', 'x'), None)
+        self.assertEqual(thresholds.resolved[(None, 'grp', 'bar')], 200)
+        thresholds = Thresholds(programs={'foo': 100}, groups={}, any=50)
+        self.assertEqual(thresholds.lookup('foo', 'foo'), 50)
+        self.assertEqual(thresholds.lookup('bar', 'bar'), 50)
+
+    def test_thresholds_lookup_instances(self):
+        from superlance.memmon import Thresholds
+        thresholds = Thresholds(
+            programs={'foo': 100, 't1@foo': 50, 't2@web_*': 300,
+                      '/a@b/': 400},
+            groups={'t1@grp': 250},
+            any=None,
+            )
+        self.assertEqual(thresholds.lookup('foo', 'foo'), 100)
+        self.assertEqual(thresholds.lookup('foo', 'foo', 't1'), 50)
+        self.assertEqual(thresholds.lookup('foo', 'foo', 't2'), 100)
+        self.assertEqual(thresholds.lookup('web', 'web_1'), None)
+        self.assertEqual(thresholds.lookup('web', 'web_1', 't2'), 300)
+        self.assertEqual(thresholds.lookup('grp', 'x'), None)
+        self.assertEqual(thresholds.lookup('grp', 'x', 't1'), 250)
+        # a regular expression may contain an @
+        self.assertEqual(thresholds.lookup('g', 'a@b'), 400)
+
     def test_stopprocess_fails_to_stop(self):
         programs = {'BAD_NAME': 0}
         groups = {}
@@ -310,6 +407,37 @@ class MemmonTests(unittest.TestCase):
             None, rss, 'Failure to parse an integer RSS value from the ps '
             'output should result in calc_rss() returning None.')
 
+    def test_calc_rss_procfs(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.procdir = self._makeProcdir({
+            '1/statm': '1000 16 8 1 0 100 0\n',
+            '2/statm': '',
+            })
+        memmon.pagesize = 4096
+        self.assertEqual(16 * 4096, memmon.calc_rss(1))
+        self.assertEqual(None, memmon.calc_rss(2))
+        self.assertEqual(
+            None, memmon.calc_rss(3),
+            'A pid without a statm file (process went away) should result '
+            'in calc_rss() returning None.')
+
+    def test_runforever_tick_procfs(self):
+        programs = {'foo':0}
+        groups = {}
+        any = None
+        memmon = self._makeOnePopulated(programs, groups, any)
+        memmon.procdir = self._makeProcdir({
+            '11/statm': '1000 2 8 1 0 100 0\n',
+            })
+        memmon.pagesize = 4096
+        memmon.pscommand = 'false %s'
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'RSS of foo:foo is 8192')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+
     def test_calc_rss_cumulative(self):
         """Let calc_rss() do its work on a fake process tree:
 
@@ -346,6 +474,780 @@ class MemmonTests(unittest.TestCase):
             'Cumulative RSS of the test process and its three children '
             'should add up to 1000 kb.')
 
+    def test_calc_rss_cumulative_procfs(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.cumulative = True
+        memmon.pagesize = 1024
+        stat = '%s (a (weird) name) S %s' + ' 0' * 19 + ' %s 0 0\n'
+        memmon.procdir = self._makeProcdir({
+            '1/stat': stat % (1, 99, 100),
+            '2/stat': stat % (2, 1, 200),
+            '3/stat': stat % (3, 2, 300),
+            '4/stat': stat % (4, 2, 400),
+            '99/stat': stat % (99, 0, 1),
+            'self/stat': stat % (4, 2, 400),
+            })
+        self.assertEqual(1000 * 1024, memmon.calc_rss(1))
+        self.assertEqual(None, memmon.calc_rss(5))
+
+    def test_runforever_cumulative_reads_process_table_once_per_tick(self):
+        memmon = self._makeOnePopulated({}, {}, maxint)
+        memmon.cumulative = True
+        memmon.verbose = True
+        reads = []
+        def read_ps_process_table():
+            reads.append(True)
+            return [(11, 1, 1024), (12, 1, 2048), (13, 12, 1024)]
+        memmon.read_ps_process_table = read_ps_process_table
+        memmon.stdin.write('eventname:TICK len:0\neventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertEqual(len(reads), 1)
+        self.assertTrue('RSS of bar:bar is 3072' in
+                        memmon.stderr.getvalue().split('\n'))
+        memmon.runforever(test=True)
+        self.assertEqual(len(reads), 2)
+
+    def test_process_table_cumulative_rss(self):
+        from superlance.memmon import ProcessTable
+        procs = [(1, 0, 1), (2, 1, 2), (3, 2, 4), (4, 2, 8), (5, 5, 16)]
+        # a chain deep enough to overflow a recursive walk
+        procs.extend([(i, i - 1, 1) for i in range(100, 5100)])
+        table = ProcessTable(procs)
+        self.assertEqual(table.cumulative_rss(2), 14)
+        self.assertEqual(table.cumulative_rss(1), 15)
+        self.assertEqual(table.cumulative_rss(5), 16)
+        self.assertEqual(table.cumulative_rss(100), 5000)
+        self.assertEqual(table.cumulative_rss(6), None)
+
+    _SMAPS_ROLLUP = (
+        '55d0c0a00000-7ffd2a1f0000 ---p 00000000 00:00 0    [rollup]\n'
+        'Rss:                 400 kB\n'
+        'Pss:                 250 kB\n'
+        'Shared_Clean:        200 kB\n'
+        'Private_Clean:        50 kB\n'
+        'Private_Dirty:       150 kB\n'
+        'Swap:                 10 kB\n'
+        )
+
+    def test_parse_smaps(self):
+        from superlance.memmon import parse_smaps
+        fields = parse_smaps(self._SMAPS_ROLLUP + 'VmFlags: rd wr mr mw me\n')
+        self.assertEqual(fields['Pss'], 250 * 1024)
+        self.assertEqual(fields['Private_Dirty'], 150 * 1024)
+        self.assertFalse('VmFlags' in fields)
+
+    def test_measure_smaps_metrics(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.procdir = self._makeProcdir({
+            '1/smaps_rollup': self._SMAPS_ROLLUP,
+            # kernels without smaps_rollup: sum the per-mapping values
+            '2/smaps': self._SMAPS_ROLLUP + self._SMAPS_ROLLUP,
+            })
+        for metric, expected in (('pss', 250), ('uss', 200), ('swap', 10)):
+            memmon.metric = metric
+            self.assertEqual(memmon.measure(1), expected * 1024)
+            self.assertEqual(memmon.measure(2), expected * 2048)
+        self.assertEqual(memmon.measure(3), None)
+
+    def test_measure_smaps_cumulative(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.cumulative = True
+        memmon.metric = 'pss'
+        memmon.pstreecommand = 'echo "1 99 100\n2 1 200\n3 2 300"'
+        memmon.procdir = None
+        memmon.process_table()
+        # pid 3 exited after the process table was read
+        memmon.procdir = self._makeProcdir({
+            '1/smaps_rollup': self._SMAPS_ROLLUP,
+            '2/smaps_rollup': self._SMAPS_ROLLUP,
+            })
+        self.assertEqual(memmon.measure(1), 500 * 1024)
+        self.assertEqual(memmon.measure(2), 250 * 1024)
+        self.assertEqual(memmon.measure(4), None)
+
+    def test_runforever_tick_metric(self):
+        memmon = self._makeOnePopulated({'foo': 0}, {}, None)
+        memmon.metric = 'pss'
+        memmon.label = 'PSS'
+        memmon.procdir = self._makeProcdir({
+            '11/smaps_rollup': self._SMAPS_ROLLUP,
+            })
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'PSS of foo:foo is 256000')
+        self.assertEqual(lines[2], 'Restarting foo:foo')
+        self.assertTrue('(256000 bytes PSS)' in memmon.mailed)
+
+    def test_measure_cgroup(self):
+        memmon = self._makeOnePopulated({}, {}, None)
+        memmon.metric = 'cgroup'
+        memmon.procdir = self._makeProcdir({
+            '1/cgroup': '0::/system.slice/foo.service\n',
+            '2/cgroup': '0::/system.slice/foo.service\n',
+            '3/cgroup': '0::/\n',
+            '4/cgroup': '12:memory:/foo\n',
+            '5/cgroup': '0::/missing\n',
+            })
+        memmon.cgroupdir = self._makeProcdir({
+            'system.slice/foo.service/memory.current': '1048576\n',
+            'system.slice/foo.service/memory.stat': (
+                'anon 524288\nfile 524288\ninactive_file 262144\n'),
+            })
+        self.assertEqual(memmon.measure(1), 786432)
+        self.assertEqual(list(memmon.cgroups.keys()),
+                         ['system.slice/foo.service'])
+        self.assertEqual(memmon.measure(2), 786432)
+        self.assertEqual(memmon.measure(3), None)
+        self.assertEqual(memmon.measure(4), None)
+        self.assertEqual(memmon.measure(5), None)
+        self.assertEqual(memmon.measure(6), None)
+
+    def test_runforever_tick_cgroup_root_warns_once(self):
+        memmon = self._makeOnePopulated({'foo': 0}, {}, None)
+        memmon.metric = 'cgroup'
+        memmon.procdir = self._makeProcdir({'11/cgroup': '0::/\n'})
+        for i in range(2):
+            memmon.stdin = StringIO('eventname:TICK len:0\n')
+            memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines, ['Checking programs foo=0',
+                                 'Not checking foo:foo: it is in the root '
+                                 'cgroup, which has no memory usage to read',
+                                 ''])
+        self.assertFalse(memmon.mailed)
+
+    def _makeRunningInfos(self, group, count):
+        from supervisor.process import ProcessStates
+        return [{'name': '%s_%02d' % (group, i), 'group': group,
+                 'pid': 100 + i, 'state': ProcessStates.RUNNING,
+                 'start': 0, 'now': 100} for i in range(count)]
+
+    def test_runforever_min_running(self):
+        memmon = self._makeOnePopulated({}, {'web': 0}, None)
+        memmon.scheduler.min_running = 2
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'web', 2)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertTrue(lines[2].startswith('Not restarting web:web_00 now'))
+        self.assertTrue(lines[4].startswith('Not restarting web:web_01 now'))
+        self.assertEqual(memmon.mailed, False)
+        # synchronous restarts only take down one process at a time
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'web', 3)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.stderr.truncate(0)
+        memmon.stderr.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1], 'Restarting web:web_00')
+        self.assertEqual(lines[5], 'Restarting web:web_02')
+
+    def test_runforever_restarts_in_background(self):
+        import threading
+        memmon = self._makeOnePopulated({}, {'web': 0}, None)
+        memmon.scheduler.concurrency = 2
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'web', 6)
+        release = threading.Event()
+        lock = threading.Lock()
+        active = []
+        peak = []
+        def restart(process, rss, reason=None, rpc=None):
+            with lock:
+                active.append(process)
+                peak.append(len(active))
+            release.wait(5)
+            with lock:
+                active.remove(process)
+        memmon.scheduler.restart = restart
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        # the event was answered while the restarts are still under way
+        self.assertTrue(memmon.stdout.getvalue().endswith('RESULT 2\nOK'))
+        self.assertFalse(memmon.scheduler.wait(0.05))
+        release.set()
+        self.assertTrue(memmon.scheduler.wait(5))
+        self.assertEqual(len(peak), 6)
+        self.assertEqual(max(peak), 2)
+
+    def test_scheduler_background_min_running(self):
+        from superlance.memmon import RestartScheduler, snapshot
+        restarted = []
+        def restart(process, rss, reason, rpc):
+            restarted.append((process.namespec, rpc))
+        scheduler = RestartScheduler(restart, concurrency=4, min_running=1,
+                                     rpc_factory=lambda instance: 'rpc')
+        processes = snapshot(self._makeRunningInfos('web', 1))
+        scheduler.update(processes)
+        self.assertTrue(scheduler.submit(processes[0], 1))
+        self.assertFalse(scheduler.submit(processes[0], 1))
+        self.assertFalse(scheduler.wait(0.05))
+        # pending restarts are dropped at the next tick
+        scheduler.update(processes)
+        self.assertTrue(scheduler.wait(1))
+        processes = snapshot(self._makeRunningInfos('web', 2))
+        scheduler.update(processes)
+        self.assertTrue(scheduler.submit(processes[0], 1))
+        self.assertTrue(scheduler.wait(5))
+        self.assertEqual(restarted, [('web:web_00', 'rpc')])
+
+    def test_scheduler_background_min_running_counts_inflight_once(self):
+        import threading
+        import time
+        from supervisor.process import ProcessStates
+        from superlance.memmon import RestartScheduler, snapshot
+        release = threading.Event()
+        started = []
+        def restart(process, rss, reason, rpc):
+            started.append(process.namespec)
+            if process.namespec == 'web:web_00':
+                release.wait(5)
+        scheduler = RestartScheduler(restart, concurrency=4, min_running=2)
+        infos = self._makeRunningInfos('web', 4)
+        processes = snapshot(infos)
+        scheduler.update(processes)
+        self.assertTrue(scheduler.submit(processes[0], 1))
+        # next tick: web_00 is still being restarted, so it isn't RUNNING
+        # and mustn't be subtracted again from the 3 that are
+        infos[0]['state'] = ProcessStates.STARTING
+        processes = snapshot(infos)
+        scheduler.update(processes)
+        self.assertTrue(scheduler.submit(processes[1], 1))
+        for i in range(100):
+            if 'web:web_01' in started:
+                break
+            time.sleep(0.01)
+        self.assertEqual(started, ['web:web_00', 'web:web_01'])
+        release.set()
+        self.assertTrue(scheduler.wait(5))
+
+    def test_scheduler_background_min_running_released_mid_tick(self):
+        import threading
+        from superlance.memmon import RestartScheduler, snapshot
+        release = threading.Event()
+        started = []
+        def restart(process, rss, reason, rpc):
+            started.append(process.namespec)
+            release.wait(5)
+        scheduler = RestartScheduler(restart, concurrency=2, min_running=2)
+        processes = snapshot(self._makeRunningInfos('web', 3))
+        scheduler.update(processes)
+        self.assertTrue(scheduler.submit(processes[0], 1))
+        self.assertTrue(scheduler.submit(processes[1], 1))
+        self.assertFalse(scheduler.wait(0.1))
+        self.assertEqual(started, ['web:web_00'])
+        # web_01 goes as soon as web_00 is back, without another tick
+        release.set()
+        self.assertTrue(scheduler.wait(5))
+        self.assertEqual(started, ['web:web_00', 'web:web_01'])
+
+    def test_scheduler_background_error_raised_on_next_tick(self):
+        from superlance.compat import xmlrpclib
+        memmon = self._makeOnePopulated({'BAD_NAME': 0}, {}, None)
+        memmon.scheduler.concurrency = 1
+        from supervisor.process import ProcessStates
+        memmon.rpc.supervisor.all_process_info = [{
+            'name':'BAD_NAME', 'group':'BAD_NAME', 'pid':11,
+            'state':ProcessStates.RUNNING, 'start':0, 'now':0,
+            }]
+        memmon.stdin.write('eventname:TICK len:0\neventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertTrue(memmon.scheduler.wait(5))
+        self.assertRaises(xmlrpclib.Fault, memmon.runforever, True)
+
+    def test_runforever_one_rpc_call_per_tick(self):
+        memmon = self._makeOnePopulated({}, {}, 0)
+        calls = []
+        supervisor = memmon.rpc.supervisor
+        def getAllProcessInfo():
+            calls.append('getAllProcessInfo')
+            return supervisor.all_process_info
+        def getProcessInfo(name):
+            raise AssertionError('getProcessInfo should not be called')
+        supervisor.getAllProcessInfo = getAllProcessInfo
+        supervisor.getProcessInfo = getProcessInfo
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertEqual(calls, ['getAllProcessInfo'])
+        self.assertEqual(
+            memmon.stderr.getvalue().count('Restarting'), 3)
+
+    def test_process_snapshot(self):
+        from superlance.memmon import snapshot
+        processes = snapshot(DummyRPCServer().supervisor.all_process_info)
+        self.assertEqual(processes[2].namespec, 'baz:baz_01')
+        self.assertEqual(processes[2].pid, 12)
+        self.assertEqual(processes[0].uptime, 100)
+
+    def test_process_state_growth_rate(self):
+        from superlance.memmon import ProcessState
+        state = ProcessState(pid=1, size=4)
+        state.add(0, 1000)
+        state.add(10, 2000)
+        state.add(20, 3000)
+        self.assertEqual(state.growth_rate(), None)
+        state.add(30, 4000)
+        self.assertEqual(state.growth_rate(), 100)
+        # the oldest sample is overwritten
+        state.add(40, 4000)
+        state.add(50, 4000)
+        self.assertEqual(state.growth_rate(), 30)
+        state.add(60, 4000)
+        state.add(70, 4000)
+        self.assertEqual(state.growth_rate(), 0)
+        self.assertEqual(len(state.samples), 8)
+
+    def _tick(self, memmon, now, usage):
+        for info in memmon.rpc.supervisor.all_process_info:
+            info['now'] = now
+        memmon.measure = lambda pid: usage
+        memmon.stdin.seek(0)
+        memmon.stdin.truncate(0)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.stderr.seek(0)
+        memmon.stderr.truncate(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        if memmon.ticks == 1:
+            # the thresholds are only written on the first tick
+            lines = lines[1:]
+        return lines
+
+    def test_runforever_horizon(self):
+        memmon = self._makeOnePopulated({}, {'foo': 10000}, None)
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'foo', 1)
+        memmon.horizon = 60
+        memmon.window = 3
+        # growing by 10 bytes/s, the limit is 600 seconds away
+        self.assertEqual(self._tick(memmon, 0, 4000), [''])
+        self.assertEqual(self._tick(memmon, 60, 4600), [''])
+        self.assertEqual(self._tick(memmon, 120, 5200), [''])
+        # growing by 35 bytes/s, the limit is 34 seconds away
+        lines = self._tick(memmon, 180, 8800)
+        self.assertEqual(lines[0],
+                         'RSS of foo:foo_00 is 8800, growing by 35 bytes/s')
+        self.assertEqual(lines[1], 'Restarting foo:foo_00')
+        self.assertTrue('growing by 35 bytes/s' in memmon.mailed)
+        self.assertEqual(list(memmon.states), ['foo:foo_00'])
+        # the history is dropped with the process
+        memmon.rpc.supervisor.all_process_info = []
+        self._tick(memmon, 240, 0)
+        self.assertEqual(memmon.states, {})
+
+    def test_runforever_horizon_shrinking(self):
+        memmon = self._makeOnePopulated({}, {'foo': 10000}, None)
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'foo', 1)
+        memmon.horizon = 3600
+        memmon.window = 3
+        # shrinking memory is never about to reach the limit
+        for now, usage in ((0, 9000), (60, 6000), (120, 3000)):
+            self.assertEqual(self._tick(memmon, now, usage), [''])
+        self.assertTrue(memmon.states['foo:foo_00'].growth_rate() < 0)
+        self.assertFalse(memmon.mailed)
+
+    def test_runforever_horizon_new_pid_resets_history(self):
+        memmon = self._makeOnePopulated({}, {'foo': 10000}, None)
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'foo', 1)
+        memmon.horizon = 600
+        memmon.window = 2
+        self._tick(memmon, 0, 1000)
+        memmon.rpc.supervisor.all_process_info[0]['pid'] = 999
+        self.assertEqual(self._tick(memmon, 60, 9000), [''])
+        self.assertEqual(memmon.states['foo:foo_00'].count, 1)
+
+    def test_runforever_sustain(self):
+        memmon = self._makeOnePopulated({}, {'foo': 10000}, None)
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'foo', 1)
+        memmon.sustain = 3
+        memmon.low_watermark = 80
+        self.assertEqual(self._tick(memmon, 0, 12000), [''])
+        self.assertEqual(self._tick(memmon, 5, 12000), [''])
+        # between the low watermark and the limit: the run isn't broken
+        self.assertEqual(self._tick(memmon, 10, 9000), [''])
+        self.assertEqual(memmon.states['foo:foo_00'].over, 2)
+        lines = self._tick(memmon, 15, 12000)
+        self.assertEqual(lines[0], 'RSS of foo:foo_00 is 12000')
+        self.assertEqual(lines[1], 'Restarting foo:foo_00')
+
+    def test_runforever_sustain_reset_below_low_watermark(self):
+        memmon = self._makeOnePopulated({}, {'foo': 10000}, None)
+        memmon.rpc.supervisor.all_process_info = self._makeRunningInfos(
+            'foo', 1)
+        memmon.sustain = 2
+        memmon.low_watermark = 80
+        memmon.verbose = True
+        lines = self._tick(memmon, 0, 12000)
+        self.assertEqual(lines[0], 'RSS of foo:foo_00 is 12000, '
+                                   'over the limit for 1 of 2 samples')
+        self._tick(memmon, 5, 7000)
+        self.assertEqual(memmon.states['foo:foo_00'].over, 0)
+        lines = self._tick(memmon, 10, 12000)
+        self.assertEqual(lines[0], 'RSS of foo:foo_00 is 12000, '
+                                   'over the limit for 1 of 2 samples')
+        self.assertEqual(len(memmon.states['foo:foo_00'].samples), 0)
+        self.assertEqual(memmon.mailed, False)
+
+    def test_runforever_store(self):
+        from superlance.samplestore import SampleStore, iter_samples
+        memmon = self._makeOnePopulated({'foo': maxint}, {}, None)
+        path = os.path.join(self._makeProcdir({}), 'samples')
+        memmon.store = SampleStore(path)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        now = memmon.rpc.supervisor.all_process_info[0]['now']
+        self.assertEqual(list(iter_samples(path)), [(now, 11, 0, 2264064)])
+        memmon.store.close()
+
+    def test_runforever_textfile(self):
+        from superlance.textfile import TextfileExporter
+        memmon = self._makeOnePopulated({'foo': 0}, {}, None)
+        path = os.path.join(self._makeProcdir({}), 'memmon.prom')
+        memmon.exporter = TextfileExporter(path)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertTrue('memmon_memory_bytes{group="foo",name="foo",'
+                        'metric="rss"} 2264064' in lines)
+        self.assertTrue('memmon_restarts_total{group="foo",name="foo",'
+                        'metric="rss"} 1' in lines)
+
+    def test_runforever_textfile_error(self):
+        from superlance.textfile import TextfileExporter
+        memmon = self._makeOnePopulated({'foo': maxint}, {}, None)
+        path = os.path.join(self._makeProcdir({}), 'missing', 'memmon.prom')
+        memmon.exporter = TextfileExporter(path)
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertTrue(lines[1].startswith(
+            'Cannot write metrics to %s: ' % path))
+        self.assertTrue(memmon.stdout.getvalue().endswith('RESULT 2\nOK'))
+
+    def test_runforever_store_error(self):
+        import errno
+        from superlance.samplestore import SampleStore
+        memmon = self._makeOnePopulated({'foo': maxint, 'bar': maxint}, {},
+                                        None)
+        path = os.path.join(self._makeProcdir({}), 'samples')
+        memmon.store = SampleStore(path)
+        self.addCleanup(memmon.store.close)
+        appended = []
+        def append(*args):
+            appended.append(args)
+            raise OSError(errno.ENOSPC, 'No space left on device')
+        memmon.store.append = append
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        # logged, and the event is still answered
+        self.assertEqual(len(appended), 1)
+        lines = memmon.stderr.getvalue().split('\n')
+        self.assertEqual(lines[1:], ['Cannot write samples to %s: [Errno 28] '
+                                     'No space left on device' % path, ''])
+        self.assertTrue(memmon.stdout.getvalue().endswith('RESULT 2\nOK'))
+
+    def test_runforever_does_not_wait_on_sendmail(self):
+        memmon = self._makeOnePopulated({'foo': 0}, {}, None)
+        # sendmail doesn't finish until the marker file exists
+        marker = os.path.join(self._makeProcdir({}), 'sent')
+        memmon.sendmail = ('while [ ! -e "%s" ]; do sleep 0.05; done; '
+                           'cat > /dev/null' % marker)
+        memmon.mail_timeout = 10
+        memmon.mail_retries = 0
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        # the event was answered while sendmail was still running
+        self.assertTrue(memmon.mailed)
+        self.assertTrue(memmon.stdout.getvalue().endswith('RESULT 2\nOK'))
+        self.assertFalse(memmon.mailer.flush(0))
+        open(marker, 'w').close()
+        self.assertTrue(memmon.mailer.flush(5))
+        self.assertFalse('Failed' in memmon.stderr.getvalue())
+
+    def _makeClock(self, step):
+        times = []
+        def clock():
+            times.append(len(times) * step)
+            return times[-1]
+        return clock
+
+    def test_runforever_timing(self):
+        memmon = self._makeOnePopulated({}, {}, maxint)
+        memmon.timing = True
+        memmon.clock = self._makeClock(0.5)
+        memmon.stdin.write('eventname:TICK_60 len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        # 3 processes measured and judged, one rpc call, one output phase
+        self.assertEqual(lines[-1], 'Tick took 8.500s: rpc 0.500s, '
+                         'measure 1.500s, restart 1.500s, output 0.500s '
+                         '(3 processes checked)')
+
+    def test_runforever_tick_longer_than_interval(self):
+        memmon = self._makeOnePopulated({}, {}, maxint)
+        memmon.clock = self._makeClock(1)
+        memmon.stdin.write('eventname:TICK_5 len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[-1], 'Tick took 17.000 seconds, longer than '
+                         'the TICK_5 interval of 5 seconds: memmon is '
+                         'falling behind')
+
+        memmon = self._makeOnePopulated({}, {}, maxint)
+        memmon.clock = self._makeClock(1)
+        memmon.stdin.write('eventname:TICK_60 len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertFalse('falling behind' in memmon.stderr.getvalue())
+
+    def test_runforever_profile(self):
+        import pstats
+        memmon = self._makeOnePopulated({'foo': maxint}, {}, None)
+        memmon.profile = os.path.join(self._makeProcdir({}), 'memmon.prof')
+        memmon.profile_every = 2
+        memmon.stdin.write('eventname:TICK_5 len:0\n')
+        memmon.stdin.seek(0)
+        memmon.runforever(test=True)
+        self.assertFalse(os.path.exists(memmon.profile))
+        memmon.stdin = StringIO('eventname:TICK_5 len:0\n')
+        memmon.runforever(test=True)
+        stats = pstats.Stats(memmon.profile)
+        self.assertTrue([func for func in stats.stats
+                         if func[2] == 'measure'])
+
+    def _makePressureMemmon(self, psi, available):
+        memmon = self._makeOnePopulated({'foo': 40000, 'bar': 40000}, {},
+                                        None)
+        memmon.pressure = True
+        memmon.procdir = self._makeProcdir({
+            '11/statm': '1000 10 8 1 0 100 0\n',
+            '12/statm': '1000 20 8 1 0 100 0\n',
+            'pressure/memory': (
+                'some avg10=%.2f avg60=0.00 avg300=0.00 total=0\n'
+                'full avg10=0.00 avg60=0.00 avg300=0.00 total=0\n' % psi),
+            'meminfo': ('MemTotal:        1000000 kB\n'
+                        'MemFree:           10000 kB\n'
+                        'MemAvailable:    %7d kB\n' % available),
+            })
+        memmon.pagesize = 4096
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        return memmon
+
+    def test_parse_psi(self):
+        from superlance.memmon import parse_psi
+        psi = parse_psi('some avg10=1.50 avg60=0.25 avg300=0.00 total=12\n'
+                        'full avg10=0.00 avg60=0.00 avg300=0.00 total=3\n')
+        self.assertEqual(psi['some']['avg10'], 1.5)
+        self.assertEqual(psi['full']['total'], 3)
+
+    def test_runforever_pressure_holds_slightly_over(self):
+        memmon = self._makePressureMemmon(psi=1.0, available=500000)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[1:], [
+            'RSS of foo:foo is 40960',
+            'RSS of bar:bar is 81920',
+            'Restarting bar:bar',
+            'Not restarting foo:foo now: RSS is within 10% of its limit '
+            'and the host is not under memory pressure',
+            ])
+
+    def test_runforever_pressure_restarts_worst_first(self):
+        memmon = self._makePressureMemmon(psi=25.0, available=500000)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[3:], [
+            'Host is under memory pressure: memory pressure (PSI some '
+            'avg10) is 25.00%',
+            'Restarting bar:bar',
+            'Restarting foo:foo',
+            ])
+
+    def test_runforever_pressure_low_available_memory(self):
+        memmon = self._makePressureMemmon(psi=0.0, available=50000)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[3], 'Host is under memory pressure: only 5% '
+                         'of memory is available')
+        self.assertEqual(lines[4:], ['Restarting bar:bar',
+                                     'Restarting foo:foo'])
+
+    def test_runforever_pressure_stops_once_cleared(self):
+        memmon = self._makePressureMemmon(psi=0.0, available=500000)
+        readings = ['only 5% of memory is available', None]
+        memmon.host_pressure = lambda: readings.pop(0)
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[4:], [
+            'Restarting bar:bar',
+            'Not restarting foo:foo now: RSS is within 10% of its limit '
+            'and the host is not under memory pressure',
+            ])
+
+    def test_runforever_pressure_background_stops_once_cleared(self):
+        memmon = self._makePressureMemmon(psi=0.0, available=500000)
+        memmon.scheduler.concurrency = 1
+        readings = ['only 5% of memory is available', None]
+        memmon.host_pressure = lambda: readings.pop(0)
+        restarted = []
+        def restart(process, rss, reason=None, rpc=None):
+            restarted.append(process.namespec)
+        memmon.scheduler.restart = restart
+        memmon.runforever(test=True)
+        self.assertTrue(memmon.scheduler.wait(5))
+        # pressure is checked again once bar's restart is done
+        self.assertEqual(restarted, ['bar:bar'])
+        self.assertEqual(readings, [])
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[-1], 'Not restarting foo:foo now: RSS is '
+                         'within 10% of its limit and the host is no longer '
+                         'under memory pressure')
+
+    def _makeInstanceMemmon(self, programs):
+        memmon = self._makeOnePopulated(programs, {}, None)
+        memmon.instances = [('t1', 'unix:///tmp/t1.sock'),
+                            ('t2', 'unix:///tmp/t2.sock')]
+        memmon.rpcs = {'t1': DummyRPCServer(), 't2': DummyRPCServer()}
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.seek(0)
+        return memmon
+
+    def test_runforever_instances(self):
+        memmon = self._makeInstanceMemmon({'t1@foo': 0, 'bar': maxint})
+        stopped = []
+        memmon.rpcs['t1'].supervisor.stopProcess = stopped.append
+        memmon.verbose = True
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[1:], [
+            'RSS of bar:bar is 2265088',
+            'RSS of t1@foo:foo is 2264064',
+            'Restarting t1@foo:foo',
+            'RSS of t1@bar:bar is 2265088',
+            'RSS of t2@bar:bar is 2265088',
+            ])
+        self.assertEqual(stopped, ['foo:foo'])
+        self.assertTrue('process named t1@foo:foo' in memmon.mailed)
+
+    def test_runforever_instance_unreachable(self):
+        import socket
+        memmon = self._makeInstanceMemmon({'foo': maxint})
+        def getAllProcessInfo():
+            raise socket.error('Connection refused')
+        memmon.rpcs['t1'].supervisor.getAllProcessInfo = getAllProcessInfo
+        memmon.verbose = True
+        memmon.runforever(test=True)
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(lines[1:], [
+            'Cannot get the processes of instance t1 '
+            '(unix:///tmp/t1.sock): Connection refused',
+            'RSS of foo:foo is 2264064',
+            'RSS of t2@foo:foo is 2264064',
+            ])
+
+    def test_make_rpc_instance(self):
+        memmon = self._makeInstanceMemmon({})
+        rpc = memmon.make_rpc('t2')
+        transport = rpc._ServerProxy__transport
+        self.assertEqual(transport.serverurl, 'unix:///tmp/t2.sock')
+
+    def _processStateEvent(self, eventname, payload):
+        return 'eventname:%s len:%d\n%s' % (eventname, len(payload), payload)
+
+    def test_process_cache(self):
+        from superlance.memmon import ProcessCache
+        from supervisor.process import ProcessStates
+        cache = ProcessCache(reconcile_every=2)
+        self.assertTrue(cache.due())
+        cache.reconcile(DummyRPCServer().supervisor.all_process_info)
+        self.assertFalse(cache.due())
+        cache.update('PROCESS_STATE_STOPPED',
+                     'processname:foo groupname:foo from_state:STOPPING '
+                     'pid:11', 100)
+        infos = cache.current(200)
+        self.assertEqual(infos[0]['state'], ProcessStates.STOPPED)
+        self.assertEqual(infos[0]['pid'], 0)
+        self.assertEqual(infos[0]['now'], 200)
+        cache.update('PROCESS_STATE_STARTING',
+                     'processname:foo groupname:foo from_state:STOPPED '
+                     'tries:0', 300)
+        cache.update('PROCESS_STATE_RUNNING',
+                     'processname:foo groupname:foo from_state:STARTING '
+                     'pid:42', 301)
+        infos = cache.current(400)
+        self.assertEqual(infos[0]['state'], ProcessStates.RUNNING)
+        self.assertEqual(infos[0]['pid'], 42)
+        self.assertEqual(infos[0]['start'], 300)
+        self.assertTrue(cache.due())
+
+        cache.reconcile(DummyRPCServer().supervisor.all_process_info)
+        cache.update('PROCESS_STATE_RUNNING',
+                     'processname:new groupname:new from_state:STARTING '
+                     'pid:43', 500)
+        self.assertTrue(cache.due())
+        cache.reconcile(DummyRPCServer().supervisor.all_process_info)
+        cache.update('PROCESS_GROUP_REMOVED', 'groupname:foo\n', 500)
+        self.assertTrue(cache.due())
+
+    def test_runforever_reconcile_every(self):
+        from superlance.memmon import ProcessCache
+        memmon = self._makeOnePopulated({}, {}, maxint)
+        memmon.cache = ProcessCache(reconcile_every=3)
+        calls = []
+        supervisor = memmon.rpc.supervisor
+        def getAllProcessInfo():
+            calls.append('getAllProcessInfo')
+            return supervisor.all_process_info
+        supervisor.getAllProcessInfo = getAllProcessInfo
+        memmon.verbose = True
+        memmon.stdin.write('eventname:TICK len:0\n')
+        memmon.stdin.write(self._processStateEvent(
+            'PROCESS_STATE_STOPPED',
+            'processname:foo groupname:foo from_state:STOPPING pid:11'))
+        memmon.stdin.write('eventname:TICK len:0\n' * 3)
+        memmon.stdin.seek(0)
+        for i in range(5):
+            memmon.runforever(test=True)
+        self.assertEqual(calls, ['getAllProcessInfo', 'getAllProcessInfo'])
+        lines = memmon.stderr.getvalue().splitlines()
+        self.assertEqual(len([l for l in lines
+                              if l.startswith('RSS of foo:foo')]), 2)
+        self.assertEqual(len([l for l in lines
+                              if l.startswith('RSS of bar:bar')]), 4)
+
+    def test_bench_memmon(self):
+        from superlance.tests.bench_memmon import run
+        out = StringIO()
+        run([3], 1, ['procfs', 'ps'], 1, out)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(len(lines), 5)
+        self.assertEqual([line.split()[:3] for line in lines[1:]], [
+            ['procfs', 'flat', '3'], ['procfs', 'cumulative', '3'],
+            ['ps', 'flat', '3'], ['ps', 'cumulative', '3']])
+
     def test_argparser(self):
         """test if arguments are parsed correctly
         """
@@ -364,9 +1266,25 @@ class MemmonTests(unittest.TestCase):
                      '-s', 'mutt',
                      '-m', 'me@you.com',
                      '-u', '1d',
-                     '-n', 'myproject']
+                     '-n', 'myproject',
+                     '--metric', 'PSS',
+                     '--restart-concurrency', '4',
+                     '--min-running', '2',
+                     '-v',
+                     '--horizon', '1h',
+                     '--window', '5',
+                     '--sustain', '3',
+                     '--low-watermark', '90%']
         memmon = memmon_from_args(arguments)
         self.assertEqual(memmon.cumulative, True)
+        self.assertEqual(memmon.metric, 'pss')
+        self.assertEqual(memmon.scheduler.concurrency, 4)
+        self.assertEqual(memmon.scheduler.min_running, 2)
+        self.assertEqual(memmon.verbose, True)
+        self.assertEqual(memmon.horizon, 3600)
+        self.assertEqual(memmon.window, 5)
+        self.assertEqual(memmon.sustain, 3)
+        self.assertEqual(memmon.low_watermark, 90)
         self.assertEqual(memmon.programs['foo'], 50 * 1024 * 1024)
         self.assertEqual(memmon.groups['bar'], 10 * 1024)
         self.assertEqual(memmon.any, 250)
@@ -375,11 +1293,22 @@ class MemmonTests(unittest.TestCase):
         self.assertEqual(memmon.email_uptime_limit, 1 * 24 * 60 * 60)
         self.assertEqual(memmon.name, 'myproject')
 
+        memmon = memmon_from_args(['--metric', 'cgroup'])
+        self.assertEqual(memmon.metric, 'cgroup')
+        self.assertEqual(memmon.label, 'CGROUP')
+
 
         #default arguments
         arguments = ['-m', 'me@you.com']
         memmon = memmon_from_args(arguments)
         self.assertEqual(memmon.cumulative, False)
+        self.assertEqual(memmon.metric, 'rss')
+        self.assertEqual(memmon.scheduler.concurrency, 0)
+        self.assertEqual(memmon.scheduler.min_running, 0)
+        self.assertEqual(memmon.verbose, False)
+        self.assertEqual(memmon.horizon, None)
+        self.assertEqual(memmon.sustain, 1)
+        self.assertEqual(memmon.low_watermark, 100)
         self.assertEqual(memmon.programs, {})
         self.assertEqual(memmon.groups, {})
         self.assertEqual(memmon.any, None)
@@ -390,3 +1319,53 @@ class MemmonTests(unittest.TestCase):
         arguments = ['-p', 'foo=50MB']
         memmon = memmon_from_args(arguments)
         self.assertEqual(memmon.email, None)
+        self.assertEqual(memmon.name, None)
+
+        path = os.path.join(self._makeProcdir({}), 'samples')
+        arguments = ['--store', path, '--store-max-size', '1MB',
+                     '--store-keep', '2']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.store.path, path)
+        self.assertEqual(memmon.store.max_size, 1024 * 1024)
+        self.assertEqual(memmon.store.keep, 2)
+        memmon.store.close()
+
+        arguments = ['--textfile', '/tmp/memmon.prom', '--metric', 'uss']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.exporter.path, '/tmp/memmon.prom')
+        self.assertEqual(memmon.exporter.metric, 'uss')
+
+        arguments = ['--mail-timeout', '1m', '--mail-retries', '5']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.mail_timeout, 60)
+        self.assertEqual(memmon.mail_retries, 5)
+
+        arguments = ['--timing', '--profile', '/tmp/memmon.prof',
+                     '--profile-every', '10']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.timing, True)
+        self.assertEqual(memmon.profile, '/tmp/memmon.prof')
+        self.assertEqual(memmon.profile_every, 10)
+
+        arguments = ['--pressure', '--psi-threshold', '2.5',
+                     '--min-available', '20%', '--grace', '5']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.pressure, True)
+        self.assertEqual(memmon.psi_threshold, 2.5)
+        self.assertEqual(memmon.min_available, 20)
+        self.assertEqual(memmon.grace, 5)
+
+        arguments = ['--instance', 't1=unix:///tmp/t1.sock',
+                     '--instance', 't2=http://localhost:9002']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.instances, [
+            ('t1', 'unix:///tmp/t1.sock'), ('t2', 'http://localhost:9002')])
+
+        memmon = memmon_from_args(['--reconcile-every', '10'])
+        self.assertEqual(memmon.cache.reconcile_every, 10)
+        self.assertEqual(memmon_from_args(['-a', '1GB']).cache, None)
+
+        arguments = ['-p', '/a=b/=1MB', '-g', 'web_*=2MB']
+        memmon = memmon_from_args(arguments)
+        self.assertEqual(memmon.programs['/a=b/'], 1024 * 1024)
+        self.assertEqual(memmon.groups['web_*'], 2 * 1024 * 1024)
@@ -0,0 +1,158 @@
+import os
+import shutil
+import tempfile
+import unittest
+from superlance.compat import StringIO
+
+class SampleStoreTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'memmon.samples')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _makeOne(self, *args, **kwargs):
+        from superlance.samplestore import SampleStore
+        return SampleStore(self.path, *args, **kwargs)
+
+    def _samples(self, path=None):
+        from superlance.samplestore import iter_samples
+        return list(iter_samples(path or self.path))
+
+    def test_append_commit(self):
+        store = self._makeOne()
+        store.append(1.5, 11, 'foo:foo', 1024)
+        store.append(1.5, 12, 'bar:bar', 2048)
+        # records are invisible to readers until they are committed
+        self.assertEqual(self._samples(), [])
+        store.commit()
+        self.assertEqual(self._samples(), [(1.5, 11, 0, 1024),
+                                           (1.5, 12, 1, 2048)])
+        store.append(2.5, 11, 'foo:foo', 4096)
+        store.close()
+        self.assertEqual(self._samples()[-1], (2.5, 11, 0, 4096))
+        with open(self.path + '.names') as f:
+            self.assertEqual(f.read(), 'foo:foo\nbar:bar\n')
+
+    def test_reopen_appends(self):
+        from superlance.samplestore import last_sample
+        store = self._makeOne()
+        store.append(1, 11, 'foo:foo', 1024)
+        store.close()
+        store = self._makeOne()
+        store.append(2, 12, 'bar:bar', 2048)
+        store.append(3, 11, 'foo:foo', 4096)
+        store.commit()
+        self.assertEqual(self._samples(), [(1, 11, 0, 1024),
+                                           (2, 12, 1, 2048),
+                                           (3, 11, 0, 4096)])
+        self.assertEqual(last_sample(self.path), (3, 11, 0, 4096))
+        store.close()
+
+    def test_not_a_store(self):
+        with open(self.path, 'w') as f:
+            f.write('x' * 100)
+        self.assertRaises(ValueError, self._makeOne)
+
+    def test_grow_and_rotate(self):
+        from superlance.samplestore import GROWTH, HEADER, RECORD
+        from superlance.samplestore import store_paths
+        per_chunk = GROWTH // RECORD.size
+        store = self._makeOne(max_size=HEADER.size + 2 * GROWTH, keep=1)
+        for i in range(per_chunk * 2):
+            store.append(i, 1, 'foo:foo', i)
+        store.commit()
+        self.assertEqual(len(self._samples()), per_chunk * 2)
+        for i in range(per_chunk * 5):
+            store.append(i, 1, 'foo:foo', i)
+        store.close()
+        paths = store_paths(self.path)
+        self.assertEqual(paths, [self.path + '.1', self.path])
+        self.assertFalse(os.path.exists(self.path + '.2'))
+        self.assertEqual(len(self._samples(paths[0])), per_chunk * 2)
+        self.assertEqual(len(self._samples(paths[1])), per_chunk)
+
+class MemmonReportTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'memmon.samples')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _fill(self):
+        from superlance.samplestore import SampleStore
+        store = SampleStore(self.path)
+        for i in range(100):
+            store.append(1000 + i, 11, 'web:web_01', (i + 1) * 1024 * 1024)
+            store.append(1000 + i, 12, 'worker:worker', 10 * 1024)
+        store.close()
+
+    def test_summarize(self):
+        from superlance.memmon_report import summarize
+        self._fill()
+        summaries = summarize(self.path)
+        self.assertEqual(sorted(summaries), ['web:web_01', 'worker:worker'])
+        web = summaries['web:web_01']
+        self.assertEqual(web.count, 100)
+        self.assertEqual(web.peak, 100 * 1024 * 1024)
+        self.assertEqual(web.peak_time, 1099)
+        for percent in (50, 90, 99):
+            expected = percent * 1024 * 1024
+            self.assertTrue(expected <= web.percentile(percent) < expected * 1.05,
+                            (percent, web.percentile(percent)))
+        self.assertEqual(summaries['worker:worker'].percentile(50), 10 * 1024)
+
+    def test_summarize_since_and_patterns(self):
+        from superlance.memmon_report import summarize
+        self._fill()
+        summaries = summarize(self.path, since=9, patterns=['web_*'])
+        self.assertEqual(list(summaries), ['web:web_01'])
+        self.assertEqual(summaries['web:web_01'].count, 10)
+
+    def test_summarize_since_after_rotation(self):
+        from superlance.memmon_report import summarize
+        self._fill()
+        os.rename(self.path, self.path + '.1')
+        open(self.path, 'wb').close()
+        summaries = summarize(self.path, since=9, patterns=['web_*'])
+        self.assertEqual(summaries['web:web_01'].count, 10)
+
+    def test_main(self):
+        from superlance import memmon_report
+        self._fill()
+        stdout = StringIO()
+        memmon_report.sys.stdout, saved = stdout, memmon_report.sys.stdout
+        try:
+            memmon_report.main(['memmon-report', '-p', 'worker:*',
+                                self.path])
+        finally:
+            memmon_report.sys.stdout = saved
+        lines = stdout.getvalue().splitlines()
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0].split()[:6],
+                         ['program', 'samples', 'p50', 'p90', 'p99', 'peak'])
+        self.assertEqual(lines[1].split()[:6],
+                         ['worker:worker', '100', '10.0KB', '10.0KB',
+                          '10.0KB', '10.0KB'])
+
+    def test_main_bad_since(self):
+        from superlance import memmon_report
+        stdout = StringIO()
+        memmon_report.sys.stdout, saved = stdout, memmon_report.sys.stdout
+        try:
+            self.assertRaises(SystemExit, memmon_report.main,
+                              ['memmon-report', '-s', 'soon', self.path])
+        finally:
+            memmon_report.sys.stdout = saved
+        self.assertEqual(stdout.getvalue(),
+                         "Unparseable value for time in 'soon' for -s\n" +
+                         memmon_report.doc + '\n')
+
+    def test_format_size(self):
+        from superlance.memmon_report import format_size
+        self.assertEqual(format_size(10), '10B')
+        self.assertEqual(format_size(1536), '1.5KB')
+        self.assertEqual(format_size(3 * 1024 * 1024), '3.0MB')
+        self.assertEqual(format_size(2048 * 1024 ** 3), '2048.0GB')
@@ -0,0 +1,56 @@
+import threading
+import time
+import unittest
+
+class RunAllTests(unittest.TestCase):
+    def _callFUT(self, func, items, concurrency):
+        from superlance.tasks import run_all
+        return run_all(func, items, concurrency)
+
+    def test_results_in_order(self):
+        def func(item):
+            time.sleep(0.01 * (5 - item))
+            return item * 2
+        self.assertEqual(self._callFUT(func, list(range(5)), 3),
+                         [0, 2, 4, 6, 8])
+
+    def test_concurrency_is_bounded(self):
+        lock = threading.Lock()
+        running = [0]
+        peak = [0]
+        def func(item):
+            with lock:
+                running[0] += 1
+                peak[0] = max(peak[0], running[0])
+            time.sleep(0.05)
+            with lock:
+                running[0] -= 1
+        self._callFUT(func, list(range(8)), 3)
+        self.assertEqual(peak[0], 3)
+
+    def test_no_threads_without_concurrency(self):
+        threads = []
+        def func(item):
+            threads.append(threading.current_thread())
+        self._callFUT(func, [1, 2], 1)
+        self.assertEqual(threads, [threading.current_thread()] * 2)
+
+class RunCommandTests(unittest.TestCase):
+    def _callFUT(self, cmd, timeout, input=None):
+        from superlance.tasks import run_command
+        return run_command(cmd, timeout, input)
+
+    def test_output_and_status(self):
+        self.assertEqual(self._callFUT('echo out; echo err >&2; exit 3', 5),
+                         (3, 'out\nerr\n', False))
+
+    def test_input(self):
+        self.assertEqual(self._callFUT('cat', 5, b'hello'),
+                         (0, 'hello', False))
+
+    def test_timeout_kills_children(self):
+        started = time.time()
+        status, output, expired = self._callFUT('sleep 10; echo done', 0.2)
+        self.assertTrue(time.time() - started < 5)
+        self.assertTrue(expired)
+        self.assertEqual(output, '')
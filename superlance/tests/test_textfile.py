@@ -0,0 +1,55 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+class TextfileExporterTests(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tempdir, 'memmon.prom')
+
+    def tearDown(self):
+        shutil.rmtree(self.tempdir)
+
+    def _makeOne(self, metric='rss'):
+        from superlance.textfile import TextfileExporter
+        return TextfileExporter(self.path, metric)
+
+    def _read(self):
+        with open(self.path) as f:
+            return f.read().splitlines()
+
+    def test_write(self):
+        exporter = self._makeOne()
+        exporter.sample('foo:foo', 1024, 2048)
+        exporter.sample('web:web_"01"', 10, 20)
+        exporter.restarted('foo:foo')
+        exporter.write(0.25)
+        lines = self._read()
+        self.assertTrue('# TYPE memmon_memory_bytes gauge' in lines)
+        self.assertTrue('# TYPE memmon_restarts_total counter' in lines)
+        self.assertTrue('memmon_memory_bytes{group="foo",name="foo",'
+                        'metric="rss"} 1024' in lines)
+        self.assertTrue('memmon_limit_bytes{group="web",name="web_\\"01\\"",'
+                        'metric="rss"} 20' in lines)
+        self.assertTrue('memmon_restarts_total{group="foo",name="foo",'
+                        'metric="rss"} 1' in lines)
+        self.assertTrue('memmon_collection_seconds 0.250000' in lines)
+        self.assertEqual(os.listdir(self.tempdir), ['memmon.prom'])
+
+    def test_write_incremental(self):
+        exporter = self._makeOne('pss')
+        exporter.sample('foo:foo', 1024, 2048)
+        exporter.sample('bar:bar', 1024, 2048)
+        exporter.write(0)
+        cached = exporter.series['memmon_limit_bytes']['foo:foo']
+        exporter.sample('foo:foo', 4096, 2048)
+        exporter.write(0)
+        # unchanged values are not formatted again
+        self.assertTrue(
+            exporter.series['memmon_limit_bytes']['foo:foo'] is cached)
+        lines = self._read()
+        self.assertTrue('memmon_memory_bytes{group="foo",name="foo",'
+                        'metric="pss"} 4096' in lines)
+        # bar wasn't measured on the last tick
+        self.assertFalse([l for l in lines if 'name="bar"' in l])
@@ -0,0 +1,143 @@
+import socket
+import ssl
+import threading
+import time
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+try:
+    from socketserver import ThreadingMixIn
+except ImportError:
+    from SocketServer import ThreadingMixIn
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    timeout = 5
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.client_address)
+
+    def do_GET(self):
+        body = b'OK'
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+class ThreadingServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class ConnectionPoolTests(unittest.TestCase):
+    def _startServer(self, timeout=5):
+        # a class statement, since the handler is a classic class on
+        # Python 2
+        class Handler(KeepAliveHandler):
+            pass
+        Handler.timeout = timeout
+        server = ThreadingServer(('127.0.0.1', 0), Handler)
+        server.connections = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, '127.0.0.1:%d' % server.server_address[1]
+
+    def _makeOne(self, timeout=5):
+        from superlance.timeoutconn import ConnectionPool
+        from superlance.timeoutconn import TimeoutHTTPConnection
+        pool = ConnectionPool(TimeoutHTTPConnection, timeout)
+        self.addCleanup(pool.close)
+        return pool
+
+    def _get(self, pool, hostport):
+        conn, res = pool.request(hostport, 'GET', '/', {})
+        body = res.read()
+        pool.release(hostport, conn, res)
+        return res.status, body
+
+    def test_reuses_connection(self):
+        server, hostport = self._startServer()
+        pool = self._makeOne()
+        for i in range(3):
+            self.assertEqual(self._get(pool, hostport), (200, b'OK'))
+        self.assertEqual(len(server.connections), 1)
+
+    def test_reuses_connection_after_search(self):
+        from superlance.httpok import search_body
+        server, hostport = self._startServer()
+        pool = self._makeOne()
+        for i in range(3):
+            conn, res = pool.request(hostport, 'GET', '/', {})
+            self.assertEqual(search_body(res, b'OK', 1024), (True, True))
+            pool.release(hostport, conn, res)
+        self.assertEqual(len(server.connections), 1)
+
+    def test_reconnects_after_server_close(self):
+        # the server drops idle connections after 0.1 seconds
+        server, hostport = self._startServer(timeout=0.1)
+        pool = self._makeOne()
+        self.assertEqual(self._get(pool, hostport), (200, b'OK'))
+        time.sleep(0.5)
+        self.assertEqual(self._get(pool, hostport), (200, b'OK'))
+        self.assertEqual(len(server.connections), 2)
+
+    def test_connection_refused_is_raised(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        hostport = '127.0.0.1:%d' % sock.getsockname()[1]
+        sock.close()
+        pool = self._makeOne()
+        self.assertRaises(socket.error, pool.request, hostport, 'GET', '/',
+                          {})
+
+    def test_connection_refused_keeps_errno(self):
+        import errno
+        from superlance.timeoutconn import TimeoutHTTPConnection
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        conn = TimeoutHTTPConnection('127.0.0.1', port)
+        conn.timeout = 5
+        try:
+            conn.request('GET', '/')
+        except socket.error as e:
+            self.assertEqual(e.errno, errno.ECONNREFUSED)
+        else:
+            self.fail('connection not refused')
+
+    def test_https_connections_share_tls_session(self):
+        from superlance.timeoutconn import TimeoutHTTPSConnection
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        self.addCleanup(listener.close)
+        hostport = '127.0.0.1:%d' % listener.getsockname()[1]
+        offered = []
+        class DummySSLSocket:
+            def __init__(self, session):
+                self.session = session
+        class DummyContext:
+            def wrap_socket(self, sock, server_hostname=None, session=None):
+                offered.append(session)
+                sock.close()
+                return DummySSLSocket('session-%d' % len(offered))
+        from superlance.timeoutconn import ConnectionPool
+        pool = ConnectionPool(TimeoutHTTPSConnection, 5)
+        for i in range(2):
+            conn, reused = pool.get(hostport, new=True)
+            self.assertFalse(reused)
+            conn.tls.context = DummyContext()
+            conn.connect()
+        self.assertEqual(offered[0], None)
+        self.assertEqual(pool.tls[hostport].session, 'session-2')
+        if hasattr(ssl, 'SSLSession'):
+            self.assertEqual(offered[1], 'session-1')
@@ -0,0 +1,117 @@
+##############################################################################
+#
+# Copyright (c) 2007 Agendaless Consulting and Contributors.
+# All Rights Reserved.
+#
+# This software is subject to the provisions of the BSD-like license at
+# http://www.repoze.org/LICENSE.txt.  A copy of the license should accompany
+# this distribution.  THIS SOFTWARE IS PROVIDED "AS IS" AND ANY AND ALL
+# EXPRESS OR IMPLIED WARRANTIES ARE DISCLAIMED, INCLUDING, BUT NOT LIMITED TO,
+# THE IMPLIED WARRANTIES OF TITLE, MERCHANTABILITY, AGAINST INFRINGEMENT, AND
+# FITNESS FOR A PARTICULAR PURPOSE
+#
+##############################################################################
+
+# Writes memmon's measurements as a Prometheus node_exporter "textfile
+# collector" file (memmon --textfile).
+
+import os
+import threading
+from collections import OrderedDict
+
+FAMILIES = (
+    ('memmon_memory_bytes', 'gauge',
+     'Memory usage of a supervisor process, as checked by memmon.'),
+    ('memmon_limit_bytes', 'gauge',
+     'Memory limit memmon applies to a supervisor process.'),
+    ('memmon_restarts_total', 'counter',
+     'Processes restarted by memmon since it started.'),
+    ('memmon_collection_seconds', 'gauge',
+     'Time memmon spent measuring processes on the last tick.'),
+    )
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+class TextfileExporter:
+    """Keeps the exposition line of each series and only formats it again
+    when its value changes.  write() joins the cached lines and replaces
+    the file atomically."""
+
+    def __init__(self, path, metric='rss'):
+        self.path = path
+        self.metric = escape(metric)
+        self.series = {}
+        for family, kind, help in FAMILIES:
+            self.series[family] = OrderedDict()
+        self.labels = {} # namespec -> rendered label set
+        self.seen = set()
+        self.restarts = {}
+        self.lock = threading.Lock()
+
+    def label_set(self, namespec):
+        try:
+            return self.labels[namespec]
+        except KeyError:
+            group, name = namespec.split(':', 1)
+            labels = self.labels[namespec] = (
+                '{group="%s",name="%s",metric="%s"}' % (
+                escape(group), escape(name), self.metric))
+            return labels
+
+    def set(self, family, namespec, value):
+        series = self.series[family]
+        cached = series.get(namespec)
+        if cached is None or cached[0] != value:
+            series[namespec] = (value, '%s%s %s\n' % (
+                family, self.label_set(namespec), value))
+
+    def sample(self, namespec, usage, limit):
+        self.seen.add(namespec)
+        self.set('memmon_memory_bytes', namespec, usage)
+        self.set('memmon_limit_bytes', namespec, limit)
+
+    def restarted(self, namespec):
+        # called from restart threads
+        with self.lock:
+            self.restarts[namespec] = self.restarts.get(namespec, 0) + 1
+
+    def render(self, collection_seconds):
+        # forget processes that weren't measured on this tick
+        for family in ('memmon_memory_bytes', 'memmon_limit_bytes'):
+            series = self.series[family]
+            for namespec in [n for n in series if n not in self.seen]:
+                del series[namespec]
+        self.seen = set()
+
+        with self.lock:
+            restarts = list(self.restarts.items())
+        for namespec, count in restarts:
+            self.set('memmon_restarts_total', namespec, count)
+        self.series['memmon_collection_seconds'][None] = (
+            collection_seconds,
+            'memmon_collection_seconds %.6f\n' % collection_seconds)
+
+        chunks = []
+        for family, kind, help in FAMILIES:
+            chunks.append('# HELP %s %s\n# TYPE %s %s\n' % (
+                family, help, family, kind))
+            chunks.extend([line for value, line in
+                           self.series[family].values()])
+        return ''.join(chunks)
+
+    def write(self, collection_seconds):
+        data = self.render(collection_seconds)
+        # write next to the target so the rename is atomic; node_exporter
+        # ignores files that don't end in .prom
+        tmp = '%s.%d.tmp' % (self.path, os.getpid())
+        try:
+            with open(tmp, 'w') as f:
+                f.write(data)
+            os.rename(tmp, self.path)
+        except (IOError, OSError):
+            try:
+                os.remove(tmp)
+            except OSError:
+                pass
+            raise
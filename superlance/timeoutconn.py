@@ -1,6 +1,7 @@
 from superlance.compat import httplib
 import socket
 import ssl
+import threading
 
 
 class TimeoutHTTPConnection(httplib.HTTPConnection):
@@ -12,7 +13,7 @@ class TimeoutHTTPConnection(httplib.HTTPConnection):
         """Override HTTPConnection.connect to connect to
         host/port specified in __init__."""
 
-        e = "getaddrinfo returns an empty list"
+        error = socket.error("getaddrinfo returns an empty list")
         for res in socket.getaddrinfo(self.host, self.port,
                                       0, socket.SOCK_STREAM):
             af, socktype, proto, canonname, sa = res
@@ -21,18 +22,56 @@ class TimeoutHTTPConnection(httplib.HTTPConnection):
                 if self.timeout:   # this is the new bit
                     self.sock.settimeout(self.timeout)
                 self.sock.connect(sa)
-            except socket.error:
+            except socket.error as e:
+                # raised if no address works, so that callers can tell
+                # e.g. a refused connection by its errno
+                error = e
                 if self.sock:
                     self.sock.close()
                 self.sock = None
                 continue
             break
         if not self.sock:
-            raise socket.error(e)
+            raise error
+
+
+class TLSSession:
+    """An SSL context shared by the connections to one host:port, and the
+    last TLS session negotiated with it, which new connections offer to
+    resume instead of doing a full handshake.  Like ssl.wrap_socket,
+    certificates aren't verified."""
+
+    def __init__(self, key_file=None, cert_file=None):
+        if hasattr(ssl, 'PROTOCOL_TLS_CLIENT'):
+            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        else:
+            self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.context.check_hostname = False
+        self.context.verify_mode = ssl.CERT_NONE
+        if cert_file:
+            self.context.load_cert_chain(cert_file, key_file)
+        self.session = None
+
+    def wrap_socket(self, sock, hostname):
+        if hasattr(ssl, 'SSLSession'): # Python 3.6+
+            sock = self.context.wrap_socket(sock, server_hostname=hostname,
+                                            session=self.session)
+        else:
+            sock = self.context.wrap_socket(sock, server_hostname=hostname)
+        self.update(sock)
+        return sock
+
+    def update(self, sock):
+        # TLS 1.3 servers send session tickets after the handshake, so
+        # this is also called once a response has been read
+        session = getattr(sock, 'session', None)
+        if session is not None:
+            self.session = session
 
 
 class TimeoutHTTPSConnection(httplib.HTTPSConnection):
     timeout = None
+    tls = None # TLSSession, set by ConnectionPool to share it
 
     def connect(self):
         "Connect to a host on a given (SSL) port."
@@ -41,4 +80,88 @@ class TimeoutHTTPSConnection(httplib.HTTPSConnection):
         if self.timeout:
             sock.settimeout(self.timeout)
         sock.connect((self.host, self.port))
-        self.sock = ssl.wrap_socket(sock, self.key_file, self.cert_file)
+        if self.tls is None:
+            self.tls = TLSSession(getattr(self, 'key_file', None),
+                                  getattr(self, 'cert_file', None))
+        self.sock = self.tls.wrap_socket(sock, self.host)
+
+
+class ConnectionPool:
+    """Keeps an idle HTTP/1.1 connection per host:port open between
+    requests, so that checking a URL every tick doesn't pay for a new TCP
+    (and TLS) handshake each time.  HTTPS connections to the same host:port
+    share a TLSSession, so that reconnecting resumes the TLS session.
+
+    Connections are taken out of the pool while in use, so the pool may
+    be shared by threads."""
+
+    def __init__(self, connclass, timeout=None):
+        self.connclass = connclass
+        self.timeout = timeout
+        self.idle = {} # hostport -> [connection]
+        self.tls = {} # hostport -> TLSSession
+        self.lock = threading.Lock()
+
+    def get(self, hostport, new=False, timeout=None):
+        """Return (connection, reused), where reused is True if the
+        connection was used for an earlier request."""
+        if timeout is None:
+            timeout = self.timeout
+        if not new:
+            with self.lock:
+                idle = self.idle.get(hostport)
+                conn = idle and idle.pop()
+            if conn:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+        conn = self.connclass(hostport)
+        conn.timeout = timeout
+        if hasattr(conn, 'tls'):
+            with self.lock:
+                tls = self.tls.get(hostport)
+                if tls is None:
+                    tls = self.tls[hostport] = TLSSession(
+                        getattr(conn, 'key_file', None),
+                        getattr(conn, 'cert_file', None))
+            conn.tls = tls
+        return conn, False
+
+    def release(self, hostport, conn, response):
+        """Return a connection to the pool once its response has been read
+        completely.  Connections the server is going to close are closed."""
+        if getattr(response, 'will_close', True) or \
+                getattr(conn, 'sock', None) is None:
+            conn.close()
+            return
+        tls = getattr(conn, 'tls', None)
+        if tls is not None:
+            tls.update(conn.sock)
+        with self.lock:
+            self.idle.setdefault(hostport, []).append(conn)
+
+    def request(self, hostport, method, path, headers, timeout=None):
+        """Send a request and return (connection, response).  If an idle
+        connection turns out to have been closed by the server, the
+        request is sent again on a new connection."""
+        conn, reused = self.get(hostport, timeout=timeout)
+        while 1:
+            try:
+                conn.request(method, path, headers=headers)
+                return conn, conn.getresponse()
+            except socket.timeout:
+                conn.close()
+                raise
+            except (socket.error, httplib.HTTPException):
+                conn.close()
+                if not reused:
+                    raise
+            conn, reused = self.get(hostport, new=True, timeout=timeout)
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()